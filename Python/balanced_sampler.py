@@ -0,0 +1,136 @@
+'''
+Class-balanced batches drawn from the full, unbalanced training set.
+
+main1.py used to keep 3000 random images per class and throw the rest away. BalancedSampler keeps
+every image and draws each batch by rejection sampling instead: a uniformly random position is
+accepted with probability weight[class] / max(weight), where weight = target share / class share,
+so accepted images follow the target class mix (equal by default) while each class's images are
+still equally likely. Besides the file list it only holds one int8 label per image and a weight per
+class: no per-class frames or index lists, and a batch costs the same however large the dataset is.
+
+An epoch is a configurable number of images. Every batch is drawn from a generator seeded with
+(seed, epoch, batch index), so epochs are reproducible and batches can be built in any order by
+keras workers. Pixels come from the pixel cache when one is given, otherwise the JPEGs are decoded
+one by one; augmentation and rescaling come from the given ImageDataGenerator as in the other
+iterators. main1.py uses the sampler for LOADER=cache and LOADER=generator; with LOADER=tfdata the
+balanced draw happens inside tf_pipeline.make_dataset (epoch_images), which keeps its own parallel
+decoding. balanced_indices() is one such draw as plain positions, for callers with their own loader.
+'''
+import numpy as np
+from tensorflow.keras.utils import Sequence
+
+from pixel_cache import load_pixels
+
+
+def acceptance(classes, num_classes, class_indices, class_weights=None):
+    # acceptance probability per class: equal share for every class present, or the class_weights mix
+    counts = np.bincount(classes, minlength=num_classes)
+    if class_weights is None:
+        target = (counts > 0).astype(np.float64)
+    else:
+        target = np.zeros(num_classes)
+        for klass, i in class_indices.items():
+            target[i] = class_weights.get(klass, 0.0)
+    target /= target.sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(counts > 0, target / (counts / len(classes)), 0.0)
+    return weight / weight.max()
+
+
+def draw(classes, accept, rng, size):
+    # size image positions, accepted with probability accept[class]
+    chosen = np.empty(0, dtype=np.int64)
+    while len(chosen) < size:
+        candidates = rng.integers(0, len(classes), 2 * size)
+        keep = rng.random(len(candidates)) < accept[classes[candidates]]
+        chosen = np.concatenate([chosen, candidates[keep]])
+    return chosen[:size]
+
+
+def balanced_indices(labels, size, seed=123, class_indices=None, class_weights=None):
+    '''
+    size positions into labels drawn with the same class mix BalancedSampler batches have.
+    '''
+    if class_indices is None:
+        class_indices = {klass: i for i, klass in enumerate(sorted(set(labels)))}
+    classes = np.fromiter((class_indices[l] for l in labels), dtype=np.int8, count=len(labels))
+    accept = acceptance(classes, len(class_indices), class_indices, class_weights)
+    return draw(classes, accept, np.random.default_rng(seed), size)
+
+
+class BalancedSampler(Sequence):
+    def __init__(self, filepaths, labels, image_data_generator, target_size, batch_size=32, epoch_images=9000,
+                 class_weights=None, seed=123, class_indices=None, cache=None):
+        self.filepaths = filepaths  # the caller's sequence, not copied
+        self.image_data_generator = image_data_generator
+        self.target_size = tuple(target_size)
+        self.image_shape = self.target_size + (3,)
+        self.batch_size = batch_size
+        self.epoch_images = epoch_images
+        self.seed = seed
+        self.cache = cache  # PixelCache over the same filepaths, in the same order
+        if class_indices is None:
+            class_indices = {klass: i for i, klass in enumerate(sorted(set(labels)))}
+        self.class_indices = class_indices
+        self.num_classes = len(class_indices)
+        self.classes = np.fromiter((class_indices[l] for l in labels), dtype=np.int8, count=len(filepaths))
+        self.n = len(self.classes)
+        self.accept = acceptance(self.classes, self.num_classes, class_indices, class_weights)
+        self.epoch = 0
+        self.batch_index = 0
+        self.total_batches_seen = 0
+
+    def _augments(self):
+        gen = self.image_data_generator
+        return any([gen.rotation_range, gen.width_shift_range, gen.height_shift_range, gen.shear_range,
+                    gen.zoom_range[0] != 1 or gen.zoom_range[1] != 1, gen.channel_shift_range,
+                    gen.horizontal_flip, gen.vertical_flip, gen.brightness_range is not None])
+
+    def __len__(self):
+        return (self.epoch_images + self.batch_size - 1) // self.batch_size
+
+    def draw(self, rng, size):
+        return draw(self.classes, self.accept, rng, size)
+
+    def __getitem__(self, idx):
+        rng = np.random.default_rng([self.seed, self.epoch, idx])
+        size = min(self.batch_size, self.epoch_images - idx * self.batch_size)
+        index_array = self.draw(rng, size)
+        if self.cache is not None:
+            order = np.argsort(index_array)  # memmap reads are cheapest in file order
+            batch = np.empty((size,) + self.image_shape, dtype=np.uint8)
+            batch[order] = self.cache.pixels[index_array[order]]
+        else:
+            batch = np.stack([load_pixels(self.filepaths[i], self.target_size) for i in index_array])
+        batch_x = batch.astype('float32')
+        gen = self.image_data_generator
+        augment = self._augments()
+        for i in range(size):
+            if augment:
+                params = gen.get_random_transform(self.image_shape, seed=int(rng.integers(2 ** 31 - 1)))
+                batch_x[i] = gen.apply_transform(batch_x[i], params)
+            batch_x[i] = gen.standardize(batch_x[i])
+        batch_y = np.zeros((size, self.num_classes), dtype='float32')
+        batch_y[np.arange(size), self.classes[index_array]] = 1.0
+        return batch_x, batch_y
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def reset(self):
+        self.batch_index = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        if self.batch_index >= len(self):
+            self.batch_index = 0
+            self.on_epoch_end()
+        batch = self[self.batch_index]
+        self.batch_index += 1
+        self.total_batches_seen += 1
+        return batch
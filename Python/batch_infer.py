@@ -0,0 +1,246 @@
+'''
+Headless batch classification of a folder (or list) of images.
+
+Uses the same preprocessing as gui.classify, decodes images in a thread pool, runs predict on large
+batches and streams one row per image to a CSV or JSONL file as it goes. Only a couple of batches are
+in memory at any time. Re-running with the same output file resumes after the last written row.
+Files whose content was already scored by the same model come from the prediction cache.
+
+--model is a model registry name (see registry.py) or a file path. With --switch-file the run checks
+that file between batches and moves to the model named in it without restarting; JSONL rows record
+which model scored them.
+
+    python batch_infer.py /data/tiles --output scores.csv --batch-size 256
+    python batch_infer.py --file-list tiles.txt --output scores.jsonl --model modelGAN-C.h5 --switch-file model.txt
+'''
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from inference import DEFAULT_MODEL, load_image_bytes, lung_cancer_type
+from pixel_cache import IMAGE_EXTENSIONS
+from prediction_cache import PredictionCache, content_hash, model_id
+from registry import ModelRegistry
+
+
+def iter_paths(inputs, file_list=None):
+    # walks directories in sorted order so an interrupted run sees the files in the same order again
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for f in sorted(files):
+                    if f.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, f)
+        else:
+            yield item
+    if file_list:
+        with open(file_list) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+def chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ResultWriter:
+    '''
+    Appends results to a .csv or .jsonl file and flushes after every batch.
+    On open it drops a partially written last line and remembers how many rows are complete.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.jsonl = path.endswith('.jsonl')
+        self.done, self.last_path = self._recover()
+        self.file = open(path, 'a', newline='')
+        if self.jsonl:
+            self.writer = None
+        else:
+            self.writer = csv.writer(self.file)
+            if self.done == 0 and self.file.tell() == 0:
+                self.writer.writerow(['path', 'class'] + lung_cancer_type + ['error'])
+
+    def _recover(self):
+        if not os.path.exists(self.path):
+            return 0, None
+        with open(self.path, 'rb+') as f:
+            # only a partial last line needs repair: scan back from the end to the last newline
+            end = f.seek(0, os.SEEK_END)
+            complete = end
+            while complete > 0:
+                step = min(65536, complete)
+                f.seek(complete - step)
+                newline = f.read(step).rfind(b'\n')
+                if newline >= 0:
+                    complete += newline + 1 - step
+                    break
+                complete -= step
+            if complete != end:
+                f.truncate(complete)  # the run was killed in the middle of a line
+        done = 0
+        last_path = None
+        with open(self.path, newline='') as f:
+            if self.jsonl:
+                for line in f:
+                    if not line.strip():
+                        continue  # the run was killed right after a newline
+                    done += 1
+                    last_path = json.loads(line)['path']
+            else:
+                reader = csv.reader(f)
+                next(reader, None)  # header
+                for row in reader:
+                    if not row:
+                        continue
+                    done += 1
+                    last_path = row[0]
+        return done, last_path
+
+    def write(self, path, probs=None, error='', model=None):
+        if probs is None:
+            predicted = 'error'
+        else:
+            predicted = lung_cancer_type[int(np.argmax(probs))]
+        if self.jsonl:
+            record = {'path': path, 'class': predicted}
+            if model:
+                record['model'] = model
+            if probs is not None:
+                record['probabilities'] = {k: float(p) for k, p in zip(lung_cancer_type, probs)}
+            if error:
+                record['error'] = error
+            self.file.write(json.dumps(record) + '\n')
+        else:
+            values = [f'{p:.6f}' for p in probs] if probs is not None else [''] * len(lung_cancer_type)
+            self.writer.writerow([path, predicted] + values + [error])
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def load(path, size, cache=None, identity=None):
+    # (image, error, cache key, cached probabilities); files scored before by this model are not decoded
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = cache.key(content_hash(data), identity) if cache else None
+        cached = cache.get(key) if cache else None
+        if cached is not None:
+            return None, '', key, cached
+        return load_image_bytes(data, size), '', key, None
+    except Exception as e:  # unreadable files get an error row instead of stopping the run
+        return None, f'{type(e).__name__}: {e}', None, None
+
+
+def skip_done(paths, writer):
+    # the walk order is stable, so resuming only has to skip as many paths as there are rows
+    skipped = None
+    for skipped in islice(paths, writer.done):
+        pass
+    if writer.done and skipped != writer.last_path:
+        sys.exit(f'{writer.path} does not match the inputs ({skipped!r} != {writer.last_path!r}), '
+                 'use a new output file')
+    return paths
+
+
+def check_switch(registry, switch_file):
+    # moves the registry to the model named in switch_file, if that changed
+    if not switch_file or not os.path.exists(switch_file):
+        return
+    with open(switch_file) as f:
+        name = f.read().strip()
+    if name and registry.resolve(name) != registry.active:
+        print(f'\nSwitching to {name}')
+        registry.set_active(name)
+
+
+def run(registry, paths, writer, batch_size=256, workers=None, prefetch=2, switch_file=None, cache=None):
+    total = 0
+    start = time.perf_counter()
+
+    def finish(chunk, futures, name):
+        nonlocal total
+        model, _ = registry.get(name)
+        loaded = [f.result() for f in futures]
+        ok = [i for i, (image, *_) in enumerate(loaded) if image is not None]
+        predict_start = time.perf_counter()
+        probs = model.predict_on_batch(np.stack([loaded[i][0] for i in ok])) if ok else []
+        probs = dict(zip(ok, np.asarray(probs)))
+        if cache and ok:
+            per_image_ms = (time.perf_counter() - predict_start) * 1000 / len(ok)
+            cache.put_many([(loaded[i][2], probs[i], per_image_ms) for i in ok])
+        probs.update((i, item[3]) for i, item in enumerate(loaded) if item[3] is not None)
+        for i, path in enumerate(chunk):
+            writer.write(path, probs.get(i), loaded[i][1], name)
+        writer.flush()
+        total += len(chunk)
+        rate = total / (time.perf_counter() - start)
+        print(f'\r{writer.done + total} images, {rate:.1f} img/s', end='', flush=True)
+
+    # keep `prefetch` batches decoding while the current one is predicted
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        pending = deque()
+        for chunk in chunks(paths, batch_size):
+            check_switch(registry, switch_file)
+            # decoded at the input size of the model that is active now, which also scores the chunk
+            size = registry.input_size()
+            identity = model_id(registry.info()) if cache else None
+            pending.append((chunk, [pool.submit(load, p, size, cache, identity) for p in chunk], registry.active))
+            if len(pending) > prefetch:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+    print()
+    if cache:
+        print(cache.summary().capitalize())
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify a folder or list of images without the GUI')
+    parser.add_argument('inputs', nargs='*', help='image files or directories (searched recursively)')
+    parser.add_argument('--file-list', help='text file with one image path per line')
+    parser.add_argument('--output', required=True, help='.csv or .jsonl file, appended to when it already exists')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='registry name, .h5 model or quantized .tflite')
+    parser.add_argument('--switch-file', help='file holding a model name, re-read between batches to switch models')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None, help='decoding threads (default: all cores)')
+    parser.add_argument('--no-cache', action='store_true', help='score every file even if it was scored before')
+    args = parser.parse_args()
+    if not args.inputs and not args.file_list:
+        parser.error('give at least one input or --file-list')
+
+    registry = ModelRegistry()
+    registry.discover()
+    registry.set_active(args.model)
+    registry.get()  # load and warm up before the clock starts
+
+    writer = ResultWriter(args.output)
+    if writer.done:
+        print(f'Resuming after {writer.done} images already in {args.output}')
+    try:
+        paths = skip_done(iter_paths(args.inputs, args.file_list), writer)
+        run(registry, paths, writer, batch_size=args.batch_size, workers=args.workers, switch_file=args.switch_file,
+            cache=None if args.no_cache else PredictionCache())
+    finally:
+        writer.close()
@@ -0,0 +1,90 @@
+'''
+Side-by-side input pipeline throughput in images/sec.
+
+Compares ImageDataGenerator.flow_from_directory, the pixel cache and the tf.data pipeline on the
+same directory with the same augmentation settings as main.py, without running a model.
+
+    python bench_input.py /path/to/lung_image_sets/train --size 180 --batch-size 8 --batches 200
+'''
+import argparse
+import json
+import time
+
+from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+from pixel_cache import flow_from_cache, list_directory
+from tf_pipeline import make_dataset
+
+
+def main_generator():
+    # same augmentation as main.py
+    return ImageDataGenerator(
+        rescale=1./255,
+        shear_range=0.2,
+        zoom_range=0.2,
+        horizontal_flip=True,
+        fill_mode='nearest',
+        width_shift_range=0.1,
+        height_shift_range=0.1
+    )
+
+
+def measure(batches, num_batches, warmup=2):
+    # images/sec over num_batches, after a few warm-up batches that start workers and fill buffers
+    it = iter(batches)
+    for _ in range(warmup):
+        next(it)
+    images = 0
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        x, _ = next(it)
+        images += len(x)
+    return images / (time.perf_counter() - start)
+
+
+def build_loader(name, directory, target_size, batch_size, seed=123):
+    gen = main_generator()
+    if name == 'generator':
+        return gen.flow_from_directory(directory, target_size=target_size, class_mode='categorical',
+                                       shuffle=True, batch_size=batch_size, seed=seed)
+    filepaths, labels = list_directory(directory)
+    if name == 'cache':
+        return flow_from_cache(gen, filepaths, labels, target_size, batch_size=batch_size, shuffle=True, seed=seed,
+                               name='bench')
+    if name == 'tfdata':
+        return make_dataset(filepaths, labels, gen, target_size, batch_size=batch_size, shuffle=True, seed=seed).repeat()
+    if name == 'tfdata-cached':
+        return make_dataset(filepaths, labels, gen, target_size, batch_size=batch_size, shuffle=True, seed=seed,
+                            cache='').repeat()
+    raise ValueError(f'unknown loader {name}')
+
+
+def run(directory, target_size, batch_size, num_batches, loaders):
+    results = {}
+    for name in loaders:
+        loader = build_loader(name, directory, target_size, batch_size)  # the pixel cache is built here
+        if name == 'tfdata-cached':
+            measure(loader, -(-len(list_directory(directory)[0]) // batch_size))  # first epoch fills the cache
+        results[name] = measure(loader, num_batches)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare input pipeline throughput in images/sec')
+    parser.add_argument('directory', help='folder with one sub-folder per class')
+    parser.add_argument('--size', type=int, default=180, help='target height and width')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--batches', type=int, default=100, help='batches timed per loader')
+    parser.add_argument('--loaders', default='generator,cache,tfdata,tfdata-cached')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = run(args.directory, (args.size, args.size), args.batch_size, args.batches, args.loaders.split(','))
+    baseline = results.get('generator')
+    print(f'{"Loader":<16s}{"img/s":>10s}{"speedup":>10s}')
+    for name, rate in results.items():
+        speedup = f'{rate / baseline:9.2f}x' if baseline else ''
+        print(f'{name:<16s}{rate:>10.1f}{speedup:>10s}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'size': args.size, 'batch_size': args.batch_size, 'images_per_sec': results}, f, indent=2)
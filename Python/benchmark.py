@@ -0,0 +1,195 @@
+'''
+Reproducible performance benchmarks with regression checks.
+
+Generates seeded synthetic 768x768 histology-like JPEGs (so no dataset is needed) and measures:
+  decode      JPEG decode + resize to IMG_H x IMG_W, images/sec
+  augment     ImageDataGenerator.flow_from_directory with the main.py augmentation, images/sec
+  train_cnn   train step of the main.py CNN, ms/step and images/sec
+  train_vgg19 train step of the main1.py VGG19 model, ms/step and images/sec
+  predict     predict latency of model.h5 and modelGAN-C.h5 at batch sizes 1/8/32/128
+
+Results go to a JSON file. --compare checks them against a saved baseline and exits with status 1
+when any metric got worse by more than --tolerance.
+
+    python benchmark.py --out baseline.json
+    python benchmark.py --out current.json --compare baseline.json --tolerance 0.1
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from bench_input import main_generator, measure
+from pixel_cache import list_directory, load_pixels
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREDICT_MODELS = [os.path.join(REPO_DIR, 'model.h5'), os.path.join(REPO_DIR, 'modelGAN-C.h5')]
+PREDICT_BATCH_SIZES = (1, 8, 32, 128)
+CLASS_NAMES = ('lung_aca', 'lung_n', 'lung_scc')
+
+
+def synthesize_dataset(directory, per_class=32, size=768, seed=1337):
+    # H&E-like pink/purple background with darker nuclei blobs, different density per class
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    for c, klass in enumerate(CLASS_NAMES):
+        os.makedirs(os.path.join(directory, klass), exist_ok=True)
+        for i in range(per_class):
+            base = np.array([230, 170, 200]) + rng.randint(-15, 15, 3)
+            img = np.empty((size, size, 3), dtype=np.float32)
+            img[:] = base
+            img += rng.normal(0, 12, (size, size, 3))
+            for _ in range(40 + 30 * c):
+                cx, cy = rng.randint(0, size, 2)
+                r = rng.randint(6, 18)
+                mask = (xx - cx) ** 2 + (yy - cy) ** 2 < r * r
+                img[mask] = np.array([90, 50, 140]) + rng.randint(-20, 20, 3)
+            Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(
+                os.path.join(directory, klass, f'{klass}{i}.jpeg'), quality=90)
+
+
+def timed(fn, repeats):
+    # median seconds of fn() over repeats
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def bench_decode(directory, img_size, repeats):
+    filepaths, _ = list_directory(directory)
+    seconds = timed(lambda: [load_pixels(p, img_size) for p in filepaths], repeats)
+    return {'images_per_sec': len(filepaths) / seconds}
+
+
+def bench_augment(directory, img_size, batch_size, repeats):
+    gen = main_generator().flow_from_directory(directory, target_size=img_size, class_mode='categorical',
+                                               shuffle=True, batch_size=batch_size, seed=123)
+    return {'images_per_sec': float(np.median([measure(gen, 20) for _ in range(repeats)]))}
+
+
+def bench_train_step(model, img_shape, batch_size, steps, repeats):
+    rng = np.random.RandomState(0)
+    x = rng.uniform(-1, 1, (batch_size,) + img_shape).astype(np.float32)
+    y = np.eye(3, dtype=np.float32)[rng.randint(0, 3, batch_size)]
+    for _ in range(3):  # graph tracing and allocator warm-up
+        model.train_on_batch(x, y)
+    seconds = timed(lambda: [model.train_on_batch(x, y) for _ in range(steps)], repeats) / steps
+    return {'ms_per_step': seconds * 1000, 'images_per_sec': batch_size / seconds}
+
+
+def bench_predict(model_path, repeats):
+    from keras.models import load_model
+    model = load_model(model_path)
+    shape = tuple(model.input_shape[1:])
+    results = {}
+    for batch_size in PREDICT_BATCH_SIZES:
+        x = np.random.RandomState(0).uniform(0, 1, (batch_size,) + shape).astype(np.float32)
+        model.predict_on_batch(x)
+        seconds = timed(lambda: model.predict_on_batch(x), max(repeats, 5))
+        results[f'batch{batch_size}_ms'] = seconds * 1000
+        results[f'batch{batch_size}_images_per_sec'] = batch_size / seconds
+    return results
+
+
+def run(args):
+    import tensorflow as tf
+    from tensorflow.keras.optimizers import Adam, Adamax
+    from models import build_cnn, build_vgg19
+
+    tf.keras.utils.set_random_seed(1337)
+    img_size = (args.img_size, args.img_size)
+    only = set(args.only.split(',')) if args.only else None
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='lung-bench-')
+    try:
+        data_dir = os.path.join(workdir, 'images')
+        synthesize_dataset(data_dir, per_class=args.images_per_class)
+        if not only or 'decode' in only:
+            results['decode'] = bench_decode(data_dir, img_size, args.repeats)
+        if not only or 'augment' in only:
+            results['augment'] = bench_augment(data_dir, img_size, args.batch_size, args.repeats)
+        if not only or 'train_cnn' in only:
+            model = build_cnn(args.img_size, args.img_size)
+            model.compile(loss='categorical_crossentropy', optimizer=Adam(learning_rate=1e-3), metrics=['accuracy'])
+            results['train_cnn'] = bench_train_step(model, img_size + (3,), args.batch_size, args.steps, args.repeats)
+        if not only or 'train_vgg19' in only:
+            # random weights: step time does not depend on them and nothing has to be downloaded
+            model, _ = build_vgg19((224, 224, 3), 3, weights=None)
+            model.compile(Adamax(learning_rate=.001), loss='categorical_crossentropy', metrics=['accuracy'])
+            results['train_vgg19'] = bench_train_step(model, (224, 224, 3), args.vgg_batch_size, args.steps, args.repeats)
+        if not only or 'predict' in only:
+            for path in PREDICT_MODELS:
+                if os.path.exists(path):
+                    results['predict_' + os.path.splitext(os.path.basename(path))[0]] = bench_predict(path, args.repeats)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'tensorflow': tf.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': {k: v for k, v in vars(args).items() if k not in ('out', 'compare')},
+        },
+        'results': results,
+    }
+
+
+def compare(current, baseline, tolerance):
+    # returns the list of regressions; *_per_sec metrics should not drop, *_ms metrics should not rise
+    regressions = []
+    print(f'{"Benchmark":<40s}{"baseline":>14s}{"current":>14s}{"change":>10s}')
+    for bench, metrics in current['results'].items():
+        for metric, value in metrics.items():
+            old = baseline['results'].get(bench, {}).get(metric)
+            if old is None or old == 0:
+                continue
+            change = (value - old) / old
+            worse = -change if metric.endswith('_per_sec') else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                regressions.append((bench, metric, old, value))
+            print(f'{bench + "." + metric:<40s}{old:>14.2f}{value:>14.2f}{change * 100:>+9.1f}%{flag}')
+    if baseline['meta'].get('config') != current['meta'].get('config'):
+        print('warning: the baseline was recorded with a different configuration')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark decoding, augmentation, training and inference')
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--compare', help='baseline JSON written by an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed relative slowdown per metric')
+    parser.add_argument('--only', help='comma separated subset: decode,augment,train_cnn,train_vgg19,predict')
+    parser.add_argument('--img-size', type=int, default=180, help='IMG_H/IMG_W of main.py')
+    parser.add_argument('--batch-size', type=int, default=8, help='batch_size of main.py')
+    parser.add_argument('--vgg-batch-size', type=int, default=32, help='batch_size of main1.py')
+    parser.add_argument('--images-per-class', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=10, help='train steps per timing')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    current = run(args)
+    with open(args.out, 'w') as f:
+        json.dump(current, f, indent=2)
+    print(f'Results written to {args.out}')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s) beyond {args.tolerance * 100:.0f} %')
+            sys.exit(1)
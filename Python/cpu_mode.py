@@ -0,0 +1,73 @@
+'''
+CPU training mode for main.py and main1.py: explicit thread pools, mixed_bfloat16 and XLA.
+
+configure() has to run before TensorFlow executes its first op, the thread pools cannot be resized
+afterwards. The models in models.py keep their final softmax/sigmoid Dense in float32, so under the
+mixed_bfloat16 policy the convolutions run in bfloat16 while the outputs and the loss stay float32.
+
+Every run appends one line (mode, training time, test accuracy) to a JSONL results file, and
+print_comparison() reports the speedup and accuracy change of each mode against the plain float32
+run of the same script, which is what decides whether a mode is safe to use.
+
+    python main1.py                                   # float32 reference run
+    CPU_MODE=1 BFLOAT16=1 XLA=1 INTRA_THREADS=32 python main1.py
+'''
+import json
+import os
+import time
+
+import tensorflow as tf
+
+
+def configure(intra_threads=0, inter_threads=0, bfloat16=False):
+    # 0 leaves the TensorFlow default (one thread per core for intra-op, a few for inter-op)
+    if intra_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+        os.environ.setdefault('OMP_NUM_THREADS', str(intra_threads))  # oneDNN kernels read this
+    if inter_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+    if bfloat16:
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+
+def mode_name(intra_threads=0, inter_threads=0, bfloat16=False, xla=False, workers=1):
+    name = 'bfloat16' if bfloat16 else 'float32'
+    if xla:
+        name += '+xla'
+    if intra_threads or inter_threads:
+        name += f' threads={intra_threads or "default"}/{inter_threads or "default"}'
+    if workers > 1:
+        name += f' workers={workers}'
+    return name
+
+
+def record_run(results_file, script, mode, train_seconds, epochs, accuracy):
+    record = {'script': script, 'mode': mode, 'train_seconds': train_seconds, 'epochs': epochs,
+              'seconds_per_epoch': train_seconds / epochs if epochs else None, 'accuracy': accuracy,
+              'cpu_count': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(results_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+
+def print_comparison(results_file, script):
+    # latest run of every mode against the latest float32 run of the same script
+    latest = {}
+    with open(results_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['script'] == script:
+                latest[record['mode']] = record
+    reference = latest.get('float32')
+    print(f'{"Mode":<40s}{"Train s":>10s}{"s/epoch":>10s}{"Speedup":>10s}{"Accuracy":>10s}{"Change":>10s}')
+    for mode, record in latest.items():
+        speedup = change = ''
+        if reference and record['seconds_per_epoch'] and reference['seconds_per_epoch']:
+            speedup = f'{reference["seconds_per_epoch"] / record["seconds_per_epoch"]:.2f}x'
+            change = f'{(record["accuracy"] - reference["accuracy"]) * 100:+.2f}'
+        train_seconds = record.get('train_seconds')
+        train = f'{train_seconds:.0f}' if train_seconds is not None else '-'  # older or hand-edited records
+        print(f'{mode:<40s}{train:>10s}{record["seconds_per_epoch"] or 0:>10.1f}{speedup:>10s}'
+              f'{record["accuracy"] * 100:>9.2f}%{change:>10s}')
+    if reference is None:
+        print('no float32 reference run recorded yet, run once without BFLOAT16/XLA to compare against')
@@ -0,0 +1,183 @@
+'''
+Knowledge distillation of the main1.py VGG19 model (teacher) into the main.py CNN (student).
+
+The student learns from the true labels and from the teacher's softened class probabilities:
+
+    loss = alpha * CE(y, student) + (1 - alpha) * T^2 * KL(teacher^(1/T) || student^(1/T))
+
+The teacher only sees un-augmented images, so its outputs on the training and validation files are
+computed once and cached on disk with the feature cache (keyed by the teacher weights and the file
+list); later runs skip VGG19 entirely. The student keeps its usual augmentation. Its last layer is a
+softmax here rather than the sigmoid of main.py, since the distillation loss needs a distribution.
+
+--filters picks a compact variant (one Conv2D per entry). The report compares test accuracy,
+parameter count and single-image CPU latency of student and teacher.
+
+    python distill.py VGG19-fruits-99.00.h5
+    python distill.py VGG19-fruits-99.00.h5 --filters 32,16,16,8 --temperature 4 --alpha 0.3
+'''
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+from evaluation import evaluate_model
+from feature_cache import backbone_fingerprint, cached_features
+from manifest import open_manifest
+from models import build_cnn
+
+PATH = '/home/andrei/Desktop/ProiectLicenta/lung_image_sets'
+
+
+def scalar(img):
+    return img / 127.5 - 1  # the main1.py preprocessing the teacher was trained with
+
+
+def load_splits(path, split_file=None):
+    # {'train'|'val'|'test': DataFrame(filepaths, labels)} from a split.py manifest or the main.py folders
+    if split_file:
+        split_df = pd.read_csv(split_file)
+        return {name: group[['filepaths', 'labels']].reset_index(drop=True)
+                for name, group in split_df.groupby('split')}
+    manifest = open_manifest(path)
+    splits = {}
+    for name in ('train', 'val', 'test'):
+        filepaths, labels = manifest.list(os.path.join(path, name))
+        splits[name] = pd.DataFrame({'filepaths': filepaths, 'labels': labels})
+    return splits
+
+
+def teacher_probs(teacher, df, name, batch_size, use_cache=True):
+    # teacher class probabilities for df in row order
+    size = tuple(teacher.input_shape[1:3])
+    batches = ImageDataGenerator(preprocessing_function=scalar).flow_from_dataframe(
+        df, x_col='filepaths', y_col='labels', target_size=size, class_mode='categorical',
+        shuffle=False, batch_size=batch_size)
+    if not use_cache:
+        return np.concatenate([teacher.predict_on_batch(batches[i][0]) for i in range(len(batches))])
+    probs, _ = cached_features(teacher, batches, df['filepaths'], f'teacher-{name}', backbone_fingerprint(teacher))
+    return probs
+
+
+def with_targets(df, classes, probs):
+    # adds y0.. (one-hot labels) and t0.. (teacher probabilities) columns read with class_mode='raw'
+    df = df.copy()
+    onehot = np.eye(len(classes))[df['labels'].map({c: i for i, c in enumerate(classes)})]
+    for i in range(len(classes)):
+        df[f'y{i}'] = onehot[:, i]
+        df[f't{i}'] = probs[:, i]
+    return df
+
+
+def distillation_loss(class_count, temperature, alpha):
+    def loss(y_true, y_pred):
+        hard, soft = y_true[:, :class_count], y_true[:, class_count:]
+        y_pred = tf.clip_by_value(y_pred, 1e-7, 1.0)
+        ce = tf.keras.losses.categorical_crossentropy(hard, y_pred)
+        # softmax(log(p) / T) softens probabilities exactly like dividing the logits by T
+        soft_teacher = tf.nn.softmax(tf.math.log(tf.clip_by_value(soft, 1e-7, 1.0)) / temperature)
+        soft_student = tf.nn.softmax(tf.math.log(y_pred) / temperature)
+        kl = tf.keras.losses.kl_divergence(soft_teacher, soft_student)
+        return alpha * ce + (1 - alpha) * temperature ** 2 * kl
+    return loss
+
+
+def hard_accuracy(class_count):
+    def accuracy(y_true, y_pred):
+        return tf.keras.metrics.categorical_accuracy(y_true[:, :class_count], y_pred)
+    return accuracy
+
+
+def latency_ms(model, runs=50, input_shape=None):
+    # median single-image predict time, as gui.classify calls the model; input_shape (h, w, c) for
+    # models built without a fixed input size
+    x = np.random.RandomState(0).uniform(0, 1, (1,) + tuple(input_shape or model.input_shape[1:])).astype(np.float32)
+    model.predict_on_batch(x)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model.predict_on_batch(x)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000
+
+
+def distill(teacher_path, path=PATH, split_file=None, img_size=180, filters=(64, 32, 16, 8), temperature=4.0,
+            alpha=0.3, epochs=10, batch_size=8, use_cache=True, out='modelCNN-distilled.h5'):
+    splits = load_splits(path, split_file)
+    teacher = load_model(teacher_path)
+    classes = sorted(set(splits['train']['labels']))
+    class_count = len(classes)
+    y_cols = [f'y{i}' for i in range(class_count)] + [f't{i}' for i in range(class_count)]
+
+    train_df = with_targets(splits['train'], classes, teacher_probs(teacher, splits['train'], 'train', 32, use_cache))
+    valid_df = with_targets(splits['val'], classes, teacher_probs(teacher, splits['val'], 'val', 32, use_cache))
+
+    # the main.py augmentation
+    gen = ImageDataGenerator(rescale=1./255, shear_range=0.2, zoom_range=0.2, horizontal_flip=True,
+                             fill_mode='nearest', width_shift_range=0.1, height_shift_range=0.1)
+    flow = dict(x_col='filepaths', y_col=y_cols, target_size=(img_size, img_size), class_mode='raw',
+                batch_size=batch_size)
+    train_gen = gen.flow_from_dataframe(train_df, shuffle=True, **flow)
+    valid_gen = gen.flow_from_dataframe(valid_df, shuffle=False, **flow)
+
+    student = build_cnn(img_size, img_size, class_count, filters=filters, activation='softmax')
+    student.compile(optimizer=Adam(learning_rate=1e-3), loss=distillation_loss(class_count, temperature, alpha),
+                    metrics=[hard_accuracy(class_count)])
+    student.fit(train_gen, epochs=epochs, validation_data=valid_gen)
+    student.save(out, include_optimizer=False)  # loads without the custom loss
+    print(f'Student saved to {out}')
+
+    test_student = ImageDataGenerator(rescale=1./255).flow_from_dataframe(
+        splits['test'], x_col='filepaths', y_col='labels', target_size=(img_size, img_size),
+        class_mode='categorical', shuffle=False, batch_size=32)
+    test_teacher = ImageDataGenerator(preprocessing_function=scalar).flow_from_dataframe(
+        splits['test'], x_col='filepaths', y_col='labels', target_size=tuple(teacher.input_shape[1:3]),
+        class_mode='categorical', shuffle=False, batch_size=32)
+    results = []
+    for name, model, batches, model_path in (('student', student, test_student, out),
+                                             ('teacher', teacher, test_teacher, teacher_path)):
+        results.append({
+            'model': name, 'path': model_path,
+            'accuracy': evaluate_model(model, batches, classes)['accuracy'],
+            'params': int(model.count_params()),
+            'size_mb': os.path.getsize(model_path) / 2**20,
+            'latency_ms': latency_ms(model),
+        })
+
+    print(f'{"Model":<10s}{"acc %":>8s}{"params":>12s}{"MB":>8s}{"ms/img":>8s}')
+    for r in results:
+        print(f'{r["model"]:<10s}{r["accuracy"] * 100:>8.2f}{r["params"]:>12,d}{r["size_mb"]:>8.1f}{r["latency_ms"]:>8.1f}')
+    student_r, teacher_r = results
+    print(f'Student: {teacher_r["params"] / student_r["params"]:.0f}x fewer parameters, '
+          f'{teacher_r["latency_ms"] / student_r["latency_ms"]:.1f}x faster, '
+          f'{(student_r["accuracy"] - teacher_r["accuracy"]) * 100:+.2f} points accuracy')
+    report = {'temperature': temperature, 'alpha': alpha, 'filters': list(filters), 'results': results}
+    with open(os.path.splitext(out)[0] + '-report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distill the VGG19 teacher into the small CNN')
+    parser.add_argument('teacher', help='VGG19 .h5 model written by main1.py')
+    parser.add_argument('--data', default=PATH, help='dataset root with train/val/test folders')
+    parser.add_argument('--split-file', help='split manifest written by split.py, used instead of the folders')
+    parser.add_argument('--img-size', type=int, default=180)
+    parser.add_argument('--filters', default='64,32,16,8', help='Conv2D filters of the student, one layer each')
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.3, help='weight of the true-label loss')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--no-cache', action='store_true', help='rerun the teacher instead of using cached outputs')
+    parser.add_argument('--out', default='modelCNN-distilled.h5')
+    args = parser.parse_args()
+
+    distill(args.teacher, args.data, args.split_file, args.img_size, tuple(int(f) for f in args.filters.split(',')),
+            args.temperature, args.alpha, args.epochs, args.batch_size, not args.no_cache, args.out)
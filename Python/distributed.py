@@ -0,0 +1,230 @@
+'''
+Multi-worker data-parallel training for main1.py.
+
+Each worker process reads its role from TF_CONFIG, trains its own shard of the training files and
+averages gradients with the others through MultiWorkerMirroredStrategy. The shards are cut from the
+file lists before any loader is built, so the generator, pixel cache and tf.data loaders all work
+unchanged, and every shard has the same length so all workers run the same number of steps. Since
+the data is sharded already, unsharded() hands model.fit every loader as a tf.data dataset with
+auto-sharding off; keras would otherwise shard generator input again by batch. Each
+worker keeps batch_size images per step, the global batch is batch_size * workers and the learning
+rate is scaled linearly with it.
+
+The launcher starts N workers as local processes, which is how the mode is tested before it is
+spread over several machines (set TF_CONFIG by hand on each machine in that case). The chief
+worker prints to the console, the others log to worker-<i>.log. The ports are picked free just before
+the workers start, so another process can still grab one in between; a cluster whose worker fails to
+bind its port is relaunched on new ports.
+
+    python distributed.py launch --workers 4 main1.py
+    EPOCHS=3 python distributed.py scaling --workers 1 2 4 main1.py
+'''
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import ExitStack
+
+
+def tf_config():
+    return json.loads(os.environ.get('TF_CONFIG') or '{}')
+
+
+def num_workers():
+    cluster = tf_config().get('cluster', {})
+    return len(cluster.get('worker', [])) + len(cluster.get('chief', [])) or 1
+
+
+def worker_index():
+    # position of this process among all workers, the chief (if there is one) counts as 0
+    config = tf_config()
+    task = config.get('task', {})
+    if not task:
+        return 0
+    if task['type'] == 'chief':
+        return 0
+    return task['index'] + len(config['cluster'].get('chief', []))
+
+
+def is_chief():
+    return worker_index() == 0
+
+
+def make_strategy():
+    '''
+    MultiWorkerMirroredStrategy when TF_CONFIG describes a cluster, the default strategy otherwise.
+    Has to be called before TensorFlow runs any op.
+    '''
+    import tensorflow as tf
+    if num_workers() > 1:
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.get_strategy()
+
+
+def shard(df, workers=None, index=None):
+    # rows index, index + workers, ... of df, cut to the same length on every worker
+    workers = workers or num_workers()
+    index = worker_index() if index is None else index
+    if workers == 1:
+        return df
+    length = len(df) // workers
+    return df.iloc[index::workers].iloc[:length].reset_index(drop=True)
+
+
+def unsharded(batches):
+    '''
+    batches (a keras iterator/Sequence or a tf.data dataset) as a dataset the strategy does not
+    auto-shard, for data this worker has already sharded itself.
+    '''
+    import tensorflow as tf
+    if not isinstance(batches, tf.data.Dataset):
+        sequence = batches
+        x, y = sequence[0]
+        signature = (tf.TensorSpec((None,) + x.shape[1:], tf.as_dtype(x.dtype)),
+                     tf.TensorSpec((None,) + y.shape[1:], tf.as_dtype(y.dtype)))
+
+        def generate():
+            # one pass per epoch, keras restarts the dataset for the next one
+            for i in range(len(sequence)):
+                yield sequence[i]
+            sequence.on_epoch_end()
+
+        batches = tf.data.Dataset.from_generator(generate, output_signature=signature).prefetch(tf.data.AUTOTUNE)
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return batches.with_options(options)
+
+
+def free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+BIND_ERRORS = (b'Address already in use', b'Could not start gRPC server')
+LAUNCH_ATTEMPTS = 3
+
+
+def relay(stream, sink, clashes, index):
+    # copies a worker's output to the console or its log and notes when it could not bind its port
+    for line in iter(stream.readline, b''):
+        sink.write(line)
+        sink.flush()
+        if any(error in line for error in BIND_ERRORS):
+            clashes.add(index)
+    stream.close()
+
+
+def run_workers(script, workers, extra_env=None, log_dir='.'):
+    # one launch on fresh ports: (exit code of the first worker that failed or 0, whether a port was taken)
+    cluster = {'worker': [f'localhost:{port}' for port in free_ports(workers)]}
+    processes = []
+    relays = []
+    clashes = set()
+    with ExitStack() as logs:
+        for index in range(workers):
+            env = dict(os.environ, **(extra_env or {}), PYTHONUNBUFFERED='1')
+            if workers > 1:
+                env['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}})
+            if index == 0:
+                sink = sys.stdout.buffer
+            else:
+                sink = logs.enter_context(open(os.path.join(log_dir, f'worker-{index}.log'), 'wb'))
+            p = subprocess.Popen([sys.executable, script], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            thread = threading.Thread(target=relay, args=(p.stdout, sink, clashes, index), daemon=True)
+            thread.start()
+            processes.append(p)
+            relays.append(thread)
+        status = 0
+        try:
+            running = list(processes)
+            while running:
+                for p in list(running):
+                    code = p.poll()
+                    if code is None:
+                        continue
+                    running.remove(p)
+                    if code and not status:
+                        status = code
+                        for other in running:  # the rest would wait forever on the failed worker
+                            other.terminate()
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            for p in processes:
+                p.terminate()
+            raise
+        finally:
+            for thread in relays:  # the logs stay open until every worker's output is written
+                thread.join()
+    return status, bool(clashes)
+
+
+def launch(script, workers, extra_env=None, log_dir='.'):
+    '''
+    Runs script as workers local processes with a localhost TF_CONFIG and waits for all of them,
+    relaunching on new ports when another process took one of them first.
+    Returns the exit code of the first worker that failed, or 0.
+    '''
+    for attempt in range(1, LAUNCH_ATTEMPTS + 1):
+        status, clashed = run_workers(script, workers, extra_env, log_dir)
+        if not clashed or attempt == LAUNCH_ATTEMPTS:
+            return status
+        print(f'A worker could not bind its port, relaunching on new ports (attempt {attempt + 1} of {LAUNCH_ATTEMPTS})',
+              flush=True)
+
+
+def scaling(script, worker_counts, results_file, threads_per_worker=0):
+    '''
+    Trains with each worker count in turn and prints speedup and scaling efficiency against the
+    smallest count. Epoch times come from the run records the chief appends to results_file.
+    '''
+    rows = []
+    for workers in worker_counts:
+        extra_env = {'RESULTS_FILE': results_file}
+        if threads_per_worker:
+            extra_env.update(CPU_MODE='1', INTRA_THREADS=str(threads_per_worker))
+        print(f'Training with {workers} worker(s)...', flush=True)
+        status = launch(script, workers, extra_env)
+        if status:
+            print(f'{workers} worker run failed with exit code {status}')
+            continue
+        with open(results_file) as f:
+            record = json.loads(f.readlines()[-1])
+        rows.append((workers, record['seconds_per_epoch'], record['accuracy']))
+
+    if not rows:
+        return rows
+    base_workers, base_seconds, _ = rows[0]
+    print(f'{"Workers":>8s}{"s/epoch":>10s}{"Speedup":>10s}{"Efficiency":>12s}{"Accuracy":>10s}')
+    for workers, seconds, accuracy in rows:
+        speedup = base_seconds / seconds
+        efficiency = speedup * base_workers / workers
+        print(f'{workers:>8d}{seconds:>10.1f}{speedup:>9.2f}x{efficiency * 100:>11.1f}%{accuracy * 100:>9.2f}%')
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a training script on several local workers')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('launch', help='train once with N workers')
+    p.add_argument('script')
+    p.add_argument('--workers', type=int, default=2)
+    p = sub.add_parser('scaling', help='train with each worker count and report scaling efficiency')
+    p.add_argument('script')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    p.add_argument('--results', default='scaling_runs.jsonl')
+    p.add_argument('--threads-per-worker', type=int, default=0,
+                   help='intra-op threads per worker, so N local workers do not oversubscribe the cores')
+    args = parser.parse_args()
+
+    if args.command == 'launch':
+        sys.exit(launch(args.script, args.workers))
+    scaling(args.script, sorted(args.workers), args.results, args.threads_per_worker)
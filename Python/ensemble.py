@@ -0,0 +1,121 @@
+'''
+Ensemble of registry models (model.h5, modelGAN-C.h5, optionally the VGG19 model) over one decoded batch.
+
+Each image is decoded once. Members that share an input size share one resized, scaled batch, so
+only distinct input shapes cost an extra resize. The members then predict concurrently on a thread
+pool (TensorFlow releases the GIL inside predict), and their probabilities are combined:
+
+  mean      average of the member probabilities
+  weighted  weighted average, --weights in member order
+  vote      share of members voting for each class, ties broken by the mean probability
+
+so the ensemble takes about as long as its slowest member rather than the sum of all of them.
+
+    python ensemble.py tile1.jpeg tile2.jpeg --models model.h5 modelGAN-C.h5 --combine mean
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from inference import preprocess
+from prediction_cache import model_id
+from registry import ModelRegistry
+
+COMBINE_MODES = ('mean', 'weighted', 'vote')
+
+
+def decode(path):
+    with Image.open(path) as image:
+        image.load()
+        return image.convert('RGB') if image.mode != 'RGB' else image
+
+
+class Ensemble:
+    def __init__(self, registry, names, combine='mean', weights=None, workers=None):
+        if combine not in COMBINE_MODES:
+            raise ValueError(f'combine must be one of {", ".join(COMBINE_MODES)}')
+        self.registry = registry
+        self.names = [registry.resolve(n) for n in names]
+        self.combine_mode = combine
+        weights = np.ones(len(self.names)) if weights is None else np.asarray(weights, dtype=np.float64)
+        if len(weights) != len(self.names):
+            raise ValueError('one weight per member model')
+        self.weights = weights / weights.sum()
+        classes = [tuple(registry.info(n)['classes']) for n in self.names]
+        if len(set(classes)) != 1:
+            raise ValueError('the member models do not share the same classes')
+        self.classes = list(classes[0])
+        # the registry keeps every member loaded
+        registry.capacity = max(registry.capacity, len(self.names))
+        self.pool = ThreadPoolExecutor(max_workers=workers or max(len(self.names), os.cpu_count() or 1))
+        self.timings = {}  # last predict: seconds per member, plus 'preprocess' and 'total'
+
+    def identity(self):
+        # changes whenever a member file, the weights or the combine mode change
+        members = '|'.join(model_id(self.registry.info(n)) for n in self.names)
+        return f'ensemble:{self.combine_mode}:{self.weights.round(6).tolist()}:{members}'
+
+    def load(self):
+        for name in self.names:
+            self.registry.get(name)
+
+    def _member(self, name, batch):
+        start = time.perf_counter()
+        model, _ = self.registry.get(name)
+        probs = np.asarray(model.predict_on_batch(batch))
+        self.timings[name] = time.perf_counter() - start
+        return probs
+
+    def combine(self, probs):
+        # probs: (members, images, classes)
+        if self.combine_mode == 'vote':
+            votes = np.zeros(probs.shape[1:])
+            for member in probs:
+                votes[np.arange(len(member)), member.argmax(axis=1)] += 1
+            votes /= len(probs)
+            return votes + probs.mean(axis=0) * 1e-6  # the tie-breaker never outweighs a vote
+        weights = self.weights if self.combine_mode == 'weighted' else np.full(len(probs), 1 / len(probs))
+        return np.tensordot(weights, probs, axes=1)
+
+    def predict_images(self, images):
+        '''
+        Returns (combined probabilities, per-member probabilities) for a list of decoded PIL images.
+        '''
+        start = time.perf_counter()
+        sizes = {name: self.registry.input_size(name) for name in self.names}
+        batches = {size: np.stack(list(self.pool.map(lambda im: preprocess(im, size), images)))
+                   for size in set(sizes.values())}
+        self.timings = {'preprocess': time.perf_counter() - start}
+        futures = [self.pool.submit(self._member, name, batches[sizes[name]]) for name in self.names]
+        members = np.stack([f.result() for f in futures])
+        self.timings['total'] = time.perf_counter() - start
+        return self.combine(members), members
+
+    def predict_files(self, paths):
+        return self.predict_images(list(self.pool.map(decode, paths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify images with an ensemble of models')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--models', nargs='+', default=['model.h5', 'modelGAN-C.h5'], help='registry names or paths')
+    parser.add_argument('--combine', choices=COMBINE_MODES, default='mean')
+    parser.add_argument('--weights', type=float, nargs='+')
+    args = parser.parse_args()
+
+    registry = ModelRegistry()
+    registry.discover()
+    ensemble = Ensemble(registry, args.models, args.combine, args.weights)
+    ensemble.load()
+    probs, _ = ensemble.predict_files(args.images)
+    for path, p in zip(args.images, probs):
+        print(f'{os.path.basename(path)}: {ensemble.classes[int(np.argmax(p))]} '
+              + ' '.join(f'{c}={v:.3f}' for c, v in zip(ensemble.classes, p)))
+    members = {n: ensemble.timings[n] * 1000 for n in ensemble.names}
+    print(f'Ensemble {ensemble.timings["total"] * 1000:.0f} ms (preprocess {ensemble.timings["preprocess"] * 1000:.0f} ms), '
+          + ', '.join(f'{n} {ms:.0f} ms' for n, ms in members.items())
+          + f', sum of members {sum(members.values()):.0f} ms')
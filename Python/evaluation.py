@@ -0,0 +1,157 @@
+'''
+Streaming evaluation of a classifier on the test set.
+
+Predictions are consumed batch by batch and folded into running NumPy accumulators: the confusion
+matrix, calibration bins, log loss and a bounded heap of the most confident mistakes. Memory does
+not grow with the size of the test set. Labels are taken from the same batches as the predictions
+and file names from the iterator's index array, so everything stays aligned even if the iterator
+shuffles.
+
+The report is written as JSON plus CSV tables instead of being plotted.
+'''
+import csv
+import heapq
+import json
+import os
+
+import numpy as np
+
+
+class StreamingEvaluator:
+    def __init__(self, class_names, top_k=25, bins=10):
+        self.class_names = list(class_names)
+        n = len(self.class_names)
+        self.confusion = np.zeros((n, n), dtype=np.int64)
+        self.bins = bins
+        self.bin_count = np.zeros(bins, dtype=np.int64)
+        self.bin_confidence = np.zeros(bins)
+        self.bin_correct = np.zeros(bins)
+        self.log_loss = 0.0
+        self.top_k = top_k
+        self.mistakes = []  # min-heap of (confidence, sequence, filename, true, predicted)
+        self.seen = 0
+
+    def update(self, probs, labels, filenames=None):
+        probs = np.asarray(probs, dtype=np.float64)
+        labels = np.asarray(labels)
+        if labels.ndim == 2:  # one-hot batches from the keras iterators
+            labels = labels.argmax(axis=1)
+        labels = labels.astype(np.int64)
+        pred = probs.argmax(axis=1)
+        confidence = probs[np.arange(len(pred)), pred]
+        np.add.at(self.confusion, (labels, pred), 1)
+
+        correct = pred == labels
+        bin_index = np.minimum((confidence * self.bins).astype(np.int64), self.bins - 1)
+        self.bin_count += np.bincount(bin_index, minlength=self.bins)
+        self.bin_confidence += np.bincount(bin_index, weights=confidence, minlength=self.bins)
+        self.bin_correct += np.bincount(bin_index, weights=correct, minlength=self.bins)
+        self.log_loss -= np.log(np.clip(probs[np.arange(len(labels)), labels], 1e-12, 1.0)).sum()
+
+        for i in np.flatnonzero(~correct):
+            item = (float(confidence[i]), self.seen + int(i),
+                    filenames[i] if filenames is not None else None, int(labels[i]), int(pred[i]))
+            if len(self.mistakes) < self.top_k:
+                heapq.heappush(self.mistakes, item)
+            elif item[0] > self.mistakes[0][0]:
+                heapq.heapreplace(self.mistakes, item)
+        self.seen += len(labels)
+
+    def report(self):
+        cm = self.confusion
+        total = cm.sum()
+        tp = np.diag(cm).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.nan_to_num(tp / cm.sum(axis=0))
+            recall = np.nan_to_num(tp / cm.sum(axis=1))
+            f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+            bin_acc = np.nan_to_num(self.bin_correct / self.bin_count)
+            bin_conf = np.nan_to_num(self.bin_confidence / self.bin_count)
+        ece = float(np.sum(self.bin_count * np.abs(bin_acc - bin_conf)) / total) if total else 0.0
+        return {
+            'samples': int(total),
+            'accuracy': float(tp.sum() / total) if total else 0.0,
+            'log_loss': self.log_loss / total if total else 0.0,
+            'classes': self.class_names,
+            'confusion_matrix': cm.tolist(),
+            'per_class': [
+                {'class': c, 'precision': float(p), 'recall': float(r), 'f1': float(f), 'support': int(s)}
+                for c, p, r, f, s in zip(self.class_names, precision, recall, f1, cm.sum(axis=1))
+            ],
+            'calibration': {
+                'ece': ece,
+                'bins': [
+                    {'low': i / self.bins, 'high': (i + 1) / self.bins, 'count': int(n),
+                     'accuracy': float(a), 'confidence': float(c)}
+                    for i, (n, a, c) in enumerate(zip(self.bin_count, bin_acc, bin_conf))
+                ],
+            },
+            'top_misclassified': [
+                {'file': f, 'true': self.class_names[t], 'predicted': self.class_names[p], 'confidence': conf}
+                for conf, _, f, t, p in sorted(self.mistakes, reverse=True)
+            ],
+        }
+
+
+def batch_filenames(batches, idx, n):
+    # file names of the n images in batch idx, through the index array when the iterator shuffles
+    filenames = getattr(batches, 'filenames', None)
+    if filenames is None:
+        return None
+    start = idx * batches.batch_size
+    index_array = getattr(batches, 'index_array', None)
+    if index_array is None:
+        index_array = range(len(filenames))
+    return [filenames[i] for i in index_array[start:start + n]]
+
+
+def evaluate_model(model, batches, class_names, top_k=25, bins=10):
+    '''
+    Runs model over one pass of batches (a keras iterator/Sequence or a tf.data dataset) and returns the report.
+    '''
+    evaluator = StreamingEvaluator(class_names, top_k=top_k, bins=bins)
+    if hasattr(batches, '__getitem__') and hasattr(batches, '__len__'):
+        for idx in range(len(batches)):
+            x, y = batches[idx]
+            # index_array is only filled in once the first batch has been drawn, so look names up afterwards
+            evaluator.update(model.predict_on_batch(x), y, batch_filenames(batches, idx, len(y)))
+    else:  # tf.data datasets cannot be indexed, they are read in order (build them with shuffle=False)
+        filenames = getattr(batches, 'filenames', None)
+        position = 0
+        for x, y in batches:
+            n = len(y)
+            evaluator.update(model.predict_on_batch(x), y.numpy(),
+                             filenames[position:position + n] if filenames is not None else None)
+            position += n
+    return evaluator.report()
+
+
+def write_report(report, save_dir, prefix):
+    '''
+    Writes <prefix>-report.json and CSV tables for the confusion matrix, per-class metrics and
+    misclassified files, and prints a short summary.
+    '''
+    os.makedirs(save_dir, exist_ok=True)
+    path = os.path.join(save_dir, prefix)
+    with open(path + '-report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(path + '-confusion.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['actual \\ predicted'] + report['classes'])
+        for name, row in zip(report['classes'], report['confusion_matrix']):
+            writer.writerow([name] + row)
+    with open(path + '-per-class.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['class', 'precision', 'recall', 'f1', 'support'])
+        writer.writeheader()
+        writer.writerows(report['per_class'])
+    with open(path + '-misclassified.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['file', 'true', 'predicted', 'confidence'])
+        writer.writeheader()
+        writer.writerows(report['top_misclassified'])
+
+    print(f'Test accuracy {report["accuracy"] * 100:.2f} % on {report["samples"]} images, '
+          f'log loss {report["log_loss"]:.4f}, ECE {report["calibration"]["ece"]:.4f}')
+    print(f'{"Class":<30s}{"Precision":>10s}{"Recall":>10s}{"F1":>10s}{"Support":>10s}')
+    for row in report['per_class']:
+        print(f'{row["class"]:<30s}{row["precision"]:>10.4f}{row["recall"]:>10.4f}{row["f1"]:>10.4f}{row["support"]:>10d}')
+    print(f'Report written to {path}-report.json')
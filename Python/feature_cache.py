@@ -0,0 +1,78 @@
+'''
+Frozen-backbone feature cache for head-only training in main1.py.
+
+With the VGG19 base frozen its pooled 512-d output never changes, so it is computed once per split
+(optionally for a fixed number of augmented views) and stored as float16 on disk. The BatchNorm/Dense
+head is then trained on the cached features, which takes seconds instead of hours on CPU.
+
+A cache file is keyed by a hash of the backbone weights, the input size and the file list, so
+changing the weights, IMG_H/IMG_W or the split never picks up stale features.
+'''
+import hashlib
+import os
+
+import numpy as np
+from tensorflow import keras
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'feature_cache')
+
+
+def backbone_fingerprint(base_model):
+    digest = hashlib.sha1(str(base_model.input_shape).encode())
+    for w in base_model.weights:
+        digest.update(w.name.encode())
+        digest.update(np.ascontiguousarray(w.numpy()).tobytes())
+    return digest.hexdigest()
+
+
+def cache_path(fingerprint, filepaths, name, cache_dir=CACHE_DIR):
+    digest = hashlib.sha1(fingerprint.encode())
+    for path in filepaths:
+        digest.update(str(path).encode())
+    return os.path.join(cache_dir, f'{name}-{digest.hexdigest()[:16]}.npz')
+
+
+def iter_batches(batches):
+    # one pass over every image: keras iterators and Sequences by index, tf.data datasets by iteration
+    if hasattr(batches, '__getitem__') and hasattr(batches, '__len__'):
+        for i in range(len(batches)):
+            yield batches[i]
+    else:
+        yield from batches
+
+
+def cached_features(base_model, batches, filepaths, name, fingerprint=None, cache_dir=CACHE_DIR):
+    '''
+    Returns (features, labels) for one pass over `batches`, from disk if this backbone has
+    already seen exactly these files. Labels are class indices.
+    '''
+    fingerprint = fingerprint or backbone_fingerprint(base_model)
+    path = cache_path(fingerprint, filepaths, name, cache_dir)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return data['features'].astype(np.float32), data['labels']
+
+    features = []
+    labels = []
+    for x, y in iter_batches(batches):
+        features.append(np.asarray(base_model.predict_on_batch(x), dtype=np.float16))
+        labels.append(np.argmax(y, axis=1).astype(np.int16))
+    features = np.concatenate(features)
+    labels = np.concatenate(labels)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, features=features, labels=labels)
+    os.replace(tmp, path)
+    return features.astype(np.float32), labels
+
+
+def build_head(model, base_model):
+    '''
+    Returns a model that runs the head layers of `model` (everything after `base_model`) on
+    pooled features. The layers are shared, so training the head also trains `model`.
+    '''
+    inputs = keras.Input(shape=base_model.output_shape[1:])
+    x = inputs
+    for layer in model.layers[len(base_model.layers):]:
+        x = layer(x)
+    return keras.Model(inputs=inputs, outputs=x)
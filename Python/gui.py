@@ -1,3 +1,10 @@
+import time
+start_time = time.perf_counter()
+
+import io
+import os
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import *
@@ -5,15 +12,25 @@ from PIL import ImageTk, Image
 
 import numpy as np
 
-from keras.models import load_model
-# model = load_model('modelGAN-C.h5')
-model = load_model('/home/andrei/Desktop/ProiectLicenta/Python/VGG19-fruits-99.00.h5')
-
-classes = {
-    0: 'Lung adenocarcinoma',
-    1: 'Lung squamous cell carcinoma',
-    2: 'Lung benign tissue'
-}
+from inference import DEFAULT_MODEL, classes, load_image_bytes
+from ensemble import Ensemble
+from prediction_cache import PredictionCache, content_hash, model_id
+from registry import ModelRegistry
+from settings import env
+
+MODEL_PATH = env('MODEL_PATH', DEFAULT_MODEL)  # model selected at start, a registry name or a .h5/.tflite path
+ENSEMBLE = env('ENSEMBLE', '')  # e.g. model.h5,modelGAN-C.h5: classify with the mean of these models instead
+PREDICTION_CACHE = env('PREDICTION_CACHE', True)  # reuse earlier predictions for identical image files
+
+# models are discovered and loaded by the worker thread so the window can paint right away,
+# classification and model switch requests go through `requests` and come back through `results`
+registry = ModelRegistry(log=lambda msg: results.put(('log', msg)))
+model = None
+ensemble = None
+cache = PredictionCache() if PREDICTION_CACHE else None
+first_paint_time = None
+requests = queue.Queue()
+results = queue.Queue()
 
 print(classes)
 
@@ -24,58 +41,181 @@ top.geometry('900x800')
 top.title('Detectarea celuleor anormale la nivelul plamanilor')
 top.configure(background='#CDCDCD')
 label = Label(top, background='#CDCDCD', font=('arial', 15, 'bold'))
+status = Label(top, background='#CDCDCD', foreground='#364156', font=('arial', 10))
 sign_image = Label(top)
+model_choice = StringVar(top)
+model_menu = OptionMenu(top, model_choice, '')
 
 
 def classify(file_path):
-    global label_packed
-    image = Image.open(file_path)
-    image = image.resize((224, 224))
-    image = np.expand_dims(image, axis=0)
-    image = np.array(image)
-    image = image/255.0
-    pred = model.predict([image])
-    print(pred[0][0])
-    print(pred[0])
+    # runs on the worker thread, returns the class probabilities by name
+    global ensemble
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    if ENSEMBLE:
+        if ensemble is None:
+            ensemble = Ensemble(registry, ENSEMBLE.split(','))
+        names, identity = ensemble.classes, ensemble.identity()
+    else:
+        model, info = registry.get()
+        names, identity = info['classes'], model_id(info)
+    # a tile that was classified before by the same model is answered without decoding or predicting
+    key = cache.key(content_hash(data), identity) if cache else None
+    probs = cache.get(key) if cache else None
+    if probs is None:
+        predict_start = time.perf_counter()
+        if ENSEMBLE:
+            with Image.open(io.BytesIO(data)) as image:
+                probs = ensemble.predict_images([image.convert('RGB')])[0][0]
+        else:
+            image = np.expand_dims(load_image_bytes(data, registry.input_size()), axis=0)
+            probs = model.predict([image])[0]
+        if cache:
+            cache.put(key, probs, (time.perf_counter() - predict_start) * 1000)
+    print(probs)
+
+    dictionary = dict(zip(names, probs))
 
-    lung_cancer_type = ['Lung aca', 'Lung scc', 'Lung n']
+    print(dictionary)
+    return dictionary
 
-    dictionary = dict(zip(lung_cancer_type, pred[0]))
 
-    print(dictionary)
+def switch_model(name):
+    global model
+    load_start = time.perf_counter()
+    model, info = registry.get(registry.set_active(name))
+    results.put(('loaded', info['name'], time.perf_counter() - load_start))
+
+
+def load_ensemble():
+    global ensemble, model
+    load_start = time.perf_counter()
+    ensemble = Ensemble(registry, ENSEMBLE.split(','))
+    ensemble.load()
+    model = ensemble  # queued images no longer wait for a model
+    results.put(('loaded', f'ensemble of {len(ensemble.names)}', time.perf_counter() - load_start))
+
+
+def worker():
+    registry.discover()
+    results.put(('models', registry.names(), registry.active))
+    try:
+        # with ENSEMBLE only its members are loaded, MODEL_PATH would never be used
+        if ENSEMBLE:
+            load_ensemble()
+        else:
+            switch_model(MODEL_PATH if os.path.exists(MODEL_PATH) or MODEL_PATH in registry.names() else registry.active)
+    except Exception as e:
+        results.put(('load_error', e))
+    while True:
+        request = requests.get()
+        if request[0] == 'switch':
+            # hot-swap: later requests use the new model, models already loaded stay in the LRU
+            try:
+                switch_model(request[1])
+            except Exception as e:
+                results.put(('load_error', e))
+            continue
+        _, file_path, queued_at = request
+        try:
+            dictionary = classify(file_path)
+            results.put(('result', file_path, dictionary, time.perf_counter() - queued_at))
+        except Exception as e:
+            results.put(('error', file_path, e, time.perf_counter() - queued_at))
+
+
+def poll_results():
+    # Tk widgets may only be touched from the main thread, so results are picked up here
+    try:
+        while True:
+            message = results.get_nowait()
+            kind = message[0]
+            if kind == 'log':
+                print(message[1])
+            elif kind == 'models':
+                _, names, active = message
+                menu = model_menu['menu']
+                menu.delete(0, 'end')
+                for name in names:
+                    menu.add_command(label=name, command=lambda n=name: select_model(n))
+                model_choice.set(active or '')
+            elif kind == 'loaded':
+                _, name, seconds = message
+                model_choice.set(name)
+                status.configure(text=f'Window ready in {first_paint_time or 0:.2f} s, {name} ready in {seconds:.2f} s')
+            elif kind == 'load_error':
+                status.configure(text=f'Could not load the model: {message[1]}')
+            elif kind == 'result':
+                _, file_path, dictionary, latency = message
+                max_key = max(dictionary, key=dictionary.get)
+                label.configure(text=f'{max_key} detected')
+                status.configure(text=f'{os.path.basename(file_path)} classified in {latency * 1000:.0f} ms'
+                                      f' ({requests.qsize()} queued' + (f', {cache.summary()})' if cache else ')'))
+            elif kind == 'error':
+                _, file_path, error, latency = message
+                status.configure(text=f'Could not classify {os.path.basename(file_path)}: {error}')
+    except queue.Empty:
+        pass
+    top.after(50, poll_results)
+
+
+def select_model(name):
+    model_choice.set(name)
+    status.configure(text=f'Switching to {name}...')
+    requests.put(('switch', name))
+
 
-    max_key = max(dictionary, key=dictionary.get)
-    label.configure(text=f'{max_key} detected')
-     
+def queue_classification(file_paths):
+    for file_path in file_paths:
+        requests.put(('classify', file_path, time.perf_counter()))
+    if model is None:
+        status.configure(text=f'Loading model... {requests.qsize()} image(s) queued')
+    else:
+        status.configure(text=f'Classifying... {requests.qsize()} image(s) queued')
 
-def show_classify_button(file_path):
-    classify_b = Button(top, text="Classify Image", command=lambda: classify(file_path), padx=10, pady=5)
+
+def show_classify_button(file_paths):
+    classify_b = Button(top, text="Classify Image", command=lambda: queue_classification(file_paths), padx=10, pady=5)
     classify_b.configure(background='#364156', foreground='white', font=('arial', 10, 'bold'))
     classify_b.place(relx=0.79, rely=0.46)
 
 
 def upload_image():
     try:
-        file_path = filedialog.askopenfilename()
-        uploaded = Image.open(file_path)
+        file_paths = filedialog.askopenfilenames()
+        if not file_paths:
+            return
+        uploaded = Image.open(file_paths[-1])
         uploaded.thumbnail(((top.winfo_width()/2.25), (top.winfo_height()/2.25)))
         im = ImageTk.PhotoImage(uploaded)
         sign_image.configure(image=im)
         sign_image.image=im
         label.configure(text='')
-        show_classify_button(file_path)
+        show_classify_button(list(file_paths))
     except:
         pass
 
 
+def first_paint():
+    global first_paint_time
+    first_paint_time = time.perf_counter() - start_time
+    if model is None:
+        status.configure(text=f'Window ready in {first_paint_time:.2f} s, loading model...')
+
+
 if __name__ == '__main__':
     upload = Button(top, text="Upload an image", command=upload_image, padx=10,  pady=5)
     upload.configure(background='#364156', foreground='white', font=('arial', 10, 'bold'))
+    status.pack(side=BOTTOM, pady=5)
+    model_menu.configure(background='#CDCDCD', font=('arial', 10))
+    model_menu.pack(side=BOTTOM)
     upload.pack(side=BOTTOM, pady=50)
     sign_image.pack(side=BOTTOM, expand=True)
     label.pack(side=BOTTOM, expand=True)
     heading = Label(top, text="Detectarea celuleor anormale la nivelul plamanilor",pady=20, font=('arial', 20, 'bold'))
     heading.configure(background='#CDCDCD', foreground='#364156')
     heading.pack()
+    threading.Thread(target=worker, daemon=True).start()
+    top.after_idle(first_paint)
+    top.after(50, poll_results)
     top.mainloop()
-
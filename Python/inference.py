@@ -0,0 +1,93 @@
+'''
+Preprocessing and class names shared by the GUI and the headless inference tools.
+'''
+import io
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_MODEL = '/home/andrei/Desktop/ProiectLicenta/Python/VGG19-fruits-99.00.h5'
+IMG_SIZE = (224, 224)
+PREPROCESS_VERSION = 1  # bump when preprocess changes, cached predictions are keyed by it
+
+classes = {
+    0: 'Lung adenocarcinoma',
+    1: 'Lung squamous cell carcinoma',
+    2: 'Lung benign tissue'
+}
+
+lung_cancer_type = ['Lung aca', 'Lung scc', 'Lung n']
+
+
+def preprocess(image, size=IMG_SIZE):
+    # resize to the model input and scale pixels between 0 and 1, as classify has always done
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image = image.resize(size)
+    return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def load_image(file_path, size=IMG_SIZE):
+    with Image.open(file_path) as image:
+        return preprocess(image, size)
+
+
+def load_image_bytes(data, size=IMG_SIZE):
+    # for callers that already read the file, e.g. to hash it
+    with Image.open(io.BytesIO(data)) as image:
+        return preprocess(image, size)
+
+
+class TFLiteModel:
+    '''
+    Wraps a .tflite file so it can be used wherever a keras model's predict/predict_on_batch is.
+    int8 models get their inputs quantized and outputs dequantized with the tensor's scale and zero point.
+    '''
+    def __init__(self, path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.path = path
+        self.interpreter = Interpreter(model_path=path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.input_shape = (None,) + tuple(int(d) for d in self.input['shape'][1:])
+        self.batch_size = int(self.input['shape'][0])
+
+    def _resize(self, batch_size):
+        if batch_size != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input['index'], (batch_size,) + self.input_shape[1:])
+            self.interpreter.allocate_tensors()
+            self.input = self.interpreter.get_input_details()[0]
+            self.output = self.interpreter.get_output_details()[0]
+            self.batch_size = batch_size
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        self._resize(len(x))
+        scale, zero_point = self.input['quantization']
+        if self.input['dtype'] != np.float32:
+            info = np.iinfo(self.input['dtype'])
+            x = np.clip(np.round(x / scale + zero_point), info.min, info.max)
+        self.interpreter.set_tensor(self.input['index'], x.astype(self.input['dtype']))
+        self.interpreter.invoke()
+        y = self.interpreter.get_tensor(self.output['index'])
+        scale, zero_point = self.output['quantization']
+        if self.output['dtype'] != np.float32:
+            y = (y.astype(np.float32) - zero_point) * scale
+        return y
+
+    def predict(self, x, batch_size=32, verbose=0):
+        if isinstance(x, (list, tuple)):
+            x = x[0]
+        return np.concatenate([self.predict_on_batch(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+
+def load_inference_model(path):
+    # .tflite files (e.g. the float16/int8 exports from quantize.py) or keras .h5 models
+    if path.endswith('.tflite'):
+        return TFLiteModel(path)
+    from keras.models import load_model
+    return load_model(path)
@@ -0,0 +1,79 @@
+'''
+Load generator for serve.py.
+
+Posts images to a running server from several client threads and reports client-side
+throughput and latency percentiles next to the server's own /stats.
+
+    python loadgen.py tile1.jpg tile2.jpg --concurrency 16 --requests 2000
+'''
+import argparse
+import json
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+
+def post(url, data):
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/octet-stream'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run(url, images, concurrency, total):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        nonlocal errors
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                post(url + '/predict', images[i % len(images)])
+            except Exception:
+                with lock:
+                    errors += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': total,
+        'errors': errors,
+        'concurrency': concurrency,
+        'throughput_rps': len(latencies) / elapsed,
+        'latency_ms': {f'p{q}': float(np.percentile(latencies, q)) for q in (50, 95, 99)} if len(latencies) else {},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send concurrent prediction requests to serve.py')
+    parser.add_argument('images', nargs='+', help='image files to upload, used round-robin')
+    parser.add_argument('--url', default='http://127.0.0.1:8500')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    payloads = []
+    for path in args.images:
+        with open(path, 'rb') as f:
+            payloads.append(f.read())
+    client = run(args.url, payloads, args.concurrency, args.requests)
+    with urllib.request.urlopen(args.url + '/stats') as response:
+        server = json.loads(response.read())
+    print(json.dumps({'client': client, 'server': server}, indent=2))
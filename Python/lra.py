@@ -0,0 +1,261 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+
+def print_in_color(txt_msg,fore_tupple,back_tupple,):
+    #prints the text_msg in the foreground color specified by fore_tupple with the background specified by back_tupple
+    #text_msg is the text, fore_tupple is foregroud color tupple (r,g,b), back_tupple is background tupple (r,g,b)
+    rf,gf,bf=fore_tupple
+    rb,gb,bb=back_tupple
+    msg='{0}' + txt_msg
+    mat='\33[38;2;' + str(rf) +';' + str(gf) + ';' + str(bf) + ';48;2;' + str(rb) + ';' +str(gb) + ';' + str(bb) +'m'
+    print(msg .format(mat), flush=True)
+    print('\33[0m', flush=True) # returns default print color to back to black
+    return
+
+
+class CheckpointWriter:
+    '''
+    Writes weight snapshots and the LRA state to checkpoint_dir on a background thread.
+    Snapshots are tf.Variables, so the training thread only pays for a variable-to-variable copy;
+    the conversion to numpy and the file write happen here while the next epoch runs.
+    '''
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir=checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.lock=threading.Lock() # held while a snapshot is being read, so it is not overwritten half way
+        self.jobs=queue.Queue()
+        self.thread=threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def path(self, name):
+        return os.path.join(self.checkpoint_dir, name)
+
+    def submit(self, name, variables, state=None):
+        self.jobs.put((name, variables, state))
+
+    def _run(self):
+        while True:
+            name, variables, state=self.jobs.get()
+            try:
+                with self.lock:
+                    arrays={f'w{i}': v.numpy() for i, v in enumerate(variables)}
+                tmp=self.path(name + '.tmp.npz')
+                np.savez(tmp, **arrays)
+                os.replace(tmp, self.path(name + '.npz'))
+                if state is not None: # written after the weights so state.json never points at missing weights
+                    tmp=self.path('state.json.tmp')
+                    with open(tmp, 'w') as f:
+                        json.dump(state, f)
+                    os.replace(tmp, self.path('state.json'))
+            except Exception as e:
+                print(f'checkpoint {name} failed: {e}', flush=True)
+            finally:
+                self.jobs.task_done()
+
+    def flush(self):
+        self.jobs.join()
+
+
+def load_weights_npz(path):
+    with np.load(path) as data:
+        return [data[f'w{i}'] for i in range(len(data.files))]
+
+
+class LRA(keras.callbacks.Callback):
+    reset=False
+    count=0
+    stop_count=0
+    tepochs=0
+    def __init__(self,model, patience,stop_patience, threshold, factor, dwell, model_name, freeze, initial_epoch,
+                 checkpoint_dir=None, resume=False, is_chief=True):
+        super(LRA, self).__init__()
+        self.model=model
+        self.patience=patience # specifies how many epochs without improvement before learning rate is adjusted
+        self.stop_patience=stop_patience
+        self.threshold=threshold # specifies training accuracy threshold when lr will be adjusted based on validation loss
+        self.factor=factor # factor by which to reduce the learning rate
+        self.dwell=dwell
+        self.lr=float(tf.keras.backend.get_value(model.optimizer.lr)) # get the initiallearning rate and save it in self.lr
+        self.highest_tracc=0.0 # set highest training accuracy to 0
+        self.lowest_vloss=np.inf # set lowest validation loss to infinity
+        #self.count=0 # initialize counter that counts epochs with no improvement
+        #self.stop_count=0 # initialize counter that counts how manytimes lr has been adjustd with no improvement
+        self.initial_epoch=initial_epoch
+        #self.epochs=epochs
+        # the best weights are kept in non-trainable variables next to the model's own, so saving them on
+        # every improvement is a device-side copy instead of a get_weights() round trip through numpy
+        self.best_weights=[tf.Variable(w, trainable=False) for w in self.model.weights]
+        self.snapshot_time=0.0 # seconds spent snapshotting weights in the current epoch
+        # in multi-worker training every worker runs the same schedule on the same all-reduced logs, so
+        # they change the lr, restore weights and stop on the same epoch; only the chief prints and writes
+        self.is_chief=is_chief
+        self.checkpoint_dir=checkpoint_dir
+        self.writer=None
+        if checkpoint_dir and is_chief:
+            self.writer=CheckpointWriter(checkpoint_dir)
+            self.latest_weights=[tf.Variable(w, trainable=False) for w in self.model.weights]
+        if checkpoint_dir and resume:
+            self.restore()
+        msg=' '
+        if freeze==True:
+            msgs=f' Starting training using  base model { model_name} with weights frozen to imagenet weights initializing LRA callback'
+        else:
+            msgs=f' Starting training using base model { model_name} training all layers '
+        self.print(msgs, (244, 252, 3), (55,65,80))
+
+    def print(self, msg, fore_tupple, back_tupple):
+        if self.is_chief:
+            print_in_color(msg, fore_tupple, back_tupple)
+
+    def snapshot(self, targets):
+        start=time.perf_counter()
+        lock=self.writer.lock if self.writer else None
+        if lock:
+            lock.acquire()
+        try:
+            for target, w in zip(targets, self.model.weights):
+                target.assign(w)
+        finally:
+            if lock:
+                lock.release()
+        self.snapshot_time += time.perf_counter() - start
+
+    def restore_best(self):
+        for w, best in zip(self.model.weights, self.best_weights):
+            w.assign(best)
+
+    def get_best_weights(self):
+        return [w.numpy() for w in self.best_weights]
+
+    def state(self, epoch):
+        return {'epoch': epoch, 'lr': self.lr, 'count': self.count, 'stop_count': self.stop_count,
+                'highest_tracc': self.highest_tracc, 'lowest_vloss': float(self.lowest_vloss)}
+
+    def restore(self):
+        # resumes from checkpoint_dir: latest weights, best weights, lr and the patience counters.
+        # pass the returned epoch (also kept in self.initial_epoch) as initial_epoch to model.fit
+        path=lambda name: os.path.join(self.checkpoint_dir, name)
+        state_path=path('state.json')
+        if not os.path.exists(state_path):
+            return self.initial_epoch
+        with open(state_path) as f:
+            state=json.load(f)
+        self.model.set_weights(load_weights_npz(path('latest.npz')))
+        if os.path.exists(path('best.npz')):
+            for v, w in zip(self.best_weights, load_weights_npz(path('best.npz'))):
+                v.assign(w)
+        self.lr=state['lr']
+        tf.keras.backend.set_value(self.model.optimizer.lr, self.lr)
+        self.count=state['count']
+        self.stop_count=state['stop_count']
+        self.highest_tracc=state['highest_tracc']
+        self.lowest_vloss=state['lowest_vloss']
+        self.initial_epoch=state['epoch'] + 1
+        msg=f' resuming from {self.checkpoint_dir} at epoch {self.initial_epoch + 1} with lr {self.lr:.5f}'
+        self.print(msg, (244, 252, 3), (55,65,80))
+        return self.initial_epoch
+
+    def new_phase(self, size):
+        # progressive resizing switched the image size: metrics at the new size are not comparable
+        # with the last phase's, so the monitor and patience counters start over
+        self.highest_tracc=0.0
+        self.lowest_vloss=np.inf
+        self.count=0
+        self.stop_count=0
+        LRA.reset=True # print the table header again
+        self.print(f' switching to {size[0]}x{size[1]} images', (244, 252, 3), (55,65,80))
+
+    def on_epoch_begin(self,epoch, logs=None):
+        self.now= time.time()
+        self.snapshot_time=0.0
+
+    def on_epoch_end(self, epoch, logs=None):  # method runs on the end of each epoch
+        later=time.time()
+        duration=later-self.now
+        if epoch== self.initial_epoch or LRA.reset==True:
+            LRA.reset=False
+            msg='{0:^8s}{1:^10s}{2:^9s}{3:^9s}{4:^9s}{5:^9s}{6:^9s}{7:^11s}{8:^8s}{9:^9s}'.format('Epoch', 'Loss', 'Accuracy','V_loss','V_acc', 'LR', 'Next LR', 'Monitor', 'Duration', 'Snap ms')
+            self.print(msg, (244,252,3), (55,65,80))
+
+        lr=float(tf.keras.backend.get_value(self.model.optimizer.lr)) # get the current learning rate
+        current_lr=lr
+        v_loss=logs.get('val_loss')  # get the validation loss for this epoch
+        acc=logs.get('accuracy')  # get training accuracy
+        v_acc=logs.get('val_accuracy')
+        loss=logs.get('loss')
+        improved=False
+        #print ( '\n',v_loss, self.lowest_vloss, acc, self.highest_tracc)
+        if acc < self.threshold: # if training accuracy is below threshold adjust lr based on training accuracy
+            monitor='accuracy'
+            if acc>self.highest_tracc: # training accuracy improved in the epoch
+                self.highest_tracc=acc # set new highest training accuracy
+                self.snapshot(self.best_weights) # traing accuracy improved so save the weights
+                improved=True
+                self.count=0 # set count to 0 since training accuracy improved
+                self.stop_count=0 # set stop counter to 0
+                if v_loss<self.lowest_vloss:
+                    self.lowest_vloss=v_loss
+                color= (0,255,0)
+                self.lr=lr
+            else:
+                # training accuracy did not improve check if this has happened for patience number of epochs
+                # if so adjust learning rate
+                if self.count>=self.patience -1:
+                    color=(245, 170, 66)
+                    self.lr= lr* self.factor # adjust the learning by factor
+                    tf.keras.backend.set_value(self.model.optimizer.lr, self.lr) # set the learning rate in the optimizer
+                    self.count=0 # reset the count to 0
+                    self.stop_count=self.stop_count + 1
+                    if self.dwell:
+                        self.restore_best() # return to better point in N space
+                    else:
+                        if v_loss<self.lowest_vloss:
+                            self.lowest_vloss=v_loss
+                else:
+                    self.count=self.count +1 # increment patience counter
+        else: # training accuracy is above threshold so adjust learning rate based on validation loss
+            monitor='val_loss'
+            if v_loss< self.lowest_vloss: # check if the validation loss improved
+                self.lowest_vloss=v_loss # replace lowest validation loss with new validation loss
+                self.snapshot(self.best_weights) # validation loss improved so save the weights
+                improved=True
+                self.count=0 # reset count since validation loss improved
+                self.stop_count=0
+                color=(0,255,0)
+                self.lr=lr
+            else: # validation loss did not improve
+                if self.count>=self.patience-1:
+                    color=(245, 170, 66)
+                    self.lr=self.lr * self.factor # adjust the learning rate
+                    self.stop_count=self.stop_count + 1 # increment stop counter because lr was adjusted
+                    self.count=0 # reset counter
+                    tf.keras.backend.set_value(self.model.optimizer.lr, self.lr) # set the learning rate in the optimizer
+                    if self.dwell:
+                        self.restore_best() # return to better point in N space
+                else:
+                    self.count =self.count +1 # increment the patience counter
+                if acc>self.highest_tracc:
+                    self.highest_tracc= acc
+        if self.writer:
+            if improved:
+                self.writer.submit('best', self.best_weights)
+            self.snapshot(self.latest_weights)
+            self.writer.submit('latest', self.latest_weights, self.state(epoch))
+        msg=f'{str(epoch+1):^3s}/{str(LRA.tepochs):4s} {loss:^9.3f}{acc*100:^9.3f}{v_loss:^9.5f}{v_acc*100:^9.3f}{current_lr:^9.5f}{self.lr:^9.5f}{monitor:^11s}{duration:^8.2f}{self.snapshot_time*1000:^9.1f}'
+        self.print(msg,color, (55,65,80))
+        if self.stop_count> self.stop_patience - 1: # check if learning rate has been adjusted stop_count times with no improvement
+            msg=f' training has been halted at epoch {epoch + 1} after {self.stop_patience} adjustments of learning rate with no improvement'
+            self.print(msg, (0,255,0), (55,65,80))
+            self.model.stop_training = True # stop training
+
+    def on_train_end(self, logs=None):
+        if self.writer:
+            self.writer.flush() # make sure the last checkpoint is on disk before fit returns
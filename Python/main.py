@@ -1,32 +1,59 @@
 #imports
 import os 
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 
 # tensorflow imports
 import tensorflow as tf
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Flatten, Conv2D, Dropout, MaxPooling2D, BatchNormalization
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.losses import mean_squared_logarithmic_error
 from tensorflow.keras.callbacks import EarlyStopping
 
-# sklearn imports
-from sklearn.metrics import confusion_matrix, classification_report
-
 # keras imports
 import keras
-import itertools
+
+from settings import env
+from pixel_cache import flow_from_cache
+from tf_pipeline import make_dataset
+from shards import make_shard_dataset, shard_files
+from manifest import open_manifest
+from evaluation import evaluate_model, write_report
+from perf_callback import instrument
+from models import build_cnn
+import cpu_mode
+from progressive import describe, fit_progressive, parse_schedule
 
 # Set the path to the dataset folder, set batch_size, epochs and image height and width
 PATH = '/home/andrei/Desktop/ProiectLicenta/lung_image_sets'
 batch_size = 8
 epochs = 10
-IMG_H = 180
-IMG_W = 180
+IMG_H = env('IMG_H', 180)
+IMG_W = env('IMG_W', 180)
 INIT_LR = 1e-3    # Initial learning rate
+LOADER = env('LOADER', 'generator')  # 'generator' decodes every JPEG each epoch, 'cache' decodes once into the pixel cache,
+                                     # 'tfdata' decodes and augments in a parallel tf.data pipeline,
+                                     # 'shards' streams the TFRecord shards written by shards.py from SHARD_DIR
+SHARD_DIR = env('SHARD_DIR', 'packed')  # output folder of python shards.py pack, read with LOADER=shards
+SPLIT_FILE = env('SPLIT_FILE', '')  # split manifest written by split.py, used instead of the train/val/test folders
+PERF_TRACE = env('PERF_TRACE', '')  # if set, per-batch timings and memory go to this JSONL file (and a .prom next to it)
+CPU_MODE = env('CPU_MODE', False)  # if true configure the thread pools below and optionally bfloat16/XLA for CPU-only nodes
+INTRA_THREADS = env('INTRA_THREADS', 0)  # threads used inside one op (0 = TensorFlow default)
+INTER_THREADS = env('INTER_THREADS', 0)  # ops run concurrently (0 = TensorFlow default)
+BFLOAT16 = env('BFLOAT16', False)  # mixed_bfloat16 policy, the output layer stays float32
+XLA = env('XLA', False)  # compile the train step with XLA
+RESULTS_FILE = env('RESULTS_FILE', 'cpu_runs.jsonl')  # training time and accuracy of every run, to compare the modes
+PROGRESSIVE = env('PROGRESSIVE', '')  # image size schedule such as '112:4,144:3,180' (progressive.py), trains a
+                                      # global-pooling CNN at growing sizes; '180' is the fixed-size reference
+
+if not CPU_MODE:
+    INTRA_THREADS, INTER_THREADS, BFLOAT16, XLA = 0, 0, False, False
+cpu_mode.configure(INTRA_THREADS, INTER_THREADS, BFLOAT16)  # before TensorFlow runs its first op
+if PROGRESSIVE:
+    schedule = parse_schedule(PROGRESSIVE, epochs)
+    print(f'Progressive resizing: {describe(schedule)}')
 
 # Creating a list of file paths and labels
 train_dir = os.path.join(PATH, 'train')
@@ -36,9 +63,20 @@ test_dir = os.path.join(PATH, 'test')
 print(f'Train directory: {train_dir}\nTest Directory: {test_dir}\nValidation directory: {validation_dir}')
 
 #print all the images for training, validation and testing
-total_train = sum([len(files) for r, d, files in os.walk(train_dir)])
-total_val = sum([len(files) for r, d, files in os.walk(validation_dir)])
-total_test = sum([len(files) for r, d, files in os.walk(test_dir)])
+if LOADER == 'shards':
+    # the shard indexes list every packed image, the image folders are not needed on this machine
+    split_files = {name: shard_files(SHARD_DIR, name) for name in ('train', 'val', 'test')}
+elif SPLIT_FILE:
+    # the same split definition main1.py reads, so results of both scripts are comparable
+    split_df = pd.read_csv(SPLIT_FILE)
+    split_files = {name: (list(group['filepaths']), list(group['labels'])) for name, group in split_df.groupby('split')}
+else:
+    # counts and file lists come from the manifest, which only re-lists folders that changed since the last run
+    manifest = open_manifest(PATH)
+    split_files = {'train': manifest.list(train_dir), 'val': manifest.list(validation_dir), 'test': manifest.list(test_dir)}
+total_train = len(split_files['train'][0])
+total_val = len(split_files['val'][0])
+total_test = len(split_files['test'][0])
 
 print(f'Total train: {total_train}\nTotal validation: {total_val}\nTotal test: {total_test}')
 
@@ -56,38 +94,49 @@ gen = ImageDataGenerator(
 )
 
 
-train_gen = gen.flow_from_directory(
-    train_dir,
-    target_size=(IMG_H, IMG_W),
-    class_mode='categorical',
-    shuffle=True,
-    batch_size=batch_size
-)
-
-test_gen = gen.flow_from_directory(
-    test_dir,
-    target_size=(IMG_H, IMG_W),
-    class_mode='categorical',
-    shuffle=True,
-    batch_size=batch_size
-)
-
-valid_gen = gen.flow_from_directory(
-    validation_dir,
-    target_size=(IMG_H, IMG_W),
-    class_mode='categorical',
-    shuffle=True,
-    batch_size=batch_size
-)
+def make_loader(name, size, shuffle=True, class_indices=None):
+    # batches of one split ('train', 'val' or 'test') at one image size, also used per phase by PROGRESSIVE
+    if LOADER == 'cache':
+        return flow_from_cache(gen, *split_files[name], target_size=size, batch_size=batch_size,
+                               shuffle=shuffle, class_indices=class_indices, name=f'main-{name}')
+    if LOADER == 'tfdata':
+        return make_dataset(*split_files[name], gen, size, batch_size=batch_size, shuffle=shuffle,
+                            class_indices=class_indices)
+    if LOADER == 'shards':
+        return make_shard_dataset(SHARD_DIR, name, gen, size, batch_size=batch_size, shuffle=shuffle)
+    if SPLIT_FILE:
+        filepaths, labels = split_files[name]
+        return gen.flow_from_dataframe(
+            pd.DataFrame({'filepaths': filepaths, 'labels': labels}),
+            x_col='filepaths',
+            y_col='labels',
+            target_size=size,
+            class_mode='categorical',
+            shuffle=shuffle,
+            batch_size=batch_size
+        )
+    return gen.flow_from_directory(
+        os.path.join(PATH, name),
+        target_size=size,
+        class_mode='categorical',
+        shuffle=shuffle,
+        batch_size=batch_size
+    )
+
+
+train_gen = make_loader('train', (IMG_H, IMG_W))
+test_gen = make_loader('test', (IMG_H, IMG_W), shuffle=False, class_indices=train_gen.class_indices)
+valid_gen = make_loader('val', (IMG_H, IMG_W), class_indices=train_gen.class_indices)
 
 classes = list(train_gen.class_indices.keys())
 class_count = len(classes)
 
 def display_all_images(images):
     plt.figure(figsize=(10, 10))
+    batches = iter(images)
     for i in range(9):
         plt.subplot(3, 3, i + 1)
-        img, label = images.next()
+        img, label = next(batches)
         plt.imshow(img[0])
         plt.title(classes[np.argmax(label[0])])
         plt.axis('off')
@@ -96,44 +145,53 @@ def display_all_images(images):
 
 display_all_images(train_gen)
 
-# create the model
-model = Sequential()
-model.add(Conv2D(64,(3,3), padding='same', activation='relu', input_shape=(IMG_H, IMG_W, 3)))
-model.add(MaxPooling2D(pool_size=(2,2)))
-model.add(Dropout(0.25))
-
-
-model.add(Conv2D(32,(3,3), activation='relu'))
-model.add(MaxPooling2D(pool_size=(2,2)))
-model.add(Dropout(0.25))
-
-
-model.add(Conv2D(16,(3,3),activation='relu'))
-model.add(MaxPooling2D(pool_size=(2,2)))
-model.add(Dropout(0.25))
-
-model.add(Conv2D(8,(3,3),activation='relu'))
-model.add(MaxPooling2D(pool_size=(2,2)))
-model.add(Dropout(0.25))
-
-model.add(Flatten())
-model.add(Dropout(0.25))
-model.add(Dense(3, activation='sigmoid'))
+# create the model, with global pooling and any input size when the image size changes during training
+model = build_cnn(None, None, pooling='avg') if PROGRESSIVE else build_cnn(IMG_H, IMG_W)
 
 #compile the model
 print('Compiling model...')
 
 opt = Adam(learning_rate=INIT_LR)
-model.compile(loss='categorical_crossentropy', optimizer=opt, metrics=['accuracy'])
+model.compile(loss='categorical_crossentropy', optimizer=opt, metrics=['accuracy'], jit_compile=XLA)
 
 #train the model
-history = model.fit(
-    x = train_gen,
-    steps_per_epoch = total_train // batch_size,
-    epochs = epochs,
-    validation_data = valid_gen,
-    validation_steps = total_val // batch_size
-)
+callbacks = []
+fit_data = train_gen
+if PERF_TRACE:
+    fit_data, perf_monitor = instrument(train_gen, PERF_TRACE, batch_size)
+    callbacks.append(perf_monitor)
+
+# tf.data loaders (tfdata, shards) are one finite pass, keras restarts them every epoch only when no step count is given
+steps_per_epoch = None if LOADER in ('tfdata', 'shards') else total_train // batch_size
+validation_steps = None if LOADER in ('tfdata', 'shards') else total_val // batch_size
+
+train_start = time.time()
+if PROGRESSIVE:
+    def phase_data(size):
+        # the last phase runs at IMG_H x IMG_W on the loaders built above
+        if size == (IMG_H, IMG_W):
+            return fit_data, valid_gen
+        phase_train = make_loader('train', size)
+        if PERF_TRACE:
+            phase_train, phase_monitor = instrument(phase_train, PERF_TRACE, batch_size)
+            perf_monitor.source = phase_monitor.source  # one monitor over all phases
+        return phase_train, make_loader('val', size, class_indices=train_gen.class_indices)
+
+    history, phases = fit_progressive(
+        model, schedule, phase_data, callbacks,
+        steps_per_epoch = steps_per_epoch,
+        validation_steps = validation_steps
+    )
+else:
+    history = model.fit(
+        x = fit_data,
+        steps_per_epoch = steps_per_epoch,
+        epochs = epochs,
+        validation_data = valid_gen,
+        validation_steps = validation_steps,
+        callbacks = callbacks
+    )
+train_seconds = time.time() - train_start
 
 # # evaluate the network
 # print('Evaluating network...')
@@ -179,29 +237,13 @@ def graph():
 graph()
 
 
-# show the confusion matrix
-def show_confusion_matrix():
-    predictions = model.predict(test_gen)
-    predicted_classes = np.argmax(predictions, axis=1)
-    true_classes = test_gen.labels
-    confusion_mtx = confusion_matrix(true_classes, predicted_classes)
-    plt.figure(figsize=(8, 8))
-    plt.imshow(confusion_mtx, interpolation='nearest', cmap=plt.cm.Blues)
-    plt.title('Confusion Matrix')
-    plt.colorbar()
-    tick_marks = np.arange(class_count)
-    plt.xticks(tick_marks, classes, rotation=45)
-    plt.yticks(tick_marks, classes)
-
-    thresh = confusion_mtx.max() / 2.0
-    for i, j in itertools.product(range(confusion_mtx.shape[0]), range(confusion_mtx.shape[1])):
-        plt.text(j, i, format(confusion_mtx[i, j], 'd'),
-                horizontalalignment="center",
-                color="white" if confusion_mtx[i, j] > thresh else "black") 
-
-    plt.ylabel('True label')
-    plt.xlabel('Predicted label')
-    plt.tight_layout()
-    plt.show()
-
-show_confusion_matrix()
+# evaluate on the test set, unshuffled so every prediction lines up with its label and file,
+# and write the confusion matrix, per-class metrics and worst mistakes to modelCNN-*.json/csv
+report = evaluate_model(model, test_gen, classes)
+write_report(report, '.', 'modelCNN')
+if RESULTS_FILE:
+    mode = cpu_mode.mode_name(INTRA_THREADS, INTER_THREADS, BFLOAT16, XLA)
+    if PROGRESSIVE:
+        mode += f' progressive={PROGRESSIVE}'
+    cpu_mode.record_run(RESULTS_FILE, 'main.py', mode, train_seconds, len(history.history['loss']), report['accuracy'])
+    cpu_mode.print_comparison(RESULTS_FILE, 'main.py')
@@ -1,16 +1,13 @@
-import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import backend as K
-from tensorflow.keras.layers import Dense, Activation,Dropout,Conv2D, MaxPooling2D,BatchNormalization, Flatten
 from tensorflow.keras.optimizers import Adam, Adamax
 from tensorflow.keras.metrics import categorical_crossentropy
-from tensorflow.keras import regularizers
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from tensorflow.keras.models import Model, load_model, Sequential
 import numpy as np
 import pandas as pd
 import shutil
 import time
+import tempfile
 import cv2 as cv2
 from tqdm import tqdm
 from sklearn.model_selection import train_test_split
@@ -20,50 +17,78 @@ import os
 import seaborn as sns
 sns.set_style('darkgrid')
 from PIL import Image
-from sklearn.metrics import confusion_matrix, classification_report
-import itertools
-from keras.applications.vgg19 import VGG19
 
-PATH = '/home/andrei/Desktop/lung_colon_image_set/lung_image_sets'
-
-# Creating a list of file paths and labels
-for i,d in enumerate([PATH]):
-    filepaths=[]
-    labels=[]
-    classlist=os.listdir(d)
-    for klass in classlist:
-        classpath=os.path.join(d,klass)
-        if os.path.isdir(classpath):
-            flist=os.listdir(classpath)
-            for f in flist:
-                fpath=os.path.join(classpath,f)
-                filepaths.append(fpath)
-                labels.append(klass)                   
-    Fseries= pd.Series(filepaths, name='filepaths')
-    Lseries=pd.Series(labels, name='labels')
-    lung_df=pd.concat([Fseries, Lseries], axis=1)
-df=pd.concat([lung_df], axis =0).reset_index(drop=True)# make a combined dataframe
-
-print(df['labels'].value_counts())
-
-'''
-First, I'm creating a list called sample_list. Then, I iterate through the 
-unique values of the labels column.
-For each label, I'm creating a sample of 3000 observations. I'm appending the sample 
-to the sample_list. Finally, I'm concatenating the samples and resetting the index.
-'''
+from settings import env
+from pixel_cache import build_cache, flow_from_cache
+from tf_pipeline import make_dataset
+from shards import make_shard_dataset, shard_files
+from feature_cache import backbone_fingerprint, build_head, cached_features
+from lra import LRA, print_in_color
+from manifest import open_manifest
+from evaluation import StreamingEvaluator, evaluate_model, write_report
+from perf_callback import PerfMonitor, instrument
+from models import build_vgg19
+from balanced_sampler import BalancedSampler
+import cpu_mode
+import distributed
+from progressive import describe, fit_progressive, parse_schedule
+
+CPU_MODE=env('CPU_MODE', False) # if true configure the thread pools below and optionally bfloat16/XLA for CPU-only nodes
+INTRA_THREADS=env('INTRA_THREADS', 0) # threads used inside one op (0 = TensorFlow default)
+INTER_THREADS=env('INTER_THREADS', 0) # ops run concurrently (0 = TensorFlow default)
+BFLOAT16=env('BFLOAT16', False) # mixed_bfloat16 policy, the softmax layer stays float32
+XLA=env('XLA', False) # compile the train step with XLA
+RESULTS_FILE=env('RESULTS_FILE', 'cpu_runs.jsonl') # training time and accuracy of every run, to compare the modes
+PROGRESSIVE=env('PROGRESSIVE', '') # image size schedule such as '112:8,160:8,224' (progressive.py), the VGG19 input
+                                   # is built without a fixed size; '224' is the fixed-size reference
+if not CPU_MODE:
+    INTRA_THREADS, INTER_THREADS, BFLOAT16, XLA = 0, 0, False, False
+cpu_mode.configure(INTRA_THREADS, INTER_THREADS, BFLOAT16) # before TensorFlow runs its first op
+# several workers when started through distributed.py (TF_CONFIG set), a single process otherwise
+strategy=distributed.make_strategy()
+WORKERS=distributed.num_workers()
+IS_CHIEF=distributed.is_chief() # only the chief prints the LRA table, plots, checkpoints and writes reports
 
-sample_size = 3000
-sample_list = []
-
-gr = df.groupby('labels')
-
-for label in df['labels'].unique():
-    label_group = gr.get_group(label).sample(sample_size, replace=False, random_state=123, axis = 0)
-    sample_list.append(label_group)
-
-df = pd.concat(sample_list, axis = 0).reset_index(drop=True)
-print(len(df))
+PATH = '/home/andrei/Desktop/lung_colon_image_set/lung_image_sets'
+LOADER=env('LOADER', 'generator') # 'generator' decodes every JPEG each epoch, 'cache' decodes once into the pixel cache,
+                                  # 'tfdata' decodes in a parallel, prefetching tf.data pipeline,
+                                  # 'shards' streams the TFRecord shards written by shards.py from SHARD_DIR
+SHARD_DIR=env('SHARD_DIR', 'packed') # output folder of python shards.py pack --split-file, read with LOADER=shards
+
+if LOADER != 'shards':
+    # Creating a list of file paths and labels
+    # read from the manifest, which only re-lists folders that changed since the last run
+    manifest=open_manifest(PATH)
+    df=manifest.dataframe(PATH)[['filepaths', 'labels']]
+
+    print(df['labels'].value_counts())
+
+BALANCED=env('BALANCED', True) # keep every image and draw class-balanced training batches through the selected loader
+EPOCH_IMAGES=env('EPOCH_IMAGES', 9000) # training images drawn per epoch with BALANCED, 3 classes x 3000 as the old sample
+FEATURE_CACHE = env('FEATURE_CACHE', False) # if true compute the frozen base model features once and train only the head on them
+# batches are drawn from the full, unbalanced training index, no per-class frames are built; the shards
+# are streamed in packed order through a shuffle buffer instead
+BALANCED_FIT=BALANCED and not FEATURE_CACHE and LOADER != 'shards'
+
+if not BALANCED and LOADER != 'shards':
+    '''
+    First, I'm creating a list called sample_list. Then, I iterate through the 
+    unique values of the labels column.
+    For each label, I'm creating a sample of 3000 observations. I'm appending the sample 
+    to the sample_list. Finally, I'm concatenating the samples and resetting the index.
+    '''
+
+    sample_size = 3000
+    sample_list = []
+
+    gr = df.groupby('labels')
+
+    for label in df['labels'].unique():
+        label_group = gr.get_group(label).sample(sample_size, replace=False, random_state=123, axis = 0)
+        sample_list.append(label_group)
+
+    df = pd.concat(sample_list, axis = 0).reset_index(drop=True)
+    print(len(df))
 
 '''Here, I create the train, test and validation datasets from the original dataset.
 The original dataset came with all the data in one folder so the train, test and validation
@@ -74,13 +99,33 @@ trainSplit = .8
 testSplit = .1
 validationSplit = testSplit/(1-trainSplit) #splits the test data and validation data in half
 
-train_df, dummy_df = train_test_split(df, train_size = trainSplit, shuffle=True, random_state=123)
-test_df, valid_df = train_test_split(dummy_df, train_size = validationSplit, shuffle=True, random_state=123)
+SPLIT_FILE=env('SPLIT_FILE', '') # split manifest written by split.py, replaces the sampling and split above so main.py sees the same sets
+
+if LOADER == 'shards':
+    # the packed splits, listed by the shard indexes
+    train_df, test_df, valid_df=(pd.DataFrame(dict(zip(('filepaths', 'labels'), shard_files(SHARD_DIR, name))))
+                                 for name in ('train', 'test', 'val'))
+elif SPLIT_FILE:
+    split_df=pd.read_csv(SPLIT_FILE)
+    train_df=split_df[split_df['split']=='train'][['filepaths', 'labels']].reset_index(drop=True)
+    test_df=split_df[split_df['split']=='test'][['filepaths', 'labels']].reset_index(drop=True)
+    valid_df=split_df[split_df['split']=='val'][['filepaths', 'labels']].reset_index(drop=True)
+else:
+    train_df, dummy_df = train_test_split(df, train_size = trainSplit, shuffle=True, random_state=123)
+    test_df, valid_df = train_test_split(dummy_df, train_size = validationSplit, shuffle=True, random_state=123)
+
+if WORKERS > 1:
+    # every worker trains and validates on its own equal-length slice, the test set is evaluated whole;
+    # with LOADER=shards make_shard_dataset hands each worker its own shards instead
+    if LOADER != 'shards':
+        train_df=distributed.shard(train_df)
+        valid_df=distributed.shard(valid_df)
+    print(f'Worker {distributed.worker_index()} of {WORKERS}')
 
 print(f'Train length: {len(train_df)}\nTest length: {len(test_df)}\nValidation length: {len(valid_df)}')
 
-height=224
-width=224
+height=env('IMG_H', 224)
+width=env('IMG_W', 224)
 channels=3
 batch_size=32
 img_shape=(height, width, channels)
@@ -96,35 +141,61 @@ def scalar(img):
 
 
 gen=ImageDataGenerator(preprocessing_function=scalar)
-train_gen=gen.flow_from_dataframe( 
-    train_df, 
-    x_col='filepaths', 
-    y_col='labels', target_size=img_size, 
-    class_mode='categorical',
-    color_mode='rgb', 
-    shuffle=True, 
-    batch_size=batch_size
-)
-
-
-test_gen=gen.flow_from_dataframe( 
-    test_df, x_col='filepaths', 
-    y_col='labels', 
-    target_size=img_size, 
-    class_mode='categorical',
-    olor_mode='rgb', 
-    shuffle=False, 
-    batch_size=test_batch_size
-)
-
-
-valid_gen=gen.flow_from_dataframe( 
-    valid_df, x_col='filepaths', 
-    y_col='labels', 
-    target_size=img_size, 
-    class_mode='categorical',
-    color_mode='rgb', shuffle=True, batch_size=batch_size
-)
+
+
+def cache_name(name):
+    # pixel cache entries of one split, per worker since every worker caches its own slice
+    return f'main1-{name}-worker{distributed.worker_index()}' if WORKERS > 1 else f'main1-{name}'
+
+
+def make_loader(name, size, batch, shuffle=True, class_indices=None):
+    # batches of one split ('train', 'val' or 'test') at one image size, also used per phase by PROGRESSIVE
+    frame={'train': train_df, 'val': valid_df, 'test': test_df}[name]
+    if LOADER == 'cache':
+        return flow_from_cache(gen, frame['filepaths'], frame['labels'], target_size=size,
+                               batch_size=batch, shuffle=shuffle, class_indices=class_indices, name=cache_name(name))
+    if LOADER == 'tfdata':
+        return make_dataset(frame['filepaths'], frame['labels'], gen, size, batch_size=batch,
+                            shuffle=shuffle, class_indices=class_indices)
+    if LOADER == 'shards':
+        # train and val are split over the workers by shard, the test set is evaluated whole
+        workers=(WORKERS, distributed.worker_index()) if name != 'test' else (1, 0)
+        return make_shard_dataset(SHARD_DIR, name, gen, size, batch_size=batch, shuffle=shuffle,
+                                  num_workers=workers[0], worker_index=workers[1])
+    return gen.flow_from_dataframe(
+        frame,
+        x_col='filepaths',
+        y_col='labels', target_size=size,
+        class_mode='categorical',
+        color_mode='rgb',
+        shuffle=shuffle,
+        batch_size=batch
+    )
+
+
+def balanced_loader(size, class_indices):
+    # class-balanced training batches drawn afresh every epoch from the full training index, fed
+    # through the selected loader
+    filepaths=train_df['filepaths'].to_numpy()
+    labels=train_df['labels'].to_numpy()
+    seed=123 + distributed.worker_index()
+    if LOADER == 'tfdata':
+        # decoded in parallel by the tf.data pipeline
+        return make_dataset(filepaths, labels, gen, size, batch_size=batch_size, shuffle=True, seed=seed,
+                            class_indices=class_indices, epoch_images=EPOCH_IMAGES)
+    # pixels come out of the memory map with LOADER=cache, the generator path decodes the drawn JPEGs
+    cache=build_cache(filepaths, labels, size, name=cache_name('train')) if LOADER == 'cache' else None
+    return BalancedSampler(filepaths, labels, gen, size, batch_size=batch_size, epoch_images=EPOCH_IMAGES,
+                           seed=seed, class_indices=class_indices, cache=cache)
+
+
+if BALANCED_FIT:
+    # only the balanced draws are built, a full pass over the training set would go unused
+    train_gen=balanced_loader(img_size, {klass: i for i, klass in enumerate(sorted(train_df['labels'].unique()))})
+else:
+    train_gen=make_loader('train', img_size, batch_size)
+test_gen=make_loader('test', img_size, test_batch_size, shuffle=False, class_indices=train_gen.class_indices)
+valid_gen=make_loader('val', img_size, batch_size, class_indices=train_gen.class_indices)
 
 
 classes=list(train_gen.class_indices.keys())
@@ -134,7 +205,7 @@ class_count=len(classes)
 def show_image_samples(gen):
     test_dict=test_gen.class_indices
     classes=list(test_dict.keys())    
-    images,labels=next(gen) # get a sample batch from the generator 
+    images,labels=next(iter(gen)) # get a sample batch from the generator 
     plt.figure(figsize=(20, 20))
     length=len(labels)
     if length<10:   #show maximum of 25 images
@@ -150,148 +221,74 @@ def show_image_samples(gen):
         plt.title(class_name, color='blue', fontsize=16)
         plt.axis('off')
     plt.show()
-show_image_samples(train_gen)
+if IS_CHIEF:
+    show_image_samples(train_gen)
 
 
 #train the model
 model_name='VGG19'
-base_model = VGG19(input_shape=(224, 224, 3), weights='imagenet', pooling="avg", include_top=False)
-x=base_model.output
-x=keras.layers.BatchNormalization(axis=-1, momentum=0.99, epsilon=0.001 )(x)
-x = Dense(
-    128, 
-    kernel_regularizer = regularizers.l2(l = 0.016),
-    activity_regularizer=regularizers.l1(0.006),
-    bias_regularizer=regularizers.l1(0.006) ,activation='relu')(x)
-
-x=Dropout(rate=.45, seed=123)(x)        
-output=Dense(class_count, activation='softmax')(x)
-model=Model(inputs=base_model.input, outputs=output)
-model.compile(Adamax(learning_rate=.001), loss='categorical_crossentropy', metrics=['accuracy'])
-
-def print_in_color(txt_msg,fore_tupple,back_tupple,):
-    #prints the text_msg in the foreground color specified by fore_tupple with the background specified by back_tupple 
-    #text_msg is the text, fore_tupple is foregroud color tupple (r,g,b), back_tupple is background tupple (r,g,b)
-    rf,gf,bf=fore_tupple
-    rb,gb,bb=back_tupple
-    msg='{0}' + txt_msg
-    mat='\33[38;2;' + str(rf) +';' + str(gf) + ';' + str(bf) + ';48;2;' + str(rb) + ';' +str(gb) + ';' + str(bb) +'m' 
-    print(msg .format(mat), flush=True)
-    print('\33[0m', flush=True) # returns default print color to back to black
-    return
-
-class LRA(keras.callbacks.Callback):
-    reset=False
-    count=0
-    stop_count=0
-    tepochs=0
-    def __init__(self,model, patience,stop_patience, threshold, factor, dwell, model_name, freeze, initial_epoch):
-        super(LRA, self).__init__()
-        self.model=model
-        self.patience=patience # specifies how many epochs without improvement before learning rate is adjusted
-        self.stop_patience=stop_patience
-        self.threshold=threshold # specifies training accuracy threshold when lr will be adjusted based on validation loss
-        self.factor=factor # factor by which to reduce the learning rate
-        self.dwell=dwell
-        self.lr=float(tf.keras.backend.get_value(model.optimizer.lr)) # get the initiallearning rate and save it in self.lr
-        self.highest_tracc=0.0 # set highest training accuracy to 0
-        self.lowest_vloss=np.inf # set lowest validation loss to infinity
-        #self.count=0 # initialize counter that counts epochs with no improvement
-        #self.stop_count=0 # initialize counter that counts how manytimes lr has been adjustd with no improvement  
-        self.initial_epoch=initial_epoch 
-        #self.epochs=epochs
-        best_weights=self.model.get_weights() # set a class vaiable so weights can be loaded after training is completed        
-        msg=' '
-        if freeze==True:
-            msgs=f' Starting training using  base model { model_name} with weights frozen to imagenet weights initializing LRA callback'
-        else:
-            msgs=f' Starting training using base model { model_name} training all layers '            
-        print_in_color (msgs, (244, 252, 3), (55,65,80)) 
-        
-    def on_epoch_begin(self,epoch, logs=None):
-        self.now= time.time()
-        
-    def on_epoch_end(self, epoch, logs=None):  # method runs on the end of each epoch
-        later=time.time()
-        duration=later-self.now        
-        if epoch== self.initial_epoch or LRA.reset==True:  
-            LRA.reset=False           
-            msg='{0:^8s}{1:^10s}{2:^9s}{3:^9s}{4:^9s}{5:^9s}{6:^9s}{7:^11s}{8:^8s}'.format('Epoch', 'Loss', 'Accuracy','V_loss','V_acc', 'LR', 'Next LR', 'Monitor', 'Duration')
-            print_in_color(msg, (244,252,3), (55,65,80)) 
-            
-        lr=float(tf.keras.backend.get_value(self.model.optimizer.lr)) # get the current learning rate
-        current_lr=lr
-        v_loss=logs.get('val_loss')  # get the validation loss for this epoch
-        acc=logs.get('accuracy')  # get training accuracy 
-        v_acc=logs.get('val_accuracy')
-        loss=logs.get('loss')
-        #print ( '\n',v_loss, self.lowest_vloss, acc, self.highest_tracc)
-        if acc < self.threshold: # if training accuracy is below threshold adjust lr based on training accuracy
-            monitor='accuracy'
-            if acc>self.highest_tracc: # training accuracy improved in the epoch                
-                self.highest_tracc=acc # set new highest training accuracy
-                LRA.best_weights=self.model.get_weights() # traing accuracy improved so save the weights
-                self.count=0 # set count to 0 since training accuracy improved
-                self.stop_count=0 # set stop counter to 0
-                if v_loss<self.lowest_vloss:
-                    self.lowest_vloss=v_loss
-                color= (0,255,0)
-                self.lr=lr
-            else: 
-                # training accuracy did not improve check if this has happened for patience number of epochs
-                # if so adjust learning rate
-                if self.count>=self.patience -1:
-                    color=(245, 170, 66)
-                    self.lr= lr* self.factor # adjust the learning by factor
-                    tf.keras.backend.set_value(self.model.optimizer.lr, self.lr) # set the learning rate in the optimizer
-                    self.count=0 # reset the count to 0
-                    self.stop_count=self.stop_count + 1
-                    if self.dwell:
-                        self.model.set_weights(LRA.best_weights) # return to better point in N space                        
-                    else:
-                        if v_loss<self.lowest_vloss:
-                            self.lowest_vloss=v_loss                                    
-                else:
-                    self.count=self.count +1 # increment patience counter                    
-        else: # training accuracy is above threshold so adjust learning rate based on validation loss
-            monitor='val_loss'
-            if v_loss< self.lowest_vloss: # check if the validation loss improved 
-                self.lowest_vloss=v_loss # replace lowest validation loss with new validation loss                
-                LRA.best_weights=self.model.get_weights() # validation loss improved so save the weights
-                self.count=0 # reset count since validation loss improved  
-                self.stop_count=0  
-                color=(0,255,0)
-                self.lr=lr
-            else: # validation loss did not improve
-                if self.count>=self.patience-1:
-                    color=(245, 170, 66)
-                    self.lr=self.lr * self.factor # adjust the learning rate
-                    self.stop_count=self.stop_count + 1 # increment stop counter because lr was adjusted 
-                    self.count=0 # reset counter
-                    tf.keras.backend.set_value(self.model.optimizer.lr, self.lr) # set the learning rate in the optimizer
-                    if self.dwell:
-                        self.model.set_weights(LRA.best_weights) # return to better point in N space
-                else: 
-                    self.count =self.count +1 # increment the patience counter                    
-                if acc>self.highest_tracc:
-                    self.highest_tracc= acc
-        msg=f'{str(epoch+1):^3s}/{str(LRA.tepochs):4s} {loss:^9.3f}{acc*100:^9.3f}{v_loss:^9.5f}{v_acc*100:^9.3f}{current_lr:^9.5f}{self.lr:^9.5f}{monitor:^11s}{duration:^8.2f}'
-        print_in_color (msg,color, (55,65,80))
-        if self.stop_count> self.stop_patience - 1: # check if learning rate has been adjusted stop_count times with no improvement
-            msg=f' training has been halted at epoch {epoch + 1} after {self.stop_patience} adjustments of learning rate with no improvement'
-            print_in_color(msg, (0,255,0), (55,65,80))
-            self.model.stop_training = True # stop training
-
-
-epochs = 30
+learning_rate=.001*WORKERS # each worker keeps batch_size, so the lr scales linearly with the global batch
+with strategy.scope():
+    # any input size with PROGRESSIVE, the backbone ends in global average pooling
+    model, base_model=build_vgg19((None, None, channels) if PROGRESSIVE else img_shape, class_count)
+    model.compile(Adamax(learning_rate=learning_rate), loss='categorical_crossentropy', metrics=['accuracy'], jit_compile=XLA)
+
+
+epochs = env('EPOCHS', 30)
 patience = 1 # number of epochs to wait to adjust lr if monitored value does not improve
 stop_patience = 3 # number of epochs to wait before stopping training if monitored value does not improve
 threshold = .9 # if train accuracy is < threshhold adjust monitor accuracy, else monitor validation loss
 factor = .5 # factor to reduce lr by
 dwell = True # experimental, if True and monitored metric does not improve on current epoch set  modelweights back to weights of previous epoch
-freeze = False # if true free weights of  the base model
+freeze = env('FREEZE', False) # if true free weights of  the base model
+AUG_VIEWS = env('AUG_VIEWS', 0) # number of augmented passes over the training set added to the feature cache
+CHECKPOINT_DIR = env('CHECKPOINT_DIR', './checkpoints') # best and latest weights plus LRA state are written here after every epoch
+RESUME = env('RESUME', False) # if true continue from the last checkpoint in CHECKPOINT_DIR
+PERF_TRACE = env('PERF_TRACE', '') # if set, per-batch timings and memory go to this JSONL file (and a .prom next to it)
+if PROGRESSIVE:
+    if FEATURE_CACHE:
+        raise SystemExit('FEATURE_CACHE trains on the features of one image size, PROGRESSIVE needs the images')
+    schedule=parse_schedule(PROGRESSIVE, epochs)
+    print(f'Progressive resizing: {describe(schedule)}')
+train_model=model
+if FEATURE_CACHE:
+    if WORKERS > 1:
+        raise SystemExit('FEATURE_CACHE only trains the head, run it on a single worker')
+    if LOADER == 'shards':
+        raise SystemExit('FEATURE_CACHE reads the augmented views from the image files, use another LOADER')
+    freeze=True
+if freeze:
+    base_model.trainable=False
+    with strategy.scope():
+        model.compile(Adamax(learning_rate=learning_rate), loss='categorical_crossentropy', metrics=['accuracy'], jit_compile=XLA)
+if FEATURE_CACHE:
+    # features are keyed by the backbone weights, image size and file list, so stale entries are never reused
+    fingerprint=backbone_fingerprint(base_model)
+    x_train, y_train=cached_features(base_model, train_gen, train_df['filepaths'], 'train', fingerprint)
+    aug_gen=ImageDataGenerator(
+        preprocessing_function=scalar,
+        shear_range=0.2,
+        zoom_range=0.2,
+        horizontal_flip=True,
+        fill_mode='nearest',
+        width_shift_range=0.1,
+        height_shift_range=0.1
+    )
+    for view in range(AUG_VIEWS):
+        view_gen=aug_gen.flow_from_dataframe(
+            train_df, x_col='filepaths', y_col='labels', target_size=img_size, class_mode='categorical',
+            color_mode='rgb', shuffle=False, batch_size=batch_size
+        )
+        x_view, y_view=cached_features(base_model, view_gen, train_df['filepaths'], f'train-view{view}', fingerprint)
+        x_train=np.concatenate([x_train, x_view])
+        y_train=np.concatenate([y_train, y_view])
+    x_valid, y_valid=cached_features(base_model, valid_gen, valid_df['filepaths'], 'valid', fingerprint)
+    print(f'Training the head on {len(x_train)} cached feature vectors')
+    train_model=build_head(model, base_model) # shares the head layers with model
+    train_model.compile(Adamax(learning_rate=.001), loss='categorical_crossentropy', metrics=['accuracy'], jit_compile=XLA)
+
 callbacks=[LRA(
-    model=model,
+    model=train_model,
     patience=patience,
     stop_patience=stop_patience, 
     threshold=threshold,
@@ -299,18 +296,64 @@ callbacks=[LRA(
     dwell=dwell, 
     model_name=model_name, 
     freeze=freeze, 
-    initial_epoch=0 
+    initial_epoch=0,
+    checkpoint_dir=CHECKPOINT_DIR or None,
+    resume=RESUME,
+    is_chief=IS_CHIEF
 )]
+initial_epoch=callbacks[0].initial_epoch # past the last checkpoint when resuming
+fit_data=train_gen
+if PERF_TRACE and IS_CHIEF:
+    if FEATURE_CACHE:
+        callbacks.append(PerfMonitor(PERF_TRACE, batch_size))
+    else:
+        fit_data, perf_monitor=instrument(fit_data, PERF_TRACE, batch_size)
+        callbacks.append(perf_monitor)
 
+if WORKERS > 1 and not FEATURE_CACHE:
+    # every worker feeds its own shard, the strategy must not split the batches again
+    fit_data=distributed.unsharded(fit_data)
+    valid_gen=distributed.unsharded(valid_gen)
 LRA.tepochs=epochs  # used to determine value of last epoch for printing
-history=model.fit(
-    x=train_gen,  epochs=epochs, callbacks=callbacks, verbose=0,  
-    validation_data=valid_gen,
-    validation_steps=None,  
-    shuffle=False,  
-    initial_epoch=0
-)
-
+train_start=time.time()
+if FEATURE_CACHE:
+    history=train_model.fit(
+        x=x_train, y=keras.utils.to_categorical(y_train, class_count), batch_size=batch_size,
+        epochs=epochs, callbacks=callbacks, verbose=0,
+        validation_data=(x_valid, keras.utils.to_categorical(y_valid, class_count)),
+        shuffle=True,
+        initial_epoch=initial_epoch
+    )
+elif PROGRESSIVE:
+    def phase_data(size):
+        # the last phase runs at img_size on the loaders built above
+        if size == img_size:
+            return fit_data, valid_gen
+        if BALANCED_FIT:
+            phase_train=balanced_loader(size, train_gen.class_indices)
+        else:
+            phase_train=make_loader('train', size, batch_size)
+        if PERF_TRACE and IS_CHIEF:
+            phase_train, phase_monitor=instrument(phase_train, PERF_TRACE, batch_size)
+            perf_monitor.source=phase_monitor.source # one monitor over all phases
+        phase_valid=make_loader('val', size, batch_size, class_indices=train_gen.class_indices)
+        if WORKERS > 1:
+            phase_train, phase_valid=distributed.unsharded(phase_train), distributed.unsharded(phase_valid)
+        return phase_train, phase_valid
+
+    history, phases=fit_progressive(model, schedule, phase_data, callbacks, initial_epoch=initial_epoch,
+                                    log=print if IS_CHIEF else lambda msg: None, verbose=0, shuffle=False)
+else:
+    history=model.fit(
+        x=fit_data,  epochs=epochs, callbacks=callbacks, verbose=0,  
+        validation_data=valid_gen,
+        validation_steps=None,  
+        shuffle=False,  
+        initial_epoch=initial_epoch
+    )
+
+
+train_seconds=time.time()-train_start
 
 #show the training and validation loss
 def tr_plot(tr_data, start_epoch):
@@ -349,103 +392,34 @@ def tr_plot(tr_data, start_epoch):
     #plt.style.use('fivethirtyeight')
     plt.show()
 
-#classification report and confusion matrix
-def print_info( test_gen, preds, print_code, save_dir, subject ):
-    class_dict=test_gen.class_indices
-    labels= test_gen.labels
-    file_names= test_gen.filenames 
-    error_list=[]
-    true_class=[]
-    pred_class=[]
-    prob_list=[]
-    new_dict={}
-    error_indices=[]
-    y_pred=[]
-    for key,value in class_dict.items():
-        new_dict[value]=key             # dictionary {integer of class number: string of class name}
-    # store new_dict as a text fine in the save_dir
-    classes=list(new_dict.values())     # list of string of class names
-    dict_as_text=str(new_dict)
-    dict_name= subject + '-' +str(len(classes)) +'.txt'  
-    dict_path=os.path.join(save_dir,dict_name)    
-    with open(dict_path, 'w') as x_file:
-        x_file.write(dict_as_text)    
-    errors=0      
-    for i, p in enumerate(preds):
-        pred_index=np.argmax(p)        
-        true_index=labels[i]  # labels are integer values
-        if pred_index != true_index: # a misclassification has occurred
-            error_list.append(file_names[i])
-            true_class.append(new_dict[true_index])
-            pred_class.append(new_dict[pred_index])
-            prob_list.append(p[pred_index])
-            error_indices.append(true_index)            
-            errors=errors + 1
-        y_pred.append(pred_index)    
-    if print_code !=0:
-        if errors>0:
-            if print_code>errors:
-                r=errors
-            else:
-                r=print_code           
-            msg='{0:^28s}{1:^28s}{2:^28s}{3:^16s}'.format('Filename', 'Predicted Class' , 'True Class', 'Probability')
-            print_in_color(msg, (0,255,0),(55,65,80))
-            for i in range(r):                
-                split1=os.path.split(error_list[i])                
-                split2=os.path.split(split1[0])                
-                fname=split2[1] + '/' + split1[1]
-                msg='{0:^28s}{1:^28s}{2:^28s}{3:4s}{4:^6.4f}'.format(fname, pred_class[i],true_class[i], ' ', prob_list[i])
-                print_in_color(msg, (255,255,255), (55,65,60))
-                #print(error_list[i]  , pred_class[i], true_class[i], prob_list[i])               
-        else:
-            msg='With accuracy of 100 % there are no errors to print'
-            print_in_color(msg, (0,255,0),(55,65,80))
-    if errors>0:
-        plot_bar=[]
-        plot_class=[]
-        for  key, value in new_dict.items():        
-            count=error_indices.count(key) 
-            if count!=0:
-                plot_bar.append(count) # list containg how many times a class c had an error
-                plot_class.append(value)   # stores the class 
-        fig=plt.figure()
-        fig.set_figheight(len(plot_class)/3)
-        fig.set_figwidth(10)
-        plt.style.use('fivethirtyeight')
-        for i in range(0, len(plot_class)):
-            c=plot_class[i]
-            x=plot_bar[i]
-            plt.barh(c, x, )
-            plt.title( ' Errors by Class on Test Set')
-    y_true= np.array(labels)        
-    y_pred=np.array(y_pred)
-    if len(classes)<= 30:
-        # create a confusion matrix 
-        cm = confusion_matrix(y_true, y_pred )        
-        length=len(classes)
-        if length<8:
-            fig_width=8
-            fig_height=8
-        else:
-            fig_width= int(length * .5)
-            fig_height= int(length * .5)
-        plt.figure(figsize=(fig_width, fig_height))
-        sns.heatmap(cm, annot=True, vmin=0, fmt='g', cmap='Blues', cbar=False)       
-        plt.xticks(np.arange(length)+.5, classes, rotation= 90)
-        plt.yticks(np.arange(length)+.5, classes, rotation=0)
-        plt.xlabel("Predicted")
-        plt.ylabel("Actual")
-        plt.title("Confusion Matrix")
-        plt.show()
-    clr = classification_report(y_true, y_pred, target_names=classes)
-    print("Classification Report:\n----------------------\n", clr)
-
-tr_plot(history,0)
+if IS_CHIEF:
+    tr_plot(history,initial_epoch)
 save_dir=r'./'
 subject='fruits'
-acc=model.evaluate( test_gen, batch_size=test_batch_size, verbose=1, steps=test_steps, return_dict=False)[1]*100
-msg=f'accuracy on the test set is {acc:5.2f} %'
-print_in_color(msg, (0,255,0),(55,65,80))
+# classification report and confusion matrix, accumulated batch by batch and written to save_dir
+if FEATURE_CACHE:
+    x_test, y_test=cached_features(base_model, test_gen, test_df['filepaths'], 'test', fingerprint)
+    evaluator=StreamingEvaluator(classes)
+    test_files=list(test_df['filepaths'])
+    for i in range(0, len(x_test), test_batch_size):
+        evaluator.update(train_model.predict_on_batch(x_test[i:i+test_batch_size]), y_test[i:i+test_batch_size], test_files[i:i+test_batch_size])
+    report=evaluator.report()
+else:
+    report=evaluate_model(model, test_gen, classes) # run on every worker, predict steps are collective under the strategy
+acc=report['accuracy']*100
 save_id=str (model_name +  '-' + subject +'-'+ str(acc)[:str(acc).rfind('.')+3] + '.h5')
-save_loc=os.path.join(save_dir, save_id)
+if IS_CHIEF:
+    write_report(report, save_dir, model_name + '-' + subject)
+    msg=f'accuracy on the test set is {acc:5.2f} %'
+    print_in_color(msg, (0,255,0),(55,65,80))
+    if RESULTS_FILE:
+        mode=cpu_mode.mode_name(INTRA_THREADS, INTER_THREADS, BFLOAT16, XLA, WORKERS)
+        if PROGRESSIVE:
+            mode+=f' progressive={PROGRESSIVE}'
+        cpu_mode.record_run(RESULTS_FILE, 'main1.py', mode, train_seconds, len(history.history['loss']), report['accuracy'])
+        cpu_mode.print_comparison(RESULTS_FILE, 'main1.py')
+    save_loc=os.path.join(save_dir, save_id)
+else:
+    # every worker has to take part in saving, the copies of the other workers are thrown away
+    save_loc=os.path.join(tempfile.mkdtemp(), save_id)
 model.save(save_loc)
@@ -0,0 +1,183 @@
+'''
+Persistent SQLite manifest of the image dataset.
+
+Records path, class label (the name of the folder holding the image), size, mtime, image dimensions
+and a content hash for every image under a root. A refresh re-stats the directories it already
+knows and only lists the ones whose mtime changed, which is what makes it fast on NFS: adding,
+removing or renaming files changes the mtime of their folder. Files are re-hashed only when their
+size or mtime changed.
+
+    python manifest.py /home/andrei/Desktop/lung_colon_image_set/lung_image_sets
+'''
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from pixel_cache import IMAGE_EXTENSIONS
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manifest.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    label TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    width INTEGER,
+    height INTEGER,
+    sha1 TEXT
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files(dir);
+'''
+
+
+def under(root):
+    # WHERE clause arguments for every path below root, using the primary key index
+    root = root.rstrip(os.sep) + os.sep
+    return root, root[:-1] + chr(ord(os.sep) + 1)
+
+
+def describe(path, hash_content=True):
+    st = os.stat(path)
+    with Image.open(path) as img:  # only reads the header
+        width, height = img.size
+    sha1 = None
+    if hash_content:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        sha1 = digest.hexdigest()
+    return path, os.path.basename(os.path.dirname(path)), st.st_size, st.st_mtime_ns, width, height, sha1
+
+
+class Manifest:
+    def __init__(self, db_path=DEFAULT_DB):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def refresh(self, root, hash_content=True, workers=16):
+        '''
+        Brings the manifest for root up to date and returns how much work that took.
+        '''
+        root = os.path.abspath(root)
+        stats = {'dirs_checked': 0, 'dirs_listed': 0, 'files_described': 0, 'files_removed': 0}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool, self.conn:
+            self._refresh_dir(root, os.path.dirname(root), pool, hash_content, stats)
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+
+    def _refresh_dir(self, path, parent, pool, hash_content, stats):
+        stats['dirs_checked'] += 1
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._forget_dir(path, stats)
+            return
+        row = self.conn.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            # unchanged folder: same entries as last time, only its sub-folders need checking
+            subdirs = [r[0] for r in self.conn.execute('SELECT path FROM dirs WHERE parent = ?', (path,))]
+            for subdir in subdirs:
+                self._refresh_dir(subdir, path, pool, hash_content, stats)
+            return
+
+        stats['dirs_listed'] += 1
+        subdirs = []
+        files = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=True):
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    st = entry.stat()
+                    files[entry.path] = (st.st_size, st.st_mtime_ns)
+
+        known = {r[0]: (r[1], r[2]) for r in
+                 self.conn.execute('SELECT path, size, mtime_ns FROM files WHERE dir = ?', (path,))}
+        removed = [p for p in known if p not in files]
+        self.conn.executemany('DELETE FROM files WHERE path = ?', [(p,) for p in removed])
+        stats['files_removed'] += len(removed)
+        changed = [p for p, meta in files.items() if known.get(p) != meta]
+        rows = list(pool.map(lambda p: describe(p, hash_content), changed))
+        self.conn.executemany('INSERT OR REPLACE INTO files (path, label, size, mtime_ns, width, height, sha1, dir) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [r + (path,) for r in rows])
+        stats['files_described'] += len(rows)
+
+        known_subdirs = [r[0] for r in self.conn.execute('SELECT path FROM dirs WHERE parent = ?', (path,))]
+        for subdir in known_subdirs:
+            if subdir not in subdirs:
+                self._forget_dir(subdir, stats)
+        self.conn.execute('INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)',
+                          (path, parent, mtime_ns))
+        for subdir in subdirs:
+            self._refresh_dir(subdir, path, pool, hash_content, stats)
+
+    def _forget_dir(self, path, stats):
+        low, high = under(path)
+        stats['files_removed'] += self.conn.execute(
+            'DELETE FROM files WHERE dir = ? OR (path >= ? AND path < ?)', (path, low, high)).rowcount
+        self.conn.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)', (path, low, high))
+
+    def list(self, root):
+        # (filepaths, labels) of every image under root, sorted by path
+        low, high = under(os.path.abspath(root))
+        rows = self.conn.execute('SELECT path, label FROM files WHERE path >= ? AND path < ? ORDER BY path',
+                                 (low, high)).fetchall()
+        return [r[0] for r in rows], [r[1] for r in rows]
+
+    def count(self, root):
+        low, high = under(os.path.abspath(root))
+        return self.conn.execute('SELECT COUNT(*) FROM files WHERE path >= ? AND path < ?', (low, high)).fetchone()[0]
+
+    def counts(self, root):
+        low, high = under(os.path.abspath(root))
+        return dict(self.conn.execute('SELECT label, COUNT(*) FROM files WHERE path >= ? AND path < ? '
+                                      'GROUP BY label ORDER BY label', (low, high)))
+
+    def dataframe(self, root):
+        # the filepaths/labels dataframe main1.py builds, plus the other recorded columns
+        import pandas as pd
+        low, high = under(os.path.abspath(root))
+        return pd.read_sql_query('SELECT path AS filepaths, label AS labels, size, mtime_ns, width, height, sha1 '
+                                 'FROM files WHERE path >= ? AND path < ? ORDER BY path', self.conn,
+                                 params=(low, high))
+
+
+def open_manifest(root, db_path=DEFAULT_DB, hash_content=True):
+    # returns a manifest that is up to date for root
+    manifest = Manifest(db_path)
+    stats = manifest.refresh(root, hash_content=hash_content)
+    print(f'Manifest refreshed in {stats["seconds"]:.2f} s: {stats["dirs_checked"]} folders checked, '
+          f'{stats["dirs_listed"]} listed, {stats["files_described"]} files added or changed, '
+          f'{stats["files_removed"]} removed')
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or refresh the dataset manifest')
+    parser.add_argument('root')
+    parser.add_argument('--db', default=DEFAULT_DB)
+    parser.add_argument('--no-hash', action='store_true', help='skip content hashes of new files')
+    args = parser.parse_args()
+    manifest = open_manifest(args.root, args.db, hash_content=not args.no_hash)
+    for label, n in manifest.counts(args.root).items():
+        print(f'{label:<20s}{n:>8d}')
+    manifest.close()
@@ -0,0 +1,48 @@
+'''
+Model architectures of main.py (small Sequential CNN) and main1.py (VGG19 transfer model),
+shared with the tools that need to build them outside the training scripts.
+'''
+from tensorflow import keras
+from tensorflow.keras import regularizers
+from tensorflow.keras.layers import Dense, Flatten, Conv2D, Dropout, MaxPooling2D, GlobalAveragePooling2D
+from tensorflow.keras.models import Model, Sequential
+from keras.applications.vgg19 import VGG19
+
+
+def build_cnn(img_h, img_w, class_count=3, filters=(64, 32, 16, 8), activation='sigmoid', pooling=None):
+    # the main.py CNN; distill.py builds narrower variants with other filters and a softmax output.
+    # pooling='avg' replaces Flatten with global average pooling, so img_h/img_w may be None and the
+    # same weights serve every input size (progressive.py)
+    model = Sequential()
+    for i, f in enumerate(filters):
+        if i == 0:
+            model.add(Conv2D(f,(3,3), padding='same', activation='relu', input_shape=(img_h, img_w, 3)))
+        else:
+            model.add(Conv2D(f,(3,3), activation='relu'))
+        model.add(MaxPooling2D(pool_size=(2,2)))
+        model.add(Dropout(0.25))
+
+    if pooling == 'avg':
+        model.add(GlobalAveragePooling2D())
+    else:
+        model.add(Flatten())
+    model.add(Dropout(0.25))
+    model.add(Dense(class_count, activation=activation, dtype='float32'))  # float32 outputs under mixed_bfloat16
+    return model
+
+
+def build_vgg19(img_shape, class_count, weights='imagenet', l2=0.016, l1=0.006, dropout=.45):
+    # the main1.py model, returns (model, base_model); the head regularization is tunable for sweep.py.
+    # the backbone ends in global average pooling, so img_shape may be (None, None, 3) for progressive.py
+    base_model = VGG19(input_shape=img_shape, weights=weights, pooling="avg", include_top=False)
+    x = base_model.output
+    x = keras.layers.BatchNormalization(axis=-1, momentum=0.99, epsilon=0.001)(x)
+    x = Dense(
+        128,
+        kernel_regularizer=regularizers.l2(l=l2),
+        activity_regularizer=regularizers.l1(l1),
+        bias_regularizer=regularizers.l1(l1), activation='relu')(x)
+    x = Dropout(rate=dropout, seed=123)(x)
+    output = Dense(class_count, activation='softmax', dtype='float32')(x)  # float32 outputs under mixed_bfloat16
+    model = Model(inputs=base_model.input, outputs=output)
+    return model, base_model
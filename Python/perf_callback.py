@@ -0,0 +1,210 @@
+'''
+Training performance instrumentation usable from main.py and main1.py.
+
+PerfMonitor records, per training batch: the step time (on_train_batch_begin to end), the gap
+between steps, images/sec, process RSS and peak memory. It writes one JSON line per batch and one
+per epoch to a trace file, and keeps a Prometheus text-format file up to date.
+
+Keras pulls batches inside the train step, so time blocked on the input pipeline shows up as extra
+step time. The fastest steps of an epoch are the ones where a batch was already waiting, so the
+10th percentile step time is taken as the compute time and anything above it (plus the gap between
+steps) is counted as input wait. Wrapping a keras iterator or Sequence in InstrumentedSequence also
+measures the time spent producing each batch (JPEG decoding and augmentation); when that is slower
+than the compute time, prefetching cannot hide it and the run is input bound.
+'''
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+import numpy as np
+from tensorflow import keras
+from tensorflow.keras.utils import Sequence
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss
+        except ImportError:
+            return 0
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, kilobytes on Linux
+
+
+class InstrumentedSequence(Sequence):
+    '''
+    Wraps a keras iterator/Sequence and times every batch it produces.
+    '''
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.lock = threading.Lock()
+        self.produce_times = []
+        self.produced_images = 0
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, idx):
+        start = time.perf_counter()
+        batch = self.sequence[idx]
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.produce_times.append(elapsed)
+            self.produced_images += len(batch[0])
+        return batch
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+    def drain(self):
+        with self.lock:
+            times, self.produce_times = self.produce_times, []
+        return times
+
+    def __getattr__(self, name):
+        # class_indices, filenames, labels... of the wrapped iterator
+        if name == 'sequence':
+            raise AttributeError(name)
+        return getattr(self.sequence, name)
+
+
+class PerfMonitor(keras.callbacks.Callback):
+    def __init__(self, trace_path, batch_size, prom_path=None, source=None, floor_percentile=10):
+        super(PerfMonitor, self).__init__()
+        self.trace_path = trace_path
+        self.prom_path = prom_path or os.path.splitext(trace_path)[0] + '.prom'
+        self.batch_size = batch_size
+        self.source = source  # optional InstrumentedSequence feeding model.fit
+        self.floor_percentile = floor_percentile
+        self.totals = {'steps': 0, 'images': 0, 'step_s': 0.0, 'gap_s': 0.0, 'wait_s': 0.0, 'compute_s': 0.0,
+                       'produce_s': 0.0, 'produced': 0, 'train_s': 0.0}
+        self.epochs = []
+
+    def on_train_begin(self, logs=None):
+        self.trace = open(self.trace_path, 'a')
+        self.train_start = time.perf_counter()  # of this fit, PROGRESSIVE calls fit once per phase
+        self.last_end = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.steps = []
+        self.gaps = []
+        self.epoch_start = time.perf_counter()
+        self.last_end = None
+        if self.source is not None:
+            self.source.drain()  # batches prefetched before the epoch started belong to no step
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+        self.gap = self.batch_start - self.last_end if self.last_end is not None else 0.0
+
+    def on_train_batch_end(self, batch, logs=None):
+        now = time.perf_counter()
+        step = now - self.batch_start
+        self.last_end = now
+        self.steps.append(step)
+        self.gaps.append(self.gap)
+        record = {'type': 'batch', 'epoch': self.epoch, 'batch': batch, 'step_s': step, 'gap_s': self.gap,
+                  'images_per_sec': self.batch_size / (step + self.gap), 'rss_bytes': rss_bytes(),
+                  'peak_rss_bytes': peak_rss_bytes(), 'time': time.time()}
+        self.trace.write(json.dumps(record) + '\n')
+
+    def on_epoch_end(self, epoch, logs=None):
+        steps = np.array(self.steps)
+        gaps = np.array(self.gaps)
+        if not len(steps):
+            return
+        floor = float(np.percentile(steps, self.floor_percentile))
+        wait = float(np.maximum(steps - floor, 0).sum() + gaps.sum())
+        wall = time.perf_counter() - self.epoch_start
+        produce = self.source.drain() if self.source is not None else []
+        summary = {
+            'type': 'epoch', 'epoch': epoch, 'steps': len(steps), 'wall_s': wall,
+            'step_s_mean': float(steps.mean()), 'step_s_p50': float(np.percentile(steps, 50)),
+            'step_s_p95': float(np.percentile(steps, 95)), 'compute_s_per_step': floor,
+            'input_wait_s': wait, 'input_wait_fraction': wait / wall if wall else 0.0,
+            'produce_s_per_batch': float(np.mean(produce)) if produce else None,
+            'images_per_sec': len(steps) * self.batch_size / wall if wall else 0.0,
+            'rss_bytes': rss_bytes(), 'peak_rss_bytes': peak_rss_bytes(),
+        }
+        self.epochs.append(summary)
+        self.trace.write(json.dumps(summary) + '\n')
+        self.trace.flush()
+        t = self.totals
+        t['steps'] += len(steps)
+        t['images'] += len(steps) * self.batch_size
+        t['step_s'] += float(steps.sum())
+        t['gap_s'] += float(gaps.sum())
+        t['wait_s'] += wait
+        t['compute_s'] += floor * len(steps)
+        t['produce_s'] += float(np.sum(produce))
+        t['produced'] += len(produce)
+        self.write_prometheus(summary)
+
+    def write_prometheus(self, last):
+        t = self.totals
+        lines = [
+            '# TYPE training_steps_total counter', f'training_steps_total {t["steps"]}',
+            '# TYPE training_images_total counter', f'training_images_total {t["images"]}',
+            '# TYPE training_step_seconds_total counter', f'training_step_seconds_total {t["step_s"]:.6f}',
+            '# TYPE training_input_wait_seconds_total counter', f'training_input_wait_seconds_total {t["wait_s"]:.6f}',
+            '# TYPE training_compute_seconds_total counter', f'training_compute_seconds_total {t["compute_s"]:.6f}',
+            '# TYPE training_images_per_second gauge', f'training_images_per_second {last["images_per_sec"]:.3f}',
+            '# TYPE training_step_seconds gauge',
+            f'training_step_seconds{{quantile="0.5"}} {last["step_s_p50"]:.6f}',
+            f'training_step_seconds{{quantile="0.95"}} {last["step_s_p95"]:.6f}',
+            '# TYPE training_epoch gauge', f'training_epoch {last["epoch"]}',
+            '# TYPE process_resident_memory_bytes gauge', f'process_resident_memory_bytes {last["rss_bytes"]}',
+            '# TYPE process_peak_memory_bytes gauge', f'process_peak_memory_bytes {last["peak_rss_bytes"]}',
+        ]
+        if t['produced']:
+            lines += ['# TYPE training_batch_produce_seconds_total counter',
+                      f'training_batch_produce_seconds_total {t["produce_s"]:.6f}']
+        tmp = self.prom_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.prom_path)  # scrapers never see a half-written file
+
+    def bottleneck(self):
+        t = self.totals
+        busy = t['step_s'] + t['gap_s']
+        wait_fraction = t['wait_s'] / busy if busy else 0.0
+        compute_per_step = t['compute_s'] / t['steps'] if t['steps'] else 0.0
+        produce_per_batch = t['produce_s'] / t['produced'] if t['produced'] else None
+        if produce_per_batch is not None and produce_per_batch > compute_per_step:
+            return ('input pipeline: producing a batch takes {:.0f} ms, the model needs {:.0f} ms per step'
+                    .format(produce_per_batch * 1000, compute_per_step * 1000))
+        if wait_fraction > 0.2:
+            return f'input pipeline: {wait_fraction * 100:.0f} % of training time was spent waiting for batches'
+        return f'model compute: only {wait_fraction * 100:.0f} % of training time was spent waiting for batches'
+
+    def on_train_end(self, logs=None):
+        t = self.totals
+        t['train_s'] += time.perf_counter() - self.train_start  # the totals span every fit so far
+        if t['steps']:
+            print(f'Performance: {t["images"] / t["train_s"]:.1f} img/s over {t["steps"]} steps, '
+                  f'{t["compute_s"] / t["steps"] * 1000:.0f} ms compute per step, '
+                  f'{t["wait_s"]:.1f} s waiting for input, peak memory {peak_rss_bytes() / 2**20:.0f} MB')
+            print(f'Bottleneck: {self.bottleneck()}')
+        self.trace.close()
+
+
+def instrument(batches, trace_path, batch_size):
+    '''
+    Returns (batches to pass to model.fit, PerfMonitor callback). keras iterators and Sequences are
+    wrapped so batch production is timed too; tf.data datasets are passed through unchanged.
+    '''
+    source = None
+    if isinstance(batches, Sequence):
+        batches = source = InstrumentedSequence(batches)
+    return batches, PerfMonitor(trace_path, batch_size, source=source)
@@ -0,0 +1,222 @@
+'''
+On-disk cache of decoded and resized training images.
+
+Every image is decoded and resized once into a uint8 memory-mapped array, so the
+training scripts only have to augment or rescale in memory on each epoch instead
+of decoding 768x768 JPEGs again. An entry is keyed by the file paths, their mtimes
+and the target size: running with a different IMG_H/IMG_W builds a new entry next
+to the existing one and leaves it alone. Callers name their file lists ('train',
+'val'...); once the files of a name change, the new entry replaces the old entries
+of that name and size instead of piling up next to them.
+'''
+import functools
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from tensorflow.keras.utils import Sequence
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pixel_cache')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+
+
+def list_directory(directory):
+    # same file order and labels as flow_from_directory: sorted class folders, sorted files
+    filepaths = []
+    labels = []
+    for klass in sorted(os.listdir(directory)):
+        classpath = os.path.join(directory, klass)
+        if not os.path.isdir(classpath):
+            continue
+        for root, _, files in sorted(os.walk(classpath)):
+            for f in sorted(files):
+                if f.lower().endswith(IMAGE_EXTENSIONS):
+                    filepaths.append(os.path.join(root, f))
+                    labels.append(klass)
+    return filepaths, labels
+
+
+def cache_key(filepaths, target_size, name=None):
+    height, width = target_size
+    digest = hashlib.sha1(f'{height}x{width}'.encode())
+    for path in filepaths:
+        digest.update(os.path.abspath(path).encode())
+        digest.update(str(os.stat(path).st_mtime_ns).encode())
+    key = f'{height}x{width}-{digest.hexdigest()[:16]}'
+    return f'{name}-{key}' if name else key
+
+
+def load_pixels(path, target_size):
+    # nearest resize to match keras load_img, which flow_from_directory/dataframe use by default
+    height, width = target_size
+    with Image.open(path) as img:
+        img = img.convert('RGB')
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.NEAREST)
+        return np.asarray(img, dtype=np.uint8)
+
+
+class PixelCache:
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'index.json')) as f:
+            meta = json.load(f)
+        self.directory = directory
+        self.filepaths = meta['filepaths']
+        self.labels = meta['labels']
+        self.target_size = tuple(meta['target_size'])
+        self.pixels = np.memmap(os.path.join(directory, 'pixels.u8'), dtype=np.uint8, mode='r',
+                                shape=tuple(meta['shape']))
+
+    def __len__(self):
+        return len(self.filepaths)
+
+
+def store_pixels(pixels, filepaths, target_size, i):
+    pixels[i] = load_pixels(filepaths[i], target_size)
+
+
+def decode_into(path, filepaths, target_size, workers=None):
+    # the memory map lives only in this call and is unmapped when it returns
+    height, width = target_size
+    pixels = np.memmap(path, dtype=np.uint8, mode='w+', shape=(len(filepaths), height, width, 3))
+    # PIL releases the GIL while decoding and resizing so threads are enough here
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(functools.partial(store_pixels, pixels, filepaths, target_size), range(len(filepaths))))
+    pixels.flush()
+    return pixels.shape
+
+
+def remove_stale(cache_dir, name, target_size, keep):
+    # entries of the same named file list at this size, left behind when its files changed
+    height, width = target_size
+    prefix = f'{name}-{height}x{width}-'
+    for entry in os.listdir(cache_dir):
+        if entry.startswith(prefix) and entry != keep:
+            print(f'Removing stale pixel cache {entry}')
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+
+def build_cache(filepaths, labels, target_size, cache_dir=CACHE_DIR, workers=None, name=None):
+    '''
+    Returns the cache entry for these files at target_size, decoding them only if it does not exist
+    yet. A name identifies the file list: building an entry for it removes its older entries.
+    '''
+    filepaths = [str(p) for p in filepaths]
+    labels = [str(l) for l in labels]
+    key = cache_key(filepaths, target_size, name)
+    directory = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(directory, 'index.json')):
+        return PixelCache(directory)
+
+    height, width = target_size
+    tmp_dir = directory + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    print(f'Building pixel cache for {len(filepaths)} images at {height}x{width} in {directory}')
+    shape = decode_into(os.path.join(tmp_dir, 'pixels.u8'), filepaths, target_size, workers)
+
+    meta = {'filepaths': filepaths, 'labels': labels, 'target_size': [height, width], 'shape': list(shape)}
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_dir, directory)  # only complete entries ever appear under their key
+    if name:
+        remove_stale(cache_dir, name, target_size, key)
+    return PixelCache(directory)
+
+
+class CachedImageIterator(Sequence):
+    '''
+    Drop-in replacement for the flow_from_directory/flow_from_dataframe iterators that reads
+    batches out of a PixelCache. Only the batch being built is copied out of the memory map,
+    augmentation and rescaling come from the given ImageDataGenerator.
+    '''
+    def __init__(self, cache, image_data_generator, batch_size=32, shuffle=True, seed=None, class_indices=None):
+        self.cache = cache
+        self.image_data_generator = image_data_generator
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.n = len(cache)
+        self.image_shape = cache.pixels.shape[1:]
+        if class_indices is None:
+            class_indices = {klass: i for i, klass in enumerate(sorted(set(cache.labels)))}
+        self.class_indices = class_indices
+        self.num_classes = len(class_indices)
+        self.classes = np.array([class_indices[l] for l in cache.labels], dtype='int32')
+        self.labels = self.classes
+        self.filenames = cache.filepaths
+        self.filepaths = cache.filepaths
+        self.batch_index = 0
+        self.total_batches_seen = 0
+        self._rng = np.random.RandomState(seed)
+        self._set_index_array()
+
+    def _set_index_array(self):
+        self.index_array = np.arange(self.n)
+        if self.shuffle:
+            self.index_array = self._rng.permutation(self.n)
+
+    def _augments(self):
+        gen = self.image_data_generator
+        return any([gen.rotation_range, gen.width_shift_range, gen.height_shift_range, gen.shear_range,
+                    gen.zoom_range[0] != 1 or gen.zoom_range[1] != 1, gen.channel_shift_range,
+                    gen.horizontal_flip, gen.vertical_flip, gen.brightness_range is not None])
+
+    def __len__(self):
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        start = idx * self.batch_size
+        stop = min(start + self.batch_size, self.n)
+        if self.shuffle:
+            index_array = self.index_array[start:stop]
+            # memmap reads are cheapest in file order, put the batch back in shuffled order afterwards
+            order = np.argsort(index_array)
+            batch = np.empty((len(index_array),) + self.image_shape, dtype=np.uint8)
+            batch[order] = self.cache.pixels[index_array[order]]
+        else:
+            index_array = np.arange(start, stop)
+            batch = self.cache.pixels[start:stop]  # zero-copy view until the float conversion below
+        batch_x = batch.astype('float32')
+        gen = self.image_data_generator
+        augment = self._augments()
+        for i in range(len(batch_x)):
+            if augment:
+                params = gen.get_random_transform(self.image_shape, seed=self._rng.randint(2 ** 31 - 1))
+                batch_x[i] = gen.apply_transform(batch_x[i], params)
+            batch_x[i] = gen.standardize(batch_x[i])
+        batch_y = np.zeros((len(batch_x), self.num_classes), dtype='float32')
+        batch_y[np.arange(len(batch_x)), self.classes[index_array]] = 1.0
+        return batch_x, batch_y
+
+    def on_epoch_end(self):
+        self._set_index_array()
+
+    def reset(self):
+        self.batch_index = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        if self.batch_index >= len(self):
+            self.batch_index = 0
+            self.on_epoch_end()
+        batch = self[self.batch_index]
+        self.batch_index += 1
+        self.total_batches_seen += 1
+        return batch
+
+
+def flow_from_cache(image_data_generator, filepaths, labels, target_size, batch_size=32, shuffle=True,
+                    seed=None, class_indices=None, cache_dir=CACHE_DIR, name=None):
+    cache = build_cache(filepaths, labels, target_size, cache_dir=cache_dir, name=name)
+    return CachedImageIterator(cache, image_data_generator, batch_size=batch_size, shuffle=shuffle,
+                               seed=seed, class_indices=class_indices)
@@ -0,0 +1,132 @@
+'''
+Content-addressed cache of model predictions, shared by gui.py and batch_infer.py.
+
+A prediction is stored under the hash of the image file's bytes, the identity of the model (path,
+size and mtime of the model file, see model_id) and PREPROCESS_VERSION, so a renamed copy of a tile
+is still a hit while a retrained model or a change to the preprocessing never returns stale scores.
+Looking an image up costs one read and hash of the file, no decoding and no predict.
+
+Entries live in an in-memory LRU in front of a SQLite store on disk. The store is trimmed to
+max_bytes by dropping the least recently used entries. Every entry remembers how long it took to
+compute, so the cache can report its hit rate and the time it saved.
+'''
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from inference import PREPROCESS_VERSION
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prediction_cache.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS predictions (
+    key TEXT PRIMARY KEY,
+    probs BLOB NOT NULL,
+    compute_ms REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used);
+'''
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def model_id(info):
+    # identity of a registry model: a changed file gets a new id
+    return f'{info["path"]}:{info["size"]}:{info["mtime_ns"]}'
+
+
+class PredictionCache:
+    def __init__(self, db_path=DEFAULT_DB, memory_entries=4096, max_bytes=256 * 2**20):
+        self.db_path = db_path
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()  # key -> (probs, compute_ms)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        self.saved_ms = 0.0
+        self.puts_since_trim = 0
+
+    def key(self, digest, model):
+        return hashlib.sha1(f'{digest}|{model}|{PREPROCESS_VERSION}'.encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.hits['memory'] += 1
+            else:
+                row = self.conn.execute('SELECT probs, compute_ms FROM predictions WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                entry = (np.frombuffer(row[0], dtype=np.float32), row[1])
+                self.conn.execute('UPDATE predictions SET last_used = ? WHERE key = ?', (time.time(), key))
+                self.conn.commit()
+                self._remember(key, entry)
+                self.hits['disk'] += 1
+            self.saved_ms += entry[1]
+            return entry[0]
+
+    def put(self, key, probs, compute_ms):
+        self.put_many([(key, probs, compute_ms)])
+
+    def put_many(self, items):
+        # items: (key, probs, compute_ms), one transaction for a whole batch
+        now = time.time()
+        with self.lock:
+            rows = []
+            for key, probs, compute_ms in items:
+                probs = np.asarray(probs, dtype=np.float32)
+                self._remember(key, (probs, compute_ms))
+                rows.append((key, probs.tobytes(), compute_ms, now))
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO predictions (key, probs, compute_ms, last_used) '
+                                      'VALUES (?, ?, ?, ?)', rows)
+            self.puts_since_trim += len(rows)
+            if self.puts_since_trim >= 256:
+                self._trim()
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _trim(self):
+        # drops least recently used rows until the stored payload fits in max_bytes
+        self.puts_since_trim = 0
+        total = self.conn.execute('SELECT COALESCE(SUM(LENGTH(probs) + LENGTH(key) + 16), 0) FROM predictions').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        with self.conn:
+            self.conn.execute('''
+                WITH sized AS (SELECT key, LENGTH(probs) + LENGTH(key) + 16 AS bytes, last_used FROM predictions),
+                     running AS (SELECT key, SUM(bytes) OVER (ORDER BY last_used, key) - bytes AS before FROM sized)
+                DELETE FROM predictions WHERE key IN (SELECT key FROM running WHERE before < ?)''', (excess,))
+
+    def stats(self):
+        hits = self.hits['memory'] + self.hits['disk']
+        lookups = hits + self.misses
+        return {'lookups': lookups, 'memory_hits': self.hits['memory'], 'disk_hits': self.hits['disk'],
+                'misses': self.misses, 'hit_rate': hits / lookups if lookups else 0.0, 'saved_s': self.saved_ms / 1000}
+
+    def summary(self):
+        s = self.stats()
+        return (f'cache hit rate {s["hit_rate"] * 100:.0f} % ({s["memory_hits"]} memory, {s["disk_hits"]} disk, '
+                f'{s["misses"]} misses), {s["saved_s"]:.1f} s saved')
+
+    def close(self):
+        self.conn.close()
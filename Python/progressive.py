@@ -0,0 +1,90 @@
+'''
+Progressive-resolution training for main.py and main1.py.
+
+Early epochs learn the coarse tissue structure just as well from small images, which are several
+times cheaper to decode, augment and convolve. With PROGRESSIVE set the scripts train in phases of
+growing image size, e.g. 112 then 160 then 224, and the input pipeline is rebuilt at every switch.
+The models end in global average pooling (build_cnn(pooling='avg'), the VGG19 backbone's
+pooling="avg") and are built with a (None, None, 3) input, so one set of weights serves every size
+and simply carries over to the next phase.
+
+The schedule is a comma separated list of size:epochs phases, the last one may leave out its count
+and takes the remaining epochs; without any counts the epochs are split evenly. Epoch numbers run
+on across the phases, so the LRA table, its checkpoints and RESUME keep working: a resumed run
+starts inside the phase its epoch belongs to. At every switch LRA.new_phase() restarts the monitor,
+since losses at a new size are not comparable with the last ones. When LRA halts a phase early the
+next phase still runs, at its scheduled first epoch.
+
+The test set is always evaluated at the scripts' full IMG_H x IMG_W. A one-phase schedule is
+fixed-resolution training with the same pooled model, the reference to compare against; both runs
+land in RESULTS_FILE with their wall-clock time and test accuracy:
+
+    PROGRESSIVE=224 python main1.py
+    PROGRESSIVE=112:8,160:8,224 python main1.py
+'''
+import time
+from types import SimpleNamespace
+
+
+def parse_schedule(spec, epochs):
+    '''
+    Phases [(first_epoch, end_epoch, (size, size))] covering epochs 0..epochs, from
+    "112:4,160:4,224" (size:epochs, the last count may be left out) or "112,160,224" (equal phases).
+    '''
+    parts = [p.strip().split(':') for p in str(spec).split(',') if p.strip()]
+    if not parts:
+        raise ValueError('empty progressive schedule')
+    sizes = [int(p[0]) for p in parts]
+    counts = [int(p[1]) if len(p) > 1 else None for p in parts]
+    if all(c is None for c in counts):
+        counts = [epochs // len(sizes)] * len(sizes)
+        counts[-1] += epochs - sum(counts)
+    elif counts[-1] is None:
+        if None in counts[:-1]:
+            raise ValueError(f'only the last phase of {spec!r} may leave out its epochs')
+        counts[-1] = epochs - sum(counts[:-1])
+    elif None in counts:
+        raise ValueError(f'only the last phase of {spec!r} may leave out its epochs')
+    if min(counts) < 1 or sum(counts) != epochs:
+        raise ValueError(f'{spec!r} does not split {epochs} epochs into phases of at least one epoch')
+    schedule = []
+    start = 0
+    for size, count in zip(sizes, counts):
+        schedule.append((start, start + count, (size, size)))
+        start += count
+    return schedule
+
+
+def describe(schedule):
+    return ' -> '.join(f'{size[0]}px x {end - start}' for start, end, size in schedule)
+
+
+def fit_progressive(model, schedule, phase_data, callbacks=(), initial_epoch=0, log=print, **fit_args):
+    '''
+    Trains model through the phases of schedule with one model.fit per phase. phase_data(size)
+    returns the (training data, validation data) of a phase. Returns (history, phases): history
+    has the .history dict of model.fit with the epochs of all phases, phases the size, epochs run
+    and seconds (pipeline rebuild included) of each phase.
+    '''
+    merged = {}
+    phases = []
+    for first, end, size in schedule:
+        if end <= initial_epoch:
+            continue  # finished before the checkpoint this run resumed from
+        start = time.perf_counter()
+        train, valid = phase_data(size)
+        if 0 < first and initial_epoch <= first:
+            # the size changes here; a run resumed inside this phase keeps its restored LRA state
+            for callback in callbacks:
+                if hasattr(callback, 'new_phase'):
+                    callback.new_phase(size)
+        first = max(first, initial_epoch)
+        history = model.fit(train, validation_data=valid, epochs=end, initial_epoch=first, callbacks=list(callbacks),
+                            **fit_args)
+        for key, values in history.history.items():
+            merged.setdefault(key, []).extend(values)
+        ran = len(history.history.get('loss', []))
+        phases.append({'size': size, 'epochs': ran, 'seconds': time.perf_counter() - start})
+        log(f'Phase {size[0]}x{size[1]}: {ran} epochs in {phases[-1]["seconds"]:.1f} s'
+            + (' (stopped early)' if ran < end - first else ''))
+    return SimpleNamespace(history=merged), phases
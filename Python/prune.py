@@ -0,0 +1,177 @@
+'''
+Structured pruning of the main1.py VGG19 model.
+
+Filters are ranked by the L1 norm of their kernels and the weakest ones are removed from the conv
+layers of the chosen blocks; the input channels of the next layer, the BatchNormalization of the
+head and the first Dense rows are cut to match. --drop-blocks 1 also removes block 5 entirely
+(block 4 ends with 512 channels as well, so the head still fits). The result
+is rebuilt as a smaller dense model with the surviving weights, fine-tuned with the LRA schedule of
+main1.py and saved as <model>-pruned-<sparsity>.h5.
+
+For every sparsity level the report lists FLOPs, parameters, file size, single-image CPU latency
+and test accuracy, next to the unpruned model.
+
+    python prune.py VGG19-fruits-99.00.h5 --split-file ../split.csv --sparsity 0.25 0.5 0.75
+    python prune.py VGG19-fruits-99.00.h5 --split-file ../split.csv --sparsity 0.5 --drop-blocks 1
+'''
+import argparse
+import json
+import os
+
+import numpy as np
+from tensorflow import keras
+from tensorflow.keras.layers import BatchNormalization, Conv2D, Dense, InputLayer
+from tensorflow.keras.models import load_model
+from tensorflow.keras.optimizers import Adamax
+from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+from distill import latency_ms, load_splits, scalar
+from evaluation import evaluate_model
+from inference import IMG_SIZE
+from lra import LRA
+
+
+def block_of(layer):
+    # 5 for block5_conv3, None for layers outside the VGG19 blocks
+    if layer.name.startswith('block') and '_' in layer.name:
+        return int(layer.name[5:layer.name.index('_')])
+    return None
+
+
+def filter_ranking(layer):
+    # output filters of a Conv2D from most to least important by kernel L1 norm
+    kernel = layer.get_weights()[0]
+    return np.argsort(-np.abs(kernel).sum(axis=(0, 1, 2)))
+
+
+def prune(model, sparsity, blocks=(3, 4, 5), drop_blocks=0):
+    '''
+    Returns a new, smaller model: `sparsity` of the filters of every conv layer in `blocks` removed
+    and the last `drop_blocks` blocks left out. The layers of main1.py form a single chain, which is
+    rebuilt layer by layer with sliced weights.
+    '''
+    last_block = max(b for b in map(block_of, model.layers) if b)
+    dropped = set(range(last_block - drop_blocks + 1, last_block + 1))
+    x = inputs = keras.Input(shape=model.input_shape[1:])
+    keep = np.arange(model.input_shape[-1])  # channels of the tensor flowing into the next layer
+    weights = []
+    for layer in model.layers:
+        if isinstance(layer, InputLayer) or block_of(layer) in dropped:
+            continue
+        config = layer.get_config()
+        w = layer.get_weights()
+        if isinstance(layer, Conv2D):
+            out_keep = np.arange(layer.filters)
+            if block_of(layer) in blocks and sparsity:
+                n = max(1, int(round(layer.filters * (1 - sparsity))))
+                out_keep = np.sort(filter_ranking(layer)[:n])
+            config['filters'] = len(out_keep)
+            w = [w[0][:, :, keep][..., out_keep], w[1][out_keep]]
+            keep = out_keep
+        elif isinstance(layer, BatchNormalization):
+            w = [v[keep] for v in w]
+        elif isinstance(layer, Dense):
+            w = [w[0][keep]] + w[1:]
+            keep = np.arange(layer.units)
+        new = layer.__class__.from_config(config)
+        x = new(x)
+        weights.append((new, w))
+    pruned = keras.Model(inputs=inputs, outputs=x)
+    for new, w in weights:
+        if w:
+            new.set_weights(w)
+    return pruned
+
+
+def input_size(model):
+    # (height, width) of the model input, IMG_SIZE for models built for any size (PROGRESSIVE training)
+    _, height, width, _ = model.input_shape
+    return (height, width) if height and width else (IMG_SIZE[1], IMG_SIZE[0])
+
+
+def count_flops(model):
+    # multiply-adds of the conv and dense layers counted as 2 FLOPs, for one image of input_size(model);
+    # shapes are followed through the layer chain so models without a fixed input size work too
+    flops = 0
+    shape = (1,) + input_size(model) + (model.input_shape[-1],)
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            continue
+        out_shape = tuple(layer.compute_output_shape(shape))
+        if isinstance(layer, Conv2D):
+            _, h, w, out = out_shape
+            kh, kw = layer.kernel_size
+            flops += 2 * h * w * kh * kw * shape[-1] * out
+        elif isinstance(layer, Dense):
+            flops += 2 * shape[-1] * layer.units
+        shape = out_shape
+    return flops
+
+
+def fine_tune(model, train_gen, valid_gen, epochs, model_name):
+    model.compile(Adamax(learning_rate=.001), loss='categorical_crossentropy', metrics=['accuracy'])
+    callbacks = [LRA(model=model, patience=1, stop_patience=3, threshold=.9, factor=.5, dwell=True,
+                     model_name=model_name, freeze=False, initial_epoch=0)]
+    LRA.tepochs = epochs
+    model.fit(x=train_gen, epochs=epochs, callbacks=callbacks, verbose=0, validation_data=valid_gen, shuffle=False)
+    callbacks[0].restore_best()
+    return model
+
+
+def measure(name, model, path, test_gen, classes):
+    model.save(path, include_optimizer=False)
+    return {
+        'model': name, 'path': path,
+        'flops': count_flops(model),
+        'params': int(model.count_params()),
+        'size_mb': os.path.getsize(path) / 2**20,
+        'latency_ms': latency_ms(model, input_shape=input_size(model) + (model.input_shape[-1],)),
+        'accuracy': evaluate_model(model, test_gen, classes)['accuracy'],
+    }
+
+
+def run(model_path, split_file, sparsities, blocks=(3, 4, 5), drop_blocks=0, epochs=10, batch_size=32):
+    splits = load_splits(None, split_file)
+    model = load_model(model_path)
+    img_size = input_size(model)
+    gen = ImageDataGenerator(preprocessing_function=scalar)
+    flow = dict(x_col='filepaths', y_col='labels', target_size=img_size, class_mode='categorical',
+                batch_size=batch_size)
+    train_gen = gen.flow_from_dataframe(splits['train'], shuffle=True, **flow)
+    valid_gen = gen.flow_from_dataframe(splits['val'], shuffle=True, **flow)
+    test_gen = gen.flow_from_dataframe(splits['test'], shuffle=False, **flow)
+    classes = list(train_gen.class_indices.keys())
+
+    stem = os.path.splitext(model_path)[0]
+    results = [measure('unpruned', model, stem + '-dense.h5', test_gen, classes)]
+    for sparsity in sparsities:
+        name = f'pruned-{int(sparsity * 100)}' + (f'-drop{drop_blocks}' if drop_blocks else '')
+        pruned = prune(model, sparsity, blocks, drop_blocks)
+        print(f'{name}: {pruned.count_params():,d} parameters, fine-tuning...')
+        fine_tune(pruned, train_gen, valid_gen, epochs, 'VGG19-' + name)
+        results.append(measure(name, pruned, f'{stem}-{name}.h5', test_gen, classes))
+
+    base = results[0]
+    print(f'{"Model":<22s}{"GFLOPs":>8s}{"params":>13s}{"MB":>8s}{"ms/img":>8s}{"acc %":>8s}{"d acc":>8s}')
+    for r in results:
+        print(f'{r["model"]:<22s}{r["flops"] / 1e9:>8.2f}{r["params"]:>13,d}{r["size_mb"]:>8.1f}'
+              f'{r["latency_ms"]:>8.1f}{r["accuracy"] * 100:>8.2f}{(r["accuracy"] - base["accuracy"]) * 100:>+8.2f}')
+    with open(stem + '-pruning.json', 'w') as f:
+        json.dump({'blocks': list(blocks), 'drop_blocks': drop_blocks, 'results': results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prune VGG19 filters, fine-tune and report the savings')
+    parser.add_argument('model', help='VGG19 .h5 model written by main1.py')
+    parser.add_argument('--split-file', required=True, help='split manifest written by split.py')
+    parser.add_argument('--sparsity', type=float, nargs='+', default=[0.25, 0.5, 0.75],
+                        help='fraction of the filters removed from each pruned conv layer')
+    parser.add_argument('--blocks', default='3,4,5', help='VGG19 blocks whose conv layers are pruned')
+    parser.add_argument('--drop-blocks', type=int, default=0, choices=(0, 1), help='remove block 5 entirely')
+    parser.add_argument('--epochs', type=int, default=10, help='fine-tuning epochs per sparsity level')
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+
+    run(args.model, args.split_file, args.sparsity, tuple(int(b) for b in args.blocks.split(',')),
+        args.drop_blocks, args.epochs, args.batch_size)
@@ -0,0 +1,150 @@
+'''
+Post-training quantization of the keras models to TFLite, and a comparison harness.
+
+export writes <name>-float16.tflite and <name>-int8.tflite next to each model (or into --out-dir).
+The int8 variant is fully integer, calibrated on a sample of real images.
+
+    python quantize.py export ../model.h5 ../modelGAN-C.h5 VGG19-fruits-99.00.h5 --calibration /data/lung/train
+
+compare runs every given model (h5 or tflite) over a test split and reports accuracy, the
+confusion matrix and its difference to the first model, file size, load time and per-image latency.
+
+    python quantize.py compare ../model.h5 ../model-float16.tflite ../model-int8.tflite --test-dir /data/lung/test
+'''
+import argparse
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from inference import IMG_SIZE, load_image, load_inference_model
+from pixel_cache import list_directory
+
+
+def input_size(model):
+    # (width, height) for PIL, from the model's (None, height, width, 3) input; IMG_SIZE for models
+    # built for any size
+    _, height, width, _ = model.input_shape
+    return (width, height) if height and width else IMG_SIZE
+
+
+def calibration_images(directory, size, samples=200, seed=123):
+    filepaths, _ = list_directory(directory)
+    random.Random(seed).shuffle(filepaths)
+    for path in filepaths[:samples]:
+        yield load_image(path, size)
+
+
+def export(model_path, calibration_dir, out_dir=None, samples=200):
+    import tensorflow as tf
+    from keras.models import load_model
+
+    model = load_model(model_path)
+    size = input_size(model)
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    out_dir = out_dir or os.path.dirname(os.path.abspath(model_path))
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+    written.append(_write(converter.convert(), os.path.join(out_dir, f'{stem}-float16.tflite')))
+
+    def representative_dataset():
+        for image in calibration_images(calibration_dir, size, samples):
+            yield [image[np.newaxis]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    written.append(_write(converter.convert(), os.path.join(out_dir, f'{stem}-int8.tflite')))
+    return written
+
+
+def _write(data, path):
+    with open(path, 'wb') as f:
+        f.write(data)
+    print(f'Wrote {path} ({len(data) / 2**20:.1f} MB)')
+    return path
+
+
+def evaluate(model_path, test_dir, batch_size=32, latency_samples=50):
+    start = time.perf_counter()
+    model = load_inference_model(model_path)
+    load_time = time.perf_counter() - start
+    size = input_size(model)
+
+    filepaths, labels = list_directory(test_dir)
+    class_names = sorted(set(labels))  # same order as the training class_indices
+    y_true = np.array([class_names.index(l) for l in labels])
+    num_classes = len(class_names)
+    cm = np.zeros((num_classes, num_classes), dtype=np.int64)
+    for i in range(0, len(filepaths), batch_size):
+        batch = np.stack([load_image(p, size) for p in filepaths[i:i + batch_size]])
+        y_pred = np.argmax(model.predict_on_batch(batch), axis=1)
+        np.add.at(cm, (y_true[i:i + batch_size], y_pred), 1)
+
+    # per-image CPU latency: batch of one, like gui.classify
+    latencies = []
+    for path in filepaths[:latency_samples]:
+        image = load_image(path, size)[np.newaxis]
+        start = time.perf_counter()
+        model.predict_on_batch(image)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies[1:] or latencies) * 1000  # the first call includes graph warm-up
+
+    return {
+        'model': model_path,
+        'size_mb': os.path.getsize(model_path) / 2**20,
+        'load_time_s': load_time,
+        'accuracy': float(np.trace(cm) / cm.sum()),
+        'latency_ms': {'p50': float(np.percentile(latencies, 50)), 'p95': float(np.percentile(latencies, 95))},
+        'classes': class_names,
+        'confusion_matrix': cm.tolist(),
+    }
+
+
+def compare(model_paths, test_dir, report=None):
+    results = [evaluate(p, test_dir) for p in model_paths]
+    reference = np.array(results[0]['confusion_matrix'])
+    for r in results:
+        r['confusion_matrix_delta'] = (np.array(r['confusion_matrix']) - reference).tolist()
+        r['accuracy_delta'] = r['accuracy'] - results[0]['accuracy']
+
+    print(f'{"Model":<40s}{"MB":>8s}{"load s":>8s}{"acc %":>8s}{"d acc":>8s}{"p50 ms":>8s}{"p95 ms":>8s}')
+    for r in results:
+        print(f'{os.path.basename(r["model"]):<40s}{r["size_mb"]:>8.1f}{r["load_time_s"]:>8.2f}'
+              f'{r["accuracy"] * 100:>8.2f}{r["accuracy_delta"] * 100:>+8.2f}'
+              f'{r["latency_ms"]["p50"]:>8.1f}{r["latency_ms"]["p95"]:>8.1f}')
+        print('  confusion matrix delta:', r['confusion_matrix_delta'])
+    if report:
+        with open(report, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize models to TFLite and compare the variants')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('export', help='write float16 and int8 TFLite variants of keras models')
+    p.add_argument('models', nargs='+')
+    p.add_argument('--calibration', required=True, help='image folder (one sub-folder per class) for int8 calibration')
+    p.add_argument('--samples', type=int, default=200, help='calibration images')
+    p.add_argument('--out-dir')
+    p = sub.add_parser('compare', help='accuracy, size, load time and latency of models on a test split')
+    p.add_argument('models', nargs='+', help='the first one is the reference for the deltas')
+    p.add_argument('--test-dir', required=True)
+    p.add_argument('--report', help='write the full results as JSON')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        for path in args.models:
+            export(path, args.calibration, args.out_dir, args.samples)
+    else:
+        compare(args.models, args.test_dir, args.report)
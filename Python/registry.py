@@ -0,0 +1,168 @@
+'''
+Registry of the classification models available on this machine.
+
+discover() finds .h5 and .tflite files in the search folders (the repository root with model.h5
+and modelGAN-C.h5, this folder, and the folder of DEFAULT_MODEL) and records for each its input size
+and class map without loading it: the input shape is read from the keras config stored in the .h5
+(h5py only, no TensorFlow import) and the classes from an optional <model>.json next to the file
+({"classes": ["Lung aca", ...]}), falling back to the three lung classes. The records are kept in
+model_registry.json, keyed by path, size and mtime, so later starts do not open the files again.
+
+get() loads a model the first time it is asked for, runs one warm-up predict so the first real
+request does not pay for graph tracing, and keeps at most `capacity` models in memory (least
+recently used ones are dropped). Load time and first-predict latency are logged per model.
+Switching the active model is a set_active() call; the next request loads it if needed.
+'''
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from inference import DEFAULT_MODEL, IMG_SIZE, load_inference_model, lung_cancer_type
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SEARCH_DIRS = [os.path.dirname(HERE), HERE, os.path.dirname(DEFAULT_MODEL)]
+INDEX_PATH = os.path.join(HERE, 'model_registry.json')
+MODEL_EXTENSIONS = ('.h5', '.tflite')
+
+
+def read_input_size(path):
+    # (width, height) from the model config saved in a keras .h5, None when it cannot be read cheaply
+    if not path.endswith('.h5'):
+        return None
+    try:
+        import h5py
+        with h5py.File(path, 'r') as f:
+            config = f.attrs.get('model_config')
+        if config is None:
+            return None
+        config = json.loads(config.decode() if isinstance(config, bytes) else config)
+        layers = config['config']['layers'] if 'layers' in config['config'] else []
+        for layer in layers:
+            shape = layer['config'].get('batch_input_shape') or layer['config'].get('batch_shape')
+            if shape and len(shape) == 4:
+                # None for models built for any size (PROGRESSIVE training), they get IMG_SIZE
+                return (shape[2], shape[1]) if shape[1] and shape[2] else None
+    except Exception:
+        return None
+    return None
+
+
+def read_classes(path):
+    sidecar = os.path.splitext(path)[0] + '.json'
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            return list(json.load(f)['classes'])
+    return list(lung_cancer_type)
+
+
+class ModelRegistry:
+    def __init__(self, search_dirs=None, capacity=2, index_path=INDEX_PATH, log=print):
+        self.search_dirs = search_dirs or SEARCH_DIRS
+        self.capacity = capacity
+        self.index_path = index_path
+        self.log = log
+        self.models = {}  # name -> info dict
+        self.loaded = OrderedDict()  # name -> model, most recently used last
+        self.stats = {}  # name -> {'load_s', 'warmup_ms'}
+        self.lock = threading.RLock()
+        self.active = None
+
+    def discover(self):
+        start = time.perf_counter()
+        index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+        models = {}
+        seen = set()
+        for directory in self.search_dirs:
+            if not os.path.isdir(directory):
+                continue
+            for f in sorted(os.listdir(directory)):
+                path = os.path.realpath(os.path.join(directory, f))
+                if not f.endswith(MODEL_EXTENSIONS) or path in seen:
+                    continue
+                seen.add(path)
+                st = os.stat(path)
+                info = index.get(path)
+                if info is None or info['size'] != st.st_size or info['mtime_ns'] != st.st_mtime_ns:
+                    info = {'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                            'input_size': read_input_size(path), 'classes': read_classes(path)}
+                name = f if f not in models else os.path.relpath(path, os.path.dirname(HERE))
+                models[name] = dict(info, name=name)
+        with self.lock:
+            self.models = models
+            if self.active not in models:
+                self.active = next(iter(models), None)
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({m['path']: {k: v for k, v in m.items() if k != 'name'} for m in models.values()}, f, indent=2)
+        os.replace(tmp, self.index_path)
+        self.log(f'Found {len(models)} model(s) in {(time.perf_counter() - start) * 1000:.0f} ms: {", ".join(models)}')
+        return list(models)
+
+    def names(self):
+        with self.lock:
+            return list(self.models)
+
+    def resolve(self, name_or_path):
+        # registry name, or a file path that is added to the registry on the fly; under the lock, since
+        # batch_infer and the GUI worker resolve from their own threads while get() loads
+        with self.lock:
+            if name_or_path in self.models:
+                return name_or_path
+            path = os.path.realpath(name_or_path)
+            for name, info in self.models.items():
+                if info['path'] == path:
+                    return name
+            if not os.path.exists(path):
+                raise KeyError(f'unknown model {name_or_path!r}, known: {", ".join(self.models)}')
+            name = os.path.basename(path)
+            st = os.stat(path)
+            self.models[name] = {'name': name, 'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                                 'input_size': read_input_size(path), 'classes': read_classes(path)}
+            return name
+
+    def info(self, name=None):
+        with self.lock:
+            return self.models[name or self.active]
+
+    def set_active(self, name_or_path):
+        with self.lock:
+            self.active = self.resolve(name_or_path)
+        return self.active
+
+    def get(self, name=None):
+        '''
+        Returns (model, info) for name (default: the active model), loading and warming it up if needed.
+        '''
+        with self.lock:
+            name = self.resolve(name or self.active)
+            if name in self.loaded:
+                self.loaded.move_to_end(name)
+                return self.loaded[name], self.models[name]
+            info = self.models[name]
+            start = time.perf_counter()
+            model = load_inference_model(info['path'])
+            load_s = time.perf_counter() - start
+            _, height, width, channels = model.input_shape
+            if height and width:
+                info['input_size'] = (width, height)  # authoritative once loaded (tflite files, odd configs)
+            width, height = self.input_size(name)
+            start = time.perf_counter()
+            model.predict_on_batch(np.zeros((1, height, width, channels), dtype=np.float32))
+            warmup_ms = (time.perf_counter() - start) * 1000
+            self.stats[name] = {'load_s': load_s, 'warmup_ms': warmup_ms}
+            self.log(f'Loaded {name} in {load_s:.2f} s, first predict {warmup_ms:.0f} ms')
+            self.loaded[name] = model
+            while len(self.loaded) > self.capacity:
+                evicted, _ = self.loaded.popitem(last=False)
+                self.log(f'Unloaded {evicted}')
+            return model, info
+
+    def input_size(self, name=None):
+        return tuple(self.info(name)['input_size'] or IMG_SIZE)
@@ -0,0 +1,179 @@
+'''
+Local HTTP inference server with dynamic micro-batching.
+
+Loads the model once and accepts raw image uploads. Concurrent requests are coalesced into one
+predict call of at most --max-batch images, waiting at most --max-wait-ms for a batch to fill.
+
+    python serve.py --model model.h5 --port 8500
+    curl --data-binary @tile.jpg http://localhost:8500/predict
+
+Endpoints:
+    POST /predict   image bytes in the body, returns the class and the gui.py probability dictionary
+    GET  /stats     p50/p95/p99 latency and the batch-size histogram
+    GET  /health    200 once the model is loaded
+'''
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+from inference import DEFAULT_MODEL, IMG_SIZE, classes, load_inference_model, lung_cancer_type, preprocess
+
+
+class MicroBatcher:
+    '''
+    Collects preprocessed images from many request threads and runs them through the model in
+    batches. A batch is sent as soon as it is full or max_wait seconds after its first image.
+    '''
+    def __init__(self, model, max_batch=32, max_wait=0.005, history=10000):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=history)  # seconds, from arrival to response
+        self.batch_sizes = Counter()
+        self.requests = 0
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def submit(self, image):
+        future = Future()
+        self.queue.put((image, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        items = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(items) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            try:
+                probs = np.asarray(self.model.predict_on_batch(np.stack([image for image, _, _ in items])))
+            except Exception as e:
+                for _, future, _ in items:
+                    future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            with self.lock:
+                self.batch_sizes[len(items)] += 1
+                self.requests += len(items)
+                self.latencies.extend(now - arrived for _, _, arrived in items)
+            for (_, future, _), p in zip(items, probs):
+                future.set_result(p)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+            requests = self.requests
+        percentiles = {}
+        if len(latencies):
+            percentiles = {f'p{q}': float(np.percentile(latencies, q)) for q in (50, 95, 99)}
+        batches = sum(batch_sizes.values())
+        return {
+            'requests': requests,
+            'batches': batches,
+            'mean_batch_size': requests / batches if batches else 0.0,
+            'latency_ms': percentiles,
+            'batch_size_histogram': batch_sizes,
+            'max_batch': self.max_batch,
+            'max_wait_ms': self.max_wait * 1000,
+        }
+
+
+def prediction(probs):
+    # same dictionary gui.classify builds, plus the winning class
+    dictionary = {k: float(p) for k, p in zip(lung_cancer_type, probs)}
+    index = int(np.argmax(probs))
+    return {'class': lung_cancer_type[index], 'label': classes[index], 'probabilities': dictionary}
+
+
+def input_size(model):
+    # (width, height) the model was built for, IMG_SIZE for models built for any size
+    _, height, width, _ = model.input_shape
+    return (width, height) if height and width else IMG_SIZE
+
+
+class Handler(BaseHTTPRequestHandler):
+    batcher = None
+    input_size = IMG_SIZE
+    timeout_s = 30.0
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send(200, self.batcher.stats())
+        elif self.path == '/health':
+            self._send(200, {'status': 'ok'})
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send(404, {'error': 'not found'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            # decoding happens here on the request thread, so it runs in parallel across clients
+            with Image.open(io.BytesIO(self.rfile.read(length))) as image:
+                pixels = preprocess(image, self.input_size)
+        except Exception as e:
+            self._send(400, {'error': f'could not decode image: {e}'})
+            return
+        try:
+            probs = self.batcher.submit(pixels).result(timeout=self.timeout_s)
+        except Exception as e:
+            self._send(500, {'error': str(e)})
+            return
+        self._send(200, prediction(probs))
+
+    def log_message(self, format, *args):
+        pass  # one line per request is too noisy under load
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the lung tissue classifier over HTTP on localhost')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='.h5 model or quantized .tflite')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8500)
+    parser.add_argument('--max-batch', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    model = load_inference_model(args.model)
+    Handler.batcher = MicroBatcher(model, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000)
+    Handler.input_size = input_size(model)  # 180x180 for the main.py CNN, 224x224 for VGG19
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f'Serving {args.model} on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,14 @@
+import os
+
+
+def env(name, default):
+    # returns the environment override for a script constant, cast to the type of the default
+    # e.g. IMG_H=224 python main.py
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if default is None:
+        return value
+    return type(default)(value)
@@ -0,0 +1,432 @@
+'''
+Packed dataset: a split stored as a few large TFRecord shards plus an offset index.
+
+Reading 15,000 small JPEGs one file at a time is slow on a network filesystem, and so is copying
+the tree to every training node. pack() writes each split (the train/val/test folders main.py
+reads, or the split.csv written by split.py) into --shards files of the original, undecoded JPEG
+bytes. Images are dealt to the shards in a seeded random order, so every shard holds a mix of all
+classes and interleaving a few of them is already well shuffled.
+
+Every shard is self-describing: its first record is a header with the class map and the shard's
+record count, and every image record carries its class index and original path. Next to the shards
+<split>.index.json records for every shard the byte offset, label and path of each record, so
+single samples are read with one seek (ShardReader) and the training scripts know the split without
+listing anything. The index can be rebuilt from the shards alone (python shards.py index).
+
+make_shard_dataset() streams the shards with a parallel interleave and a shuffle buffer of
+serialized records, then decodes and augments like tf_pipeline.make_dataset. main.py and main1.py
+use it with LOADER=shards and SHARD_DIR.
+
+    python shards.py pack /home/andrei/Desktop/ProiectLicenta/lung_image_sets packed --shards 8
+    python shards.py pack --split-file ../split.csv packed
+    python shards.py unpack packed unpacked
+    python shards.py bench packed --split-file ../split.csv
+'''
+import argparse
+import json
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from tf_pipeline import AUTOTUNE, batch_and_augment, decode_bytes, make_dataset
+
+FORMAT_VERSION = 1
+SPLITS = ('train', 'val', 'test')
+
+RECORD_FEATURES = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.int64),
+    'path': tf.io.FixedLenFeature([], tf.string),
+}
+
+
+def shard_name(split, index, count):
+    return f'{split}-{index:05d}-of-{count:05d}.tfrecord'
+
+
+def index_path(shard_dir, split):
+    return os.path.join(shard_dir, f'{split}.index.json')
+
+
+def _bytes(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def header_record(split, shard, count, class_indices):
+    header = {'format': FORMAT_VERSION, 'split': split, 'shard': shard, 'count': count,
+              'class_indices': class_indices}
+    return tf.train.Example(features=tf.train.Features(feature={
+        'header': _bytes(json.dumps(header).encode())})).SerializeToString()
+
+
+def image_record(data, label, path):
+    return tf.train.Example(features=tf.train.Features(feature={
+        'image': _bytes(data), 'label': _int(label), 'path': _bytes(path.encode())})).SerializeToString()
+
+
+def record_size(record):
+    # TFRecord framing: length (8 bytes), its crc (4), data, data crc (4)
+    return 16 + len(record)
+
+
+def read_record(f):
+    # the record at the current position of f, None at the end of the file; crcs are not checked
+    head = f.read(12)
+    if len(head) < 12:
+        return None
+    length, = struct.unpack('<Q', head[:8])
+    data = f.read(length)
+    f.seek(4, os.SEEK_CUR)
+    return data
+
+
+def parse_header(record):
+    example = tf.train.Example.FromString(record)
+    return json.loads(example.features.feature['header'].bytes_list.value[0])
+
+
+def parse_image(record):
+    feature = tf.train.Example.FromString(record).features.feature
+    return (feature['image'].bytes_list.value[0], int(feature['label'].int64_list.value[0]),
+            feature['path'].bytes_list.value[0].decode())
+
+
+def write_shard(path, split, shard, filepaths, labels, class_indices):
+    offsets = []
+    nbytes = 0
+    position = 0
+    with tf.io.TFRecordWriter(path) as writer:
+        header = header_record(split, shard, len(filepaths), class_indices)
+        writer.write(header)
+        position += record_size(header)
+        for filepath, label in zip(filepaths, labels):
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            record = image_record(data, class_indices[label], filepath)
+            writer.write(record)
+            offsets.append(position)
+            position += record_size(record)
+            nbytes += len(data)
+    return {'file': os.path.basename(path), 'count': len(filepaths), 'offsets': offsets,
+            'labels': [class_indices[l] for l in labels], 'paths': list(filepaths)}, nbytes
+
+
+def pack(splits, out_dir, num_shards=8, seed=123, class_indices=None, workers=None):
+    '''
+    Writes splits ({split: (filepaths, labels)}) into num_shards TFRecord shards each, with one
+    class map shared by all splits, and returns (images, bytes, seconds).
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    if class_indices is None:
+        names = sorted({str(l) for _, labels in splits.values() for l in labels})
+        class_indices = {klass: i for i, klass in enumerate(names)}
+    rng = np.random.default_rng(seed)
+    images = nbytes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers or min(num_shards, os.cpu_count() or 1)) as pool:
+        for split, (filepaths, labels) in splits.items():
+            filepaths = [str(p) for p in filepaths]
+            labels = [str(l) for l in labels]
+            count = max(1, min(num_shards, len(filepaths)))
+            order = rng.permutation(len(filepaths))
+            futures = []
+            for shard in range(count):
+                chosen = order[shard::count]
+                futures.append(pool.submit(write_shard, os.path.join(out_dir, shard_name(split, shard, count)), split,
+                                           shard, [filepaths[i] for i in chosen], [labels[i] for i in chosen],
+                                           class_indices))
+            shards = []
+            for future in futures:
+                entry, written = future.result()
+                shards.append(entry)
+                nbytes += written
+            write_index(out_dir, split, class_indices, shards)
+            images += len(filepaths)
+            print(f'{split}: {len(filepaths)} images in {count} shards')
+    return images, nbytes, time.perf_counter() - start
+
+
+def write_index(shard_dir, split, class_indices, shards):
+    path = index_path(shard_dir, split)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'format': FORMAT_VERSION, 'split': split, 'class_indices': class_indices, 'shards': shards}, f)
+    os.replace(tmp, path)
+
+
+def read_index(shard_dir, split):
+    with open(index_path(shard_dir, split)) as f:
+        return json.load(f)
+
+
+def scan_shard(path):
+    # rebuilds a shard's index entry and header from the shard file alone
+    offsets, labels, paths = [], [], []
+    with open(path, 'rb') as f:
+        header = parse_header(read_record(f))
+        while True:
+            position = f.tell()
+            record = read_record(f)
+            if record is None:
+                break
+            _, label, filepath = parse_image(record)
+            offsets.append(position)
+            labels.append(label)
+            paths.append(filepath)
+    if len(offsets) != header['count']:
+        raise ValueError(f'{path}: header says {header["count"]} records, found {len(offsets)}')
+    return header, {'file': os.path.basename(path), 'count': len(offsets), 'offsets': offsets, 'labels': labels,
+                    'paths': paths}
+
+
+def rebuild_index(shard_dir, split):
+    files = sorted(f for f in os.listdir(shard_dir) if f.startswith(f'{split}-') and f.endswith('.tfrecord'))
+    if not files:
+        raise FileNotFoundError(f'no {split} shards in {shard_dir}')
+    shards = []
+    class_indices = None
+    for f in files:
+        header, entry = scan_shard(os.path.join(shard_dir, f))
+        if class_indices is not None and header['class_indices'] != class_indices:
+            raise ValueError(f'{f} has a different class map than the other {split} shards')
+        class_indices = header['class_indices']
+        shards.append(entry)
+    write_index(shard_dir, split, class_indices, shards)
+    return shards
+
+
+def shard_files(shard_dir, split):
+    '''
+    (filepaths, labels) of a packed split in shard order, from its index; the same lists
+    split_files holds in main.py.
+    '''
+    index = read_index(shard_dir, split)
+    names = {i: klass for klass, i in index['class_indices'].items()}
+    filepaths = [p for shard in index['shards'] for p in shard['paths']]
+    labels = [names[l] for shard in index['shards'] for l in shard['labels']]
+    return filepaths, labels
+
+
+class ShardReader:
+    '''
+    Random access to the samples of a packed split: reader[i] returns (jpeg bytes, label, path)
+    of the i-th sample in shard order with one seek and one read.
+    '''
+    def __init__(self, shard_dir, split):
+        index = read_index(shard_dir, split)
+        self.class_indices = index['class_indices']
+        self.paths = [os.path.join(shard_dir, shard['file']) for shard in index['shards']]
+        counts = [shard['count'] for shard in index['shards']]
+        self.starts = np.cumsum([0] + counts)
+        self.offsets = np.concatenate([np.asarray(s['offsets'], dtype=np.int64) for s in index['shards']]) \
+            if counts else np.empty(0, dtype=np.int64)
+        self.files = {}
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i %= len(self)
+        shard = int(np.searchsorted(self.starts, i, side='right')) - 1
+        f = self.files.get(shard)
+        if f is None:
+            f = self.files[shard] = open(self.paths[shard], 'rb')
+        f.seek(int(self.offsets[i]))
+        return parse_image(read_record(f))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+def make_shard_dataset(shard_dir, split, gen, target_size, batch_size=32, shuffle=True, seed=123,
+                       class_indices=None, shuffle_buffer=1024, cycle_length=4, num_workers=1, worker_index=0):
+    '''
+    Batched, prefetching dataset of (images, one-hot labels) read from the shards of a split.
+
+    With shuffle the shard order is reshuffled every epoch, cycle_length shards are read in
+    parallel and interleaved record by record, and the serialized records pass a shuffle buffer
+    before they are decoded. Without shuffle the shards are read one after the other, so batches
+    follow the order of ds.filenames. num_workers/worker_index give every worker of a multi-worker
+    run its own shards, cut to the same number of records on every worker.
+    Carries class_indices, classes, labels, filenames, n and batch_size like make_dataset.
+    '''
+    index = read_index(shard_dir, split)
+    if class_indices is not None and dict(class_indices) != index['class_indices']:
+        raise ValueError(f'the {split} shards were packed with a different class map')
+    class_indices = index['class_indices']
+    shards = index['shards']
+    if num_workers > 1:
+        if len(shards) < num_workers:
+            raise ValueError(f'{len(shards)} {split} shards cannot be split over {num_workers} workers')
+        records = min(sum(s['count'] for s in shards[w::num_workers]) for w in range(num_workers))
+        shards = shards[worker_index::num_workers]
+    else:
+        records = sum(s['count'] for s in shards)
+    files = [os.path.join(shard_dir, s['file']) for s in shards]
+    classes = np.array([l for s in shards for l in s['labels']], dtype='int32')[:records]
+    filenames = [p for s in shards for p in s['paths']][:records]
+
+    def read(path):
+        return tf.data.TFRecordDataset(path, buffer_size=8 * 2**20).skip(1)  # the first record is the header
+
+    def parse(record):
+        sample = tf.io.parse_single_example(record, RECORD_FEATURES)
+        return decode_bytes(sample['image'], target_size), tf.cast(sample['label'], tf.int32)
+
+    ds = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle:
+        ds = ds.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+        ds = ds.interleave(read, cycle_length=min(cycle_length, len(files)), block_length=1,
+                           num_parallel_calls=AUTOTUNE, deterministic=True)
+    else:
+        ds = ds.flat_map(read)
+    ds = ds.take(records)
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    ds = ds.map(parse, num_parallel_calls=AUTOTUNE)
+    ds = batch_and_augment(ds, gen, len(class_indices), batch_size, seed)
+
+    ds.class_indices = class_indices
+    ds.classes = classes
+    ds.labels = classes
+    ds.filenames = filenames
+    ds.n = records
+    ds.batch_size = batch_size
+    return ds
+
+
+def unpack(shard_dir, out_dir, splits=SPLITS):
+    '''
+    Writes the packed images back to out_dir/<split>/<class>/<file name>, reading every shard
+    sequentially, and returns (images, bytes, seconds).
+    '''
+    images = nbytes = 0
+    start = time.perf_counter()
+    for split in splits:
+        if not os.path.exists(index_path(shard_dir, split)):
+            continue
+        index = read_index(shard_dir, split)
+        names = {i: klass for klass, i in index['class_indices'].items()}
+        for klass in names.values():
+            os.makedirs(os.path.join(out_dir, split, klass), exist_ok=True)
+        for shard in index['shards']:
+            with open(os.path.join(shard_dir, shard['file']), 'rb') as f:
+                read_record(f)  # header
+                while True:
+                    record = read_record(f)
+                    if record is None:
+                        break
+                    data, label, path = parse_image(record)
+                    with open(os.path.join(out_dir, split, names[label], os.path.basename(path)), 'wb') as out:
+                        out.write(data)
+                    images += 1
+                    nbytes += len(data)
+    return images, nbytes, time.perf_counter() - start
+
+
+def throughput(images, nbytes, seconds):
+    return f'{images} images, {nbytes / 2**20:.0f} MiB in {seconds:.1f} s ({images / seconds:.0f} images/s, ' \
+           f'{nbytes / 2**20 / seconds:.0f} MiB/s)'
+
+
+def images_per_second(ds, batches):
+    it = iter(ds)
+    next(it)  # first batch pays for opening files and tracing
+    start = time.perf_counter()
+    images = 0
+    for _ in range(batches):
+        images += int(next(it)[0].shape[0])
+    return images / (time.perf_counter() - start)
+
+
+def bench(shard_dir, filepaths, labels, target_size=(224, 224), batch_size=32, batches=50, split='train'):
+    '''
+    Training-time input throughput of the loose JPEGs (tf_pipeline.make_dataset) against the shards
+    of the same split, both decoding, resizing and shuffling with the same ImageDataGenerator, plus
+    random-access reads per second from the shards.
+    '''
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+    gen = ImageDataGenerator(rescale=1./255, horizontal_flip=True)
+    loose = make_dataset(filepaths, labels, gen, target_size, batch_size=batch_size, shuffle=True).repeat()
+    packed = make_shard_dataset(shard_dir, split, gen, target_size, batch_size=batch_size, shuffle=True).repeat()
+    results = {'files': images_per_second(loose, batches), 'shards': images_per_second(packed, batches)}
+
+    reader = ShardReader(shard_dir, split)
+    picks = np.random.default_rng(0).integers(0, len(reader), min(1000, len(reader)))
+    start = time.perf_counter()
+    for i in picks:
+        reader[int(i)]
+    results['random_reads'] = len(picks) / (time.perf_counter() - start)
+    reader.close()
+
+    print(f'Files:  {results["files"]:.0f} images/s')
+    print(f'Shards: {results["shards"]:.0f} images/s ({results["shards"] / results["files"]:.2f}x)')
+    print(f'Random access: {results["random_reads"]:.0f} samples/s')
+    return results
+
+
+def load_splits(data, split_file):
+    # {split: (filepaths, labels)} from a split manifest or the train/val/test folders of main.py
+    if split_file:
+        import pandas as pd
+        split_df = pd.read_csv(split_file)
+        return {name: (list(group['filepaths']), list(group['labels'])) for name, group in split_df.groupby('split')}
+    from manifest import open_manifest
+    manifest = open_manifest(data)
+    return {name: manifest.list(os.path.join(data, name)) for name in SPLITS if os.path.isdir(os.path.join(data, name))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the image dataset into TFRecord shards')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('pack', help='write train/val/test into shards')
+    p.add_argument('data', nargs='?', help='dataset root with train/val/test folders')
+    p.add_argument('out_dir')
+    p.add_argument('--split-file', help='split manifest written by split.py, used instead of the folders')
+    p.add_argument('--shards', type=int, default=8, help='shards per split')
+    p.add_argument('--seed', type=int, default=123)
+    p = commands.add_parser('unpack', help='write the packed images back to <split>/<class> folders')
+    p.add_argument('shard_dir')
+    p.add_argument('out_dir')
+    p = commands.add_parser('index', help='rebuild the offset indexes from the shards')
+    p.add_argument('shard_dir')
+    p = commands.add_parser('bench', help='compare input throughput of the loose files and the shards')
+    p.add_argument('shard_dir')
+    p.add_argument('data', nargs='?', help='dataset root with train/val/test folders')
+    p.add_argument('--split-file')
+    p.add_argument('--split', default='train')
+    p.add_argument('--size', type=int, default=224)
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--batches', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        if not args.data and not args.split_file:
+            parser.error('pack needs the dataset root or --split-file')
+        images, nbytes, seconds = pack(load_splits(args.data, args.split_file), args.out_dir, args.shards, args.seed)
+        print(f'Packed {throughput(images, nbytes, seconds)}')
+    elif args.command == 'unpack':
+        images, nbytes, seconds = unpack(args.shard_dir, args.out_dir)
+        print(f'Unpacked {throughput(images, nbytes, seconds)}')
+    elif args.command == 'index':
+        for split in SPLITS:
+            if any(f.startswith(f'{split}-') for f in os.listdir(args.shard_dir)):
+                shards = rebuild_index(args.shard_dir, split)
+                print(f'{split}: {sum(s["count"] for s in shards)} records in {len(shards)} shards')
+    else:
+        if not args.data and not args.split_file:
+            parser.error('bench needs the dataset root or --split-file to read the loose files')
+        filepaths, labels = load_splits(args.data, args.split_file)[args.split]
+        bench(args.shard_dir, filepaths, labels, (args.size, args.size), args.batch_size, args.batches, args.split)
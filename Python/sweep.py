@@ -0,0 +1,221 @@
+'''
+Hyperparameter sweep over the main.py CNN or the main1.py VGG19 model with successive halving.
+
+Configurations are sampled from a search space (built in below, or a JSON file with the same
+layout: a list is a choice, ["log", low, high] is log-uniform, ["uniform", low, high] uniform);
+parameters the space leaves out keep the values of the scripts.
+Every configuration trains for --min-epochs, the best 1/eta continue for eta times as many epochs
+from their saved weights, and so on until --max-epochs or a single configuration is left.
+
+Trials run in a pool of spawned processes, cores // --threads-per-trial of them, each with its
+TensorFlow and OpenMP thread pools limited to --threads-per-trial. The train and validation images
+are decoded once into the pixel cache for every input size in the space before the pool starts;
+trials read them from the shared memory maps. After every rung the leaderboard CSV is rewritten
+with the parameters, rung, epochs, validation metrics and accumulated wall-clock seconds per trial.
+
+    python sweep.py cnn --trials 27 --min-epochs 1 --max-epochs 9
+    python sweep.py vgg19 --split-file ../split.csv --space space.json --threads-per-trial 4
+'''
+import argparse
+import csv
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from distill import PATH, load_splits, scalar
+from pixel_cache import build_cache
+
+SPACES = {
+    # main.py: batch_size, INIT_LR and IMG_H/IMG_W
+    'cnn': {
+        'batch_size': [8, 16, 32],
+        'learning_rate': ['log', 1e-4, 3e-3],
+        'img_size': [128, 180],
+    },
+    # main1.py: the LRA schedule and the head regularization
+    'vgg19': {
+        'batch_size': [16, 32],
+        'learning_rate': ['log', 1e-4, 3e-3],
+        'patience': [1, 2],
+        'factor': [.3, .5, .7],
+        'threshold': [.8, .9, .95],
+        'l2': ['log', 1e-3, 3e-2],
+        'l1': ['log', 1e-4, 1e-2],
+        'dropout': [.3, .45, .6],
+        'img_size': [224],
+    },
+}
+
+# the values hard-coded in main.py and main1.py, used for anything a search space leaves out
+DEFAULTS = {
+    'cnn': {'batch_size': 8, 'learning_rate': 1e-3, 'img_size': 180},
+    'vgg19': {'batch_size': 32, 'learning_rate': 1e-3, 'patience': 1, 'factor': .5, 'threshold': .9, 'l2': 0.016,
+              'l1': 0.006, 'dropout': .45, 'img_size': 224},
+}
+
+_splits = None  # (train, val) file lists of the worker process
+
+
+def sample(space, rng):
+    config = {}
+    for name, spec in space.items():
+        if spec and spec[0] == 'log':
+            config[name] = math.exp(rng.uniform(math.log(spec[1]), math.log(spec[2])))
+        elif spec and spec[0] == 'uniform':
+            config[name] = rng.uniform(spec[1], spec[2])
+        else:
+            config[name] = rng.choice(spec)
+    return config
+
+
+def init_worker(path, split_file, threads):
+    # runs first in every pool process, before TensorFlow executes any op
+    global _splits
+    import cpu_mode
+    cpu_mode.configure(threads, 1)
+    splits = load_splits(path, split_file)
+    _splits = {name: (list(df['filepaths']), list(df['labels'])) for name, df in splits.items()}
+
+
+def generator(kind):
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+    if kind == 'cnn':  # the main.py augmentation
+        return ImageDataGenerator(rescale=1./255, shear_range=0.2, zoom_range=0.2, horizontal_flip=True,
+                                  fill_mode='nearest', width_shift_range=0.1, height_shift_range=0.1)
+    return ImageDataGenerator(preprocessing_function=scalar)
+
+
+def train_trial(trial, kind, config, start_epoch, end_epoch, out_dir):
+    '''
+    Trains one configuration from start_epoch to end_epoch, continuing from its saved weights,
+    and returns its validation metrics and the seconds it took.
+    '''
+    start = time.perf_counter()
+    from tensorflow.keras.optimizers import Adam, Adamax
+    from lra import LRA
+    from models import build_cnn, build_vgg19
+    from pixel_cache import flow_from_cache
+
+    size = (config['img_size'], config['img_size'])
+    gen = generator(kind)
+    train_gen = flow_from_cache(gen, *_splits['train'], target_size=size, batch_size=config['batch_size'],
+                                shuffle=True, seed=trial, name='sweep-train')
+    valid_gen = flow_from_cache(gen, *_splits['val'], target_size=size, batch_size=config['batch_size'],
+                                shuffle=False, class_indices=train_gen.class_indices, name='sweep-val')
+    class_count = len(train_gen.class_indices)
+    weights_path = os.path.join(out_dir, f'trial-{trial}.weights.h5')
+    state_path = os.path.join(out_dir, f'trial-{trial}.json')
+    learning_rate = config['learning_rate']
+    if start_epoch and os.path.exists(state_path):
+        with open(state_path) as f:
+            learning_rate = json.load(f)['learning_rate']  # where the LRA schedule left it
+
+    callbacks = []
+    if kind == 'cnn':
+        model = build_cnn(size[0], size[1], class_count)
+        model.compile(loss='categorical_crossentropy', optimizer=Adam(learning_rate=learning_rate), metrics=['accuracy'])
+    else:
+        model, _ = build_vgg19(size + (3,), class_count, l2=config['l2'], l1=config['l1'], dropout=config['dropout'])
+        model.compile(Adamax(learning_rate=learning_rate), loss='categorical_crossentropy', metrics=['accuracy'])
+        callbacks.append(LRA(model=model, patience=config['patience'], stop_patience=3, threshold=config['threshold'],
+                             factor=config['factor'], dwell=True, model_name=f'VGG19 trial {trial}', freeze=False,
+                             initial_epoch=start_epoch))
+        LRA.tepochs = end_epoch
+    if start_epoch:
+        model.load_weights(weights_path)
+
+    history = model.fit(train_gen, epochs=end_epoch, initial_epoch=start_epoch, validation_data=valid_gen,
+                        callbacks=callbacks, verbose=0)
+    model.save_weights(weights_path)
+    with open(state_path, 'w') as f:
+        json.dump({'learning_rate': float(model.optimizer.learning_rate.numpy())}, f)
+    return {
+        'trial': trial,
+        'epochs': start_epoch + len(history.history['loss']),  # LRA may stop early
+        'val_accuracy': float(max(history.history['val_accuracy'])),
+        'val_loss': float(min(history.history['val_loss'])),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def write_leaderboard(board, path):
+    rows = sorted(board.values(), key=lambda r: (-r['rung'], -r['val_accuracy']))
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'trial', 'rung', 'epochs', 'val_accuracy', 'val_loss', 'seconds', 'params'])
+        for rank, r in enumerate(rows, 1):
+            writer.writerow([rank, r['trial'], r['rung'], r['epochs'], f'{r["val_accuracy"]:.4f}',
+                             f'{r["val_loss"]:.4f}', f'{r["seconds"]:.1f}', json.dumps(r['params'])])
+    os.replace(tmp, path)
+
+
+def sweep(kind, space, trials, min_epochs, max_epochs, eta=3, threads_per_trial=2, path=PATH, split_file=None,
+          out_dir='sweep', leaderboard='sweep-leaderboard.csv', seed=123):
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    configs = {trial: dict(DEFAULTS[kind], **sample(space, rng)) for trial in range(trials)}
+
+    # decode every image once per input size, the trials only read the memory maps
+    splits = load_splits(path, split_file)
+    for img_size in sorted({c['img_size'] for c in configs.values()}):
+        for name in ('train', 'val'):
+            build_cache(splits[name]['filepaths'], splits[name]['labels'], (img_size, img_size), name=f'sweep-{name}')
+
+    workers = max(1, (os.cpu_count() or 1) // threads_per_trial)
+    print(f'{trials} trials on {workers} processes with {threads_per_trial} threads each')
+    board = {t: {'trial': t, 'params': c, 'rung': 0, 'epochs': 0, 'val_accuracy': 0.0, 'val_loss': float('inf'),
+                 'seconds': 0.0} for t, c in configs.items()}
+    alive = list(configs)
+    budget = min_epochs
+    rung = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(path, split_file, threads_per_trial)) as pool:
+        while True:
+            futures = [pool.submit(train_trial, t, kind, configs[t], board[t]['epochs'], budget, out_dir)
+                       for t in alive]
+            for future in futures:
+                result = future.result()
+                row = board[result['trial']]
+                row.update(rung=rung, epochs=result['epochs'], val_accuracy=result['val_accuracy'],
+                           val_loss=result['val_loss'])
+                row['seconds'] += result['seconds']
+            write_leaderboard(board, leaderboard)
+            best = max((board[t] for t in alive), key=lambda r: r['val_accuracy'])
+            print(f'Rung {rung}: {len(alive)} trials at {budget} epochs, best val accuracy '
+                  f'{best["val_accuracy"] * 100:.2f} % (trial {best["trial"]})')
+            if len(alive) <= 1 or budget >= max_epochs:
+                break
+            alive = sorted(alive, key=lambda t: -board[t]['val_accuracy'])[:max(1, len(alive) // eta)]
+            budget = min(budget * eta, max_epochs)
+            rung += 1
+    print(f'Leaderboard written to {leaderboard}')
+    return board
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Successive-halving hyperparameter sweep')
+    parser.add_argument('model', choices=sorted(SPACES))
+    parser.add_argument('--space', help='JSON search space replacing the built-in one')
+    parser.add_argument('--trials', type=int, default=27)
+    parser.add_argument('--min-epochs', type=int, default=1)
+    parser.add_argument('--max-epochs', type=int, default=9)
+    parser.add_argument('--eta', type=int, default=3, help='keep the best 1/eta trials at every rung')
+    parser.add_argument('--threads-per-trial', type=int, default=2)
+    parser.add_argument('--data', default=PATH, help='dataset root with train/val/test folders')
+    parser.add_argument('--split-file', help='split manifest written by split.py, used instead of the folders')
+    parser.add_argument('--out-dir', default='sweep', help='weights of the running trials')
+    parser.add_argument('--leaderboard', default='sweep-leaderboard.csv')
+    parser.add_argument('--seed', type=int, default=123)
+    args = parser.parse_args()
+
+    space = SPACES[args.model]
+    if args.space:
+        with open(args.space) as f:
+            space = json.load(f)
+    sweep(args.model, space, args.trials, args.min_epochs, args.max_epochs, args.eta, args.threads_per_trial,
+          args.data, args.split_file, args.out_dir, args.leaderboard, args.seed)
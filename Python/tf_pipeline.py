@@ -0,0 +1,173 @@
+'''
+tf.data input pipeline used by the training scripts when LOADER=tfdata.
+
+JPEGs are decoded and resized in parallel, the ImageDataGenerator augmentations (shear, zoom,
+shifts, flips) are applied to a whole batch at once with one projective transform, and batches are
+prefetched while the model trains. The augmentation settings and preprocessing are read from the
+ImageDataGenerator the scripts already build, so both loaders produce the same kind of batches.
+'''
+import math
+
+import numpy as np
+import tensorflow as tf
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def decode_image(path, target_size):
+    return decode_bytes(tf.io.read_file(path), target_size)
+
+
+def decode_bytes(data, target_size):
+    img = tf.io.decode_image(data, channels=3, expand_animations=False)
+    # nearest resize to match keras load_img
+    img = tf.image.resize(img, target_size, method='nearest')
+    return tf.cast(img, tf.uint8)
+
+
+def augment_config(gen):
+    # the subset of ImageDataGenerator settings that augment_batch supports
+    return {
+        'shear_range': float(gen.shear_range),
+        'zoom_range': (float(gen.zoom_range[0]), float(gen.zoom_range[1])),
+        'width_shift_range': float(gen.width_shift_range),
+        'height_shift_range': float(gen.height_shift_range),
+        'horizontal_flip': bool(gen.horizontal_flip),
+        'vertical_flip': bool(gen.vertical_flip),
+        'fill_mode': gen.fill_mode,
+        'cval': float(gen.cval),
+    }
+
+
+def has_augmentation(config):
+    return (config['shear_range'] or config['zoom_range'] != (1.0, 1.0) or config['width_shift_range']
+            or config['height_shift_range'] or config['horizontal_flip'] or config['vertical_flip'])
+
+
+def augment_batch(images, rng, config):
+    '''
+    Applies a random shear/zoom/shift/flip to every image of a float32 batch in a single
+    ImageProjectiveTransformV3 call. Like ImageDataGenerator the matrix maps output pixels back to
+    input pixels and is built around the image center.
+    '''
+    shape = tf.shape(images)
+    batch = shape[0]
+    height = tf.cast(shape[1], tf.float32)
+    width = tf.cast(shape[2], tf.float32)
+    ones = tf.ones([batch])
+    zeros = tf.zeros([batch])
+
+    def uniform(low, high):
+        return rng.uniform([batch], low, high)
+
+    shear = uniform(-config['shear_range'], config['shear_range']) * math.pi / 180 if config['shear_range'] else zeros
+    zoom_low, zoom_high = config['zoom_range']
+    zx = uniform(zoom_low, zoom_high) if (zoom_low, zoom_high) != (1.0, 1.0) else ones
+    zy = uniform(zoom_low, zoom_high) if (zoom_low, zoom_high) != (1.0, 1.0) else ones
+    tx = uniform(-config['width_shift_range'], config['width_shift_range']) * width if config['width_shift_range'] else zeros
+    ty = uniform(-config['height_shift_range'], config['height_shift_range']) * height if config['height_shift_range'] else zeros
+    fx = tf.where(uniform(0.0, 1.0) < 0.5, -ones, ones) if config['horizontal_flip'] else ones
+    fy = tf.where(uniform(0.0, 1.0) < 0.5, -ones, ones) if config['vertical_flip'] else ones
+
+    # centered affine: p_in = C . Shear . Zoom . Flip . C^-1 . p_out + shift
+    cx = (width - 1) / 2
+    cy = (height - 1) / 2
+    a00 = zx * fx
+    a01 = -tf.sin(shear) * zy * fy
+    a10 = zeros
+    a11 = tf.cos(shear) * zy * fy
+    a02 = cx - a00 * cx - a01 * cy + tx
+    a12 = cy - a10 * cx - a11 * cy + ty
+    transforms = tf.stack([a00, a01, a02, a10, a11, a12, zeros, zeros], axis=1)
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=shape[1:3],
+        fill_value=config['cval'],
+        interpolation='BILINEAR',
+        fill_mode=config['fill_mode'].upper(),
+    )
+
+
+def batch_and_augment(ds, gen, num_classes, batch_size, seed):
+    '''
+    Batches a dataset of (uint8 image, class index) pairs and applies the augmentation and
+    preprocessing of gen to every batch, yielding (float32 images, one-hot labels).
+    '''
+    config = augment_config(gen)
+    augment = has_augmentation(config)
+    ds = ds.batch(batch_size)
+
+    rng = tf.random.Generator.from_seed(seed)
+
+    def transform(images, label):
+        images = tf.cast(images, tf.float32)
+        if augment:
+            images = augment_batch(images, rng, config)
+        if gen.preprocessing_function:
+            images = gen.preprocessing_function(images)
+        if gen.rescale:
+            images = images * gen.rescale
+        return images, tf.one_hot(label, num_classes)
+
+    # the augmentation map draws from one stateful generator, so it runs sequentially to stay
+    # deterministic; it is a handful of vectorized ops per batch
+    ds = ds.map(transform)
+    options = tf.data.Options()
+    options.deterministic = True
+    # multi-worker runs shard the file lists themselves (distributed.shard), the dataset is not split again
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return ds.with_options(options).prefetch(AUTOTUNE)
+
+
+def make_dataset(filepaths, labels, gen, target_size, batch_size=32, shuffle=True, seed=123,
+                 class_indices=None, cache=None, shuffle_buffer=1024, epoch_images=None):
+    '''
+    Builds a batched, prefetching dataset of (images, one-hot labels) from file paths.
+
+    gen is the ImageDataGenerator the scripts already use: its augmentation ranges,
+    preprocessing_function and rescale are applied the same way flow_from_directory would.
+    cache='' keeps decoded images in memory, a path caches them on disk, None disables caching.
+    The returned dataset carries class_indices, classes, labels, filenames and n like the
+    keras iterators so the rest of the scripts can use it unchanged.
+    epoch_images makes every pass a class-balanced draw of that many images from all files, the
+    tf.data counterpart of balanced_sampler.BalancedSampler: each class present is an endlessly
+    reshuffled stream and sample_from_datasets picks a class with equal odds for every position.
+    '''
+    filepaths = [str(p) for p in filepaths]
+    labels = [str(l) for l in labels]
+    if class_indices is None:
+        class_indices = {klass: i for i, klass in enumerate(sorted(set(labels)))}
+    classes = np.array([class_indices[l] for l in labels], dtype='int32')
+    num_classes = len(class_indices)
+
+    if epoch_images:
+        if cache is not None:
+            raise ValueError('a class-balanced draw cannot be cached, pass cache=None with epoch_images')
+        paths = np.array(filepaths)
+        streams = []
+        for i in range(num_classes):
+            members = np.flatnonzero(classes == i)
+            if len(members):
+                streams.append(tf.data.Dataset.from_tensor_slices((paths[members], classes[members]))
+                               .shuffle(len(members), seed=seed + i, reshuffle_each_iteration=True).repeat())
+        ds = tf.data.Dataset.sample_from_datasets(streams, seed=seed).take(epoch_images)
+    else:
+        ds = tf.data.Dataset.from_tensor_slices((filepaths, classes))
+    if shuffle and cache is None and not epoch_images:
+        # shuffling file names is free, the buffer can hold the whole split
+        ds = ds.shuffle(len(filepaths), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.map(lambda path, label: (decode_image(path, target_size), label), num_parallel_calls=AUTOTUNE)
+    if cache is not None:
+        ds = ds.cache(cache)
+        if shuffle:
+            ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    ds = batch_and_augment(ds, gen, num_classes, batch_size, seed)
+
+    ds.class_indices = class_indices
+    ds.classes = classes
+    ds.labels = classes
+    ds.filenames = filepaths
+    ds.n = epoch_images or len(filepaths)
+    ds.batch_size = batch_size
+    return ds
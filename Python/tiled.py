@@ -0,0 +1,262 @@
+'''
+Tiled classification of large histology images.
+
+Instead of squashing a whole capture down to 224x224 like gui.classify, the image is cut into
+model-sized tiles (with a configurable stride), the tiles are classified in batches and the
+results are put back together into a per-tile probability heatmap and an image-level verdict.
+
+Whole-slide formats and tiled TIFFs are read region by region through openslide when it is
+installed, so only the tiles of the batches in flight are ever in memory. Without openslide, tiled
+TIFFs are read the same way through tifffile, which reads and decodes only the TIFF tiles under each
+region. Other formats (JPEG, PNG, striped TIFF) are decoded whole by PIL: JPEGs at the coarsest draft
+scale that still leaves every tile at least the model input size, and anything whose decoded raster
+would exceed --max-pixels is refused rather than lifting PIL's decompression-bomb guard.
+
+    python tiled.py capture.tif --model model.h5 --stride 112 --heatmap heatmap.npy --heatmap-png heatmap.png
+'''
+import argparse
+import json
+import queue
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+from inference import DEFAULT_MODEL, IMG_SIZE, classes, load_inference_model, lung_cancer_type, preprocess
+
+# one color per class for the heatmap preview, in lung_cancer_type order
+COLORS = np.array([[220, 50, 47], [181, 137, 0], [38, 139, 210]], dtype=np.uint8)
+
+MAX_PIXELS = 200_000_000  # largest raster decoded whole, about 600 MB as RGB
+
+_limit_lock = threading.Lock()
+
+
+@contextmanager
+def pixel_limit(max_pixels):
+    # Image.open refuses images over twice MAX_IMAGE_PIXELS; the limit is raised to our own budget
+    # only while a capture is opened and restored right after, the guard stays on for everything else
+    with _limit_lock:
+        previous = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = max(previous or 0, max_pixels)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+                yield
+        finally:
+            Image.MAX_IMAGE_PIXELS = previous
+
+
+class PILReader:
+    '''
+    Captures neither openslide nor tifffile can read region by region. The image is decoded once, at
+    a JPEG draft scale that keeps tiles at least min_tile pixels wide, and refused when the decoded
+    raster exceeds max_pixels.
+    '''
+    def __init__(self, path, max_pixels=MAX_PIXELS, tile=None, min_tile=None):
+        with pixel_limit(max_pixels):
+            image = Image.open(path)
+        self.size = image.size
+        if image.format == 'JPEG' and tile and min_tile:
+            # libjpeg decodes at 1/2, 1/4 or 1/8 scale for the cost of the smaller raster
+            for reduce in (8, 4, 2):
+                if tile // reduce >= min_tile:
+                    image.draft('RGB', (self.size[0] // reduce, self.size[1] // reduce))
+                    break
+        width, height = image.size  # after draft
+        if width * height > max_pixels:
+            image.close()
+            raise ValueError(f'{path}: {width}x{height} pixels exceed the {max_pixels} pixel budget, '
+                             'convert it to a tiled TIFF or raise --max-pixels')
+        with image:
+            self.image = image.convert('RGB')
+        self.scale = self.image.width / self.size[0]
+
+    def read(self, x, y, width, height):
+        s = self.scale
+        return self.image.crop((round(x * s), round(y * s), round((x + width) * s), round((y + height) * s)))
+
+    def close(self):
+        self.image.close()
+
+
+class TiffFileReader:
+    '''
+    Tiled 8-bit TIFFs through tifffile: every read decodes only the TIFF tiles under the region.
+    '''
+    def __init__(self, path):
+        import tifffile
+        self.tiff = tifffile.TiffFile(path)
+        page = self.tiff.pages[0]
+        if not page.is_tiled or page.dtype != np.uint8 or page.planarconfig != 1 or page.samplesperpixel not in (1, 3, 4):
+            self.tiff.close()
+            raise ValueError(f'{path}: not a tiled 8-bit TIFF with interleaved samples')
+        self.page = page
+        self.size = (page.imagewidth, page.imagelength)
+
+    def read(self, x, y, width, height):
+        page = self.page
+        tile_w, tile_h = page.tilewidth, page.tilelength
+        across = -(-self.size[0] // tile_w)
+        right = min(x + width, self.size[0])
+        bottom = min(y + height, self.size[1])
+        region = np.zeros((height, width, 3), dtype=np.uint8)  # black past the edge, as crop pads
+        fh = self.tiff.filehandle
+        for row in range(y // tile_h, (bottom - 1) // tile_h + 1):
+            for col in range(x // tile_w, (right - 1) // tile_w + 1):
+                index = row * across + col
+                data = None
+                if page.databytecounts[index]:
+                    fh.seek(page.dataoffsets[index])
+                    data = fh.read(page.databytecounts[index])
+                pixels, position, _ = page.decode(data, index, jpegtables=page.jpegtables)
+                if pixels is None:
+                    continue  # tile never written
+                pixels = pixels[0]  # (length, width, samples) of the single depth plane
+                if pixels.shape[-1] == 1:
+                    pixels = np.repeat(pixels, 3, axis=-1)
+                top, left = position[2], position[3]
+                y0, y1 = max(y, top), min(bottom, top + pixels.shape[0])
+                x0, x1 = max(x, left), min(right, left + pixels.shape[1])
+                region[y0 - y:y1 - y, x0 - x:x1 - x] = pixels[y0 - top:y1 - top, x0 - left:x1 - left, :3]
+        return Image.fromarray(region)
+
+    def close(self):
+        self.tiff.close()
+
+
+class OpenSlideReader:
+    def __init__(self, path):
+        import openslide
+        self.slide = openslide.OpenSlide(path)
+        self.size = self.slide.dimensions
+
+    def read(self, x, y, width, height):
+        return self.slide.read_region((x, y), 0, (width, height)).convert('RGB')
+
+    def close(self):
+        self.slide.close()
+
+
+def open_reader(path, max_pixels=MAX_PIXELS, tile=None, min_tile=None):
+    for reader in (OpenSlideReader, TiffFileReader):
+        try:
+            return reader(path)
+        except Exception:  # library missing or not a format it reads region by region
+            pass
+    return PILReader(path, max_pixels, tile, min_tile)
+
+
+def tile_origins(length, tile, stride):
+    # origins along one axis; a last tile flush with the far edge covers any remainder
+    last = max(length - tile, 0)
+    origins = list(range(0, last + 1, stride))
+    if origins[-1] != last:
+        origins.append(last)
+    return origins
+
+
+def tile_grid(size, tile, stride):
+    width, height = size
+    return tile_origins(width, tile, stride), tile_origins(height, tile, stride)
+
+
+def classify_tiled(model, path, tile=None, stride=None, batch_size=64, prefetch=2, max_pixels=MAX_PIXELS):
+    '''
+    Returns (heatmap, summary): heatmap has shape (rows, cols, classes) with the probabilities of
+    every tile, summary holds the image-level verdict and the throughput.
+    '''
+    _, in_h, in_w, _ = model.input_shape
+    if not in_h or not in_w:  # built for any size (PROGRESSIVE training)
+        in_w, in_h = IMG_SIZE
+    tile = tile or in_w
+    stride = stride or tile
+    reader = open_reader(path, max_pixels, tile, in_w)
+    xs, ys = tile_grid(reader.size, tile, stride)
+    heatmap = np.zeros((len(ys), len(xs), len(lung_cancer_type)), dtype=np.float32)
+    positions = [(r, c) for r in range(len(ys)) for c in range(len(xs))]
+
+    # a reader thread fills a bounded queue so tile decoding overlaps prediction without piling up
+    batches = queue.Queue(maxsize=prefetch)
+
+    def produce():
+        try:
+            for i in range(0, len(positions), batch_size):
+                chunk = positions[i:i + batch_size]
+                pixels = np.stack([preprocess(reader.read(xs[c], ys[r], tile, tile), (in_w, in_h)) for r, c in chunk])
+                batches.put((chunk, pixels))
+        except Exception as e:
+            batches.put(e)
+            return
+        batches.put(None)
+
+    start = time.perf_counter()
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            chunk, pixels = item
+            probs = np.asarray(model.predict_on_batch(pixels))
+            rows, cols = zip(*chunk)
+            heatmap[list(rows), list(cols)] = probs
+    finally:
+        reader.close()
+    elapsed = time.perf_counter() - start
+
+    mean = heatmap.reshape(-1, heatmap.shape[-1]).mean(axis=0) if positions else np.zeros(len(lung_cancer_type))
+    votes = np.bincount(heatmap.reshape(-1, heatmap.shape[-1]).argmax(axis=1), minlength=len(lung_cancer_type))
+    index = int(np.argmax(mean))
+    summary = {
+        'path': path,
+        'size': list(reader.size),
+        'tile': tile,
+        'stride': stride,
+        'tiles': len(positions),
+        'class': lung_cancer_type[index],
+        'label': classes[index],
+        'mean_probabilities': {k: float(p) for k, p in zip(lung_cancer_type, mean)},
+        'tile_fractions': {k: float(v) / max(len(positions), 1) for k, v in zip(lung_cancer_type, votes)},
+        'seconds': elapsed,
+        'tiles_per_sec': len(positions) / elapsed if elapsed else 0.0,
+    }
+    return heatmap, summary
+
+
+def heatmap_image(heatmap, tile_px=16):
+    # colored by the winning class, brighter where the model is more confident
+    winner = heatmap.argmax(axis=-1)
+    confidence = heatmap.max(axis=-1)[..., np.newaxis]
+    rgb = (COLORS[winner] * confidence).astype(np.uint8)
+    image = Image.fromarray(rgb)
+    return image.resize((image.width * tile_px, image.height * tile_px), Image.NEAREST)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify a large image tile by tile')
+    parser.add_argument('image')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='.h5 model or quantized .tflite')
+    parser.add_argument('--tile', type=int, default=None, help='tile size in pixels (default: model input size)')
+    parser.add_argument('--stride', type=int, default=None, help='distance between tiles (default: tile size)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-pixels', type=int, default=MAX_PIXELS,
+                        help='largest raster decoded whole when it cannot be read tile by tile')
+    parser.add_argument('--heatmap', help='save the (rows, cols, classes) probabilities as .npy')
+    parser.add_argument('--heatmap-png', help='save a colored preview of the heatmap')
+    args = parser.parse_args()
+
+    model = load_inference_model(args.model)
+    heatmap, summary = classify_tiled(model, args.image, args.tile, args.stride, args.batch_size,
+                                      max_pixels=args.max_pixels)
+    if args.heatmap:
+        np.save(args.heatmap, heatmap)
+    if args.heatmap_png:
+        heatmap_image(heatmap).save(args.heatmap_png)
+    print(json.dumps(summary, indent=2))
+    print(f'{summary["class"]} detected, {summary["tiles"]} tiles at {summary["tiles_per_sec"]:.1f} tiles/s')
@@ -1,6 +1,123 @@
-import splitfolders
-splitfolders.ratio('/home/andrei/Desktop/ProiectLicenta/lung_image_sets', 
-      output="output", 
-      seed=1337, 
-      ratio=(.8, 0.1,0.1)
-)
\ No newline at end of file
+'''
+Deterministic train/val/test split of the image folders without copying any pixels.
+
+The split is exactly stratified: a first walk counts the images of every class and sets per-class
+quotas for train/val/test (the ratios, rounded by largest remainder). The second walk streams the
+files in sorted order and picks each one's split by selection sampling: with r images of its class
+still to come and t, v, s places left in train, val and test, a uniform number drawn from a hash of
+the seed and the image's path relative to the dataset root sends it to train below t/r, to val below
+(t + v)/r and to test otherwise. Every quota is then met exactly, the assignment is the same on every
+run and machine for the same files, and memory stays at a few counters per class: files go straight
+from the folder walk to the output.
+
+By default a split manifest is written, a CSV with filepaths,labels,split columns that main.py and
+main1.py read through SPLIT_FILE. --link symlink/hardlink builds output/<split>/<class>/ trees
+instead, for tools that want flow_from_directory style folders.
+
+    python split.py /home/andrei/Desktop/ProiectLicenta/lung_image_sets --manifest split.csv
+    python split.py /home/andrei/Desktop/ProiectLicenta/lung_image_sets --link symlink --output output
+'''
+import argparse
+import csv
+import hashlib
+import os
+from collections import Counter
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+SPLITS = ('train', 'val', 'test')
+
+
+def iter_images(root):
+    # (path, label) for every image, the label being the name of the folder holding it
+    for dirpath, dirs, files in os.walk(root):
+        dirs.sort()
+        for f in sorted(files):
+            if f.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(dirpath, f), os.path.basename(dirpath)
+
+
+def path_hash(relpath, seed):
+    # uniform in [0, 1) from the seed and the path, independent of the machine and the listing order
+    digest = hashlib.sha1(f'{seed}:{relpath}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') / 2**64
+
+
+def quotas(count, ratio):
+    # images per split for a class of count images, rounded by largest remainder so they sum to count
+    exact = [count * r / sum(ratio) for r in ratio]
+    quota = [int(x) for x in exact]
+    for i in sorted(range(len(exact)), key=lambda i: exact[i] - quota[i], reverse=True)[:count - sum(quota)]:
+        quota[i] += 1
+    return quota
+
+
+def assign_split(needed, remaining, u):
+    # selection sampling: needed holds the places left per split and sums to remaining
+    bound = 0
+    for i, name in enumerate(SPLITS):
+        bound += needed[i]
+        if u * remaining < bound:
+            needed[i] -= 1
+            return name
+    raise ValueError('no places left for this class')
+
+
+def split_images(root, seed=1337, ratio=(.8, .1, .1)):
+    root = os.path.abspath(root)
+    totals = Counter(label for _, label in iter_images(root))
+    needed = {label: quotas(count, ratio) for label, count in totals.items()}
+    remaining = dict(totals)
+    for path, label in iter_images(root):
+        u = path_hash(os.path.relpath(path, root).replace(os.sep, '/'), seed)
+        yield path, label, assign_split(needed[label], remaining[label], u)
+        remaining[label] -= 1
+
+
+def write_manifest(root, out, seed=1337, ratio=(.8, .1, .1)):
+    counts = Counter()
+    with open(out, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['filepaths', 'labels', 'split'])
+        for path, label, split in split_images(root, seed, ratio):
+            writer.writerow([path, label, split])
+            counts[label, split] += 1
+    return counts
+
+
+def write_links(root, output, seed=1337, ratio=(.8, .1, .1), mode='symlink'):
+    counts = Counter()
+    for path, label, split in split_images(root, seed, ratio):
+        target = os.path.join(output, split, label, os.path.basename(path))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            os.remove(target)
+        if mode == 'hardlink':
+            os.link(path, target)
+        else:
+            os.symlink(path, target)
+        counts[label, split] += 1
+    return counts
+
+
+def print_counts(counts):
+    labels = sorted({label for label, _ in counts})
+    print(f'{"Class":<20s}' + ''.join(f'{s:>8s}' for s in SPLITS))
+    for label in labels:
+        print(f'{label:<20s}' + ''.join(f'{counts[label, s]:>8d}' for s in SPLITS))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split the dataset into train/val/test without copying images')
+    parser.add_argument('root', nargs='?', default='/home/andrei/Desktop/ProiectLicenta/lung_image_sets')
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--ratio', type=float, nargs=3, default=(.8, .1, .1), metavar=('TRAIN', 'VAL', 'TEST'))
+    parser.add_argument('--manifest', default='split.csv', help='split manifest to write (default)')
+    parser.add_argument('--link', choices=('symlink', 'hardlink'), help='build link trees instead of a manifest')
+    parser.add_argument('--output', default='output', help='root of the link trees')
+    args = parser.parse_args()
+
+    if args.link:
+        counts = write_links(args.root, args.output, args.seed, args.ratio, args.link)
+    else:
+        counts = write_manifest(args.root, args.manifest, args.seed, args.ratio)
+    print_counts(counts)
@@ -0,0 +1,47 @@
+from collections import Counter
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('tensorflow')
+
+from balanced_sampler import acceptance, balanced_indices
+
+LABELS = ['lung_aca'] * 9000 + ['lung_n'] * 900 + ['lung_scc'] * 100
+
+
+def test_acceptance_favours_rare_classes():
+    classes = np.array([0] * 90 + [1] * 10)
+    accept = acceptance(classes, 2, {'a': 0, 'b': 1})
+    assert accept.max() == 1.0
+    assert accept[1] == 1.0
+    assert accept[0] == pytest.approx(10 / 90)
+
+
+def test_balanced_indices_equal_class_mix():
+    index = balanced_indices(LABELS, 30000, seed=1)
+    assert len(index) == 30000
+    assert index.min() >= 0 and index.max() < len(LABELS)
+    counts = Counter(LABELS[i] for i in index)
+    for label in ('lung_aca', 'lung_n', 'lung_scc'):
+        assert counts[label] == pytest.approx(10000, rel=0.05)
+
+
+def test_balanced_indices_draw_from_every_image():
+    index = balanced_indices(LABELS, 30000, seed=1)
+    # each lung_scc image is expected about 100 times, every one of them has to come up
+    assert set(range(9900, 10000)) <= set(index.tolist())
+
+
+def test_balanced_indices_depend_only_on_the_seed():
+    assert np.array_equal(balanced_indices(LABELS, 500, seed=5), balanced_indices(LABELS, 500, seed=5))
+    assert not np.array_equal(balanced_indices(LABELS, 500, seed=5), balanced_indices(LABELS, 500, seed=6))
+
+
+def test_balanced_indices_class_weights():
+    class_indices = {'lung_aca': 0, 'lung_n': 1, 'lung_scc': 2}
+    index = balanced_indices(LABELS, 3000, class_indices=class_indices,
+                             class_weights={'lung_aca': 1.0, 'lung_n': 0.0, 'lung_scc': 1.0})
+    counts = Counter(LABELS[i] for i in index)
+    assert counts['lung_n'] == 0
+    assert counts['lung_aca'] == pytest.approx(1500, rel=0.1)
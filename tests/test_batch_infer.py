@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+pytest.importorskip('tensorflow')
+
+from batch_infer import ResultWriter
+
+
+def jsonl_line(path):
+    return json.dumps({'path': path, 'class': 'Lung n'}) + '\n'
+
+
+def test_partial_last_line_is_dropped(tmp_path):
+    out = tmp_path / 'scores.jsonl'
+    out.write_text(jsonl_line('a.jpeg') + jsonl_line('b.jpeg') + '{"path": "c.jp')
+    writer = ResultWriter(str(out))
+    writer.close()
+    assert (writer.done, writer.last_path) == (2, 'b.jpeg')
+    assert out.read_text() == jsonl_line('a.jpeg') + jsonl_line('b.jpeg')
+
+
+def test_partial_line_longer_than_a_read_chunk(tmp_path):
+    out = tmp_path / 'scores.jsonl'
+    out.write_text(jsonl_line('a.jpeg') + '{"path": "' + 'x' * 200000)
+    writer = ResultWriter(str(out))
+    writer.close()
+    assert (writer.done, writer.last_path) == (1, 'a.jpeg')
+    assert out.read_text() == jsonl_line('a.jpeg')
+
+
+def test_file_without_a_complete_line(tmp_path):
+    out = tmp_path / 'scores.jsonl'
+    out.write_text('{"path"')
+    writer = ResultWriter(str(out))
+    writer.close()
+    assert (writer.done, writer.last_path) == (0, None)
+    assert out.read_text() == ''
+
+
+def test_blank_lines_are_skipped(tmp_path):
+    out = tmp_path / 'scores.jsonl'
+    out.write_text(jsonl_line('a.jpeg') + '\n' + jsonl_line('b.jpeg') + '\n')
+    writer = ResultWriter(str(out))
+    writer.close()
+    assert (writer.done, writer.last_path) == (2, 'b.jpeg')
+
+
+def test_csv_resume(tmp_path):
+    out = str(tmp_path / 'scores.csv')
+    writer = ResultWriter(out)
+    writer.write('a.jpeg', [0.1, 0.2, 0.7])
+    writer.write('b.jpeg', error='OSError: broken')
+    writer.close()
+    with open(out, 'a') as f:
+        f.write('c.jpeg,Lung')  # killed mid-row
+    writer = ResultWriter(out)
+    writer.close()
+    assert (writer.done, writer.last_path) == (2, 'b.jpeg')
+    with open(out) as f:
+        rows = f.read().splitlines()
+    assert rows[0].startswith('path,class,')
+    assert len(rows) == 3
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+pytest.importorskip('tensorflow')
+
+from manifest import Manifest
+
+
+def add_image(path, size=(8, 6)):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', size).save(path)
+
+
+def touch_dir(path):
+    # folder mtimes can be coarse, make sure a change is visible
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    root = tmp_path / 'images'
+    for label, count in (('lung_aca', 3), ('lung_n', 2)):
+        for i in range(count):
+            add_image(str(root / label / f'{label}{i}.jpeg'))
+    manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+    yield str(root), manifest
+    manifest.close()
+
+
+def test_refresh_lists_every_image(dataset):
+    root, manifest = dataset
+    stats = manifest.refresh(root)
+    assert stats['files_described'] == 5
+    filepaths, labels = manifest.list(root)
+    assert filepaths == sorted(filepaths)
+    assert labels == ['lung_aca'] * 3 + ['lung_n'] * 2
+    assert manifest.counts(root) == {'lung_aca': 3, 'lung_n': 2}
+    width, height, sha1 = manifest.conn.execute('SELECT width, height, sha1 FROM files LIMIT 1').fetchone()
+    assert (width, height) == (8, 6) and len(sha1) == 40
+
+
+def test_unchanged_folders_are_not_listed(dataset):
+    root, manifest = dataset
+    manifest.refresh(root)
+    stats = manifest.refresh(root)
+    assert stats['dirs_listed'] == 0
+    assert stats['files_described'] == 0
+    assert stats['dirs_checked'] == 3
+
+
+def test_only_changed_folders_are_listed(dataset):
+    root, manifest = dataset
+    manifest.refresh(root)
+    add_image(os.path.join(root, 'lung_n', 'new.jpeg'))
+    touch_dir(os.path.join(root, 'lung_n'))
+    stats = manifest.refresh(root)
+    assert stats['dirs_listed'] == 1
+    assert stats['files_described'] == 1
+    assert manifest.count(root) == 6
+
+    os.remove(os.path.join(root, 'lung_aca', 'lung_aca0.jpeg'))
+    touch_dir(os.path.join(root, 'lung_aca'))
+    stats = manifest.refresh(root)
+    assert stats['files_removed'] == 1
+    assert manifest.counts(root) == {'lung_aca': 2, 'lung_n': 3}
+
+
+def test_removed_folder_is_forgotten(dataset):
+    root, manifest = dataset
+    manifest.refresh(root)
+    for f in os.listdir(os.path.join(root, 'lung_n')):
+        os.remove(os.path.join(root, 'lung_n', f))
+    os.rmdir(os.path.join(root, 'lung_n'))
+    touch_dir(root)
+    stats = manifest.refresh(root)
+    assert stats['files_removed'] == 2
+    assert manifest.counts(root) == {'lung_aca': 3}
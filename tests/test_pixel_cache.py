@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+Image = pytest.importorskip('PIL.Image')
+pytest.importorskip('tensorflow')
+
+from pixel_cache import build_cache
+
+
+def make_images(directory, count, start=0):
+    paths = []
+    for i in range(start, start + count):
+        path = os.path.join(directory, f'img{i}.png')
+        Image.new('RGB', (12, 10), (i, 2 * i, 3 * i)).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_cache_holds_the_resized_pixels(tmp_path):
+    paths = make_images(str(tmp_path), 3)
+    cache = build_cache(paths, ['a', 'b', 'a'], (5, 6), cache_dir=str(tmp_path / 'cache'), workers=2)
+    assert cache.pixels.shape == (3, 5, 6, 3)
+    assert cache.pixels[2].tolist() == [[[2, 4, 6]] * 6] * 5
+    assert cache.labels == ['a', 'b', 'a']
+    again = build_cache(paths, ['a', 'b', 'a'], (5, 6), cache_dir=str(tmp_path / 'cache'))
+    assert again.directory == cache.directory
+
+
+def test_new_entry_replaces_the_stale_ones_of_its_name(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    paths = make_images(str(tmp_path), 3)
+    old = build_cache(paths, ['a'] * 3, (4, 4), cache_dir=cache_dir, name='train')
+    other_size = build_cache(paths, ['a'] * 3, (8, 8), cache_dir=cache_dir, name='train')
+    other_name = build_cache(paths[:1], ['a'], (4, 4), cache_dir=cache_dir, name='val')
+    new = build_cache(paths + make_images(str(tmp_path), 1, start=3), ['a'] * 4, (4, 4), cache_dir=cache_dir,
+                      name='train')
+    entries = set(os.listdir(cache_dir))
+    assert os.path.basename(old.directory) not in entries
+    assert {os.path.basename(c.directory) for c in (other_size, other_name, new)} == entries
@@ -0,0 +1,42 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+
+from prediction_cache import PredictionCache, content_hash
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = PredictionCache(str(tmp_path / 'cache.sqlite'), memory_entries=2, max_bytes=100)
+    yield cache
+    cache.close()
+
+
+def test_round_trip_and_hit_counts(cache):
+    key = cache.key(content_hash(b'tile'), 'model.h5:1:2')
+    assert cache.get(key) is None
+    cache.put(key, [0.1, 0.7, 0.2], 12.0)
+    assert np.allclose(cache.get(key), [0.1, 0.7, 0.2])
+    assert cache.stats()['memory_hits'] == 1 and cache.stats()['misses'] == 1
+    assert cache.key(content_hash(b'tile'), 'other.h5:1:2') != key
+
+
+def test_memory_lru_keeps_the_most_recent_entries(cache):
+    for key in ('k1', 'k2', 'k3'):
+        cache.put(key, [1.0, 0.0, 0.0], 1.0)
+    assert list(cache.memory) == ['k2', 'k3']
+    assert cache.get('k1') is not None  # still on disk
+    assert cache.stats()['disk_hits'] == 1
+    assert list(cache.memory) == ['k3', 'k1']
+
+
+def test_trim_drops_least_recently_used_rows(cache):
+    # every row is 12 bytes of probabilities + 2 of key + 16, so 3 of them fit in 100 bytes
+    for i in range(10):
+        cache.put(f'k{i}', [0.2, 0.3, 0.5], 1.0)
+        cache.conn.execute('UPDATE predictions SET last_used = ? WHERE key = ?', (i, f'k{i}'))
+    cache.conn.commit()
+    cache._trim()
+    keys = [r[0] for r in cache.conn.execute('SELECT key FROM predictions ORDER BY key')]
+    assert keys == ['k7', 'k8', 'k9']
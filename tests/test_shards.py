@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+
+from shards import (ShardReader, pack, parse_header, parse_image, read_index, read_record, rebuild_index,
+                    record_size, shard_files)
+
+
+@pytest.fixture
+def packed(tmp_path):
+    filepaths, labels = [], []
+    for i in range(20):
+        label = ('lung_aca', 'lung_n')[i % 2]
+        path = tmp_path / f'{label}{i}.jpeg'
+        path.write_bytes(bytes([i]) * (100 + i))  # never decoded here, any bytes will do
+        filepaths.append(str(path))
+        labels.append(label)
+    out_dir = str(tmp_path / 'packed')
+    pack({'train': (filepaths, labels)}, out_dir, num_shards=3, workers=1)
+    return out_dir, dict(zip(filepaths, labels))
+
+
+def test_offsets_point_at_the_records(packed):
+    out_dir, files = packed
+    index = read_index(out_dir, 'train')
+    assert sum(shard['count'] for shard in index['shards']) == len(files)
+    for shard in index['shards']:
+        with open(os.path.join(out_dir, shard['file']), 'rb') as f:
+            assert parse_header(read_record(f))['count'] == shard['count']
+            for offset, label, path in zip(shard['offsets'], shard['labels'], shard['paths']):
+                f.seek(offset)
+                data, record_label, record_path = parse_image(read_record(f))
+                assert record_path == path
+                assert record_label == label == index['class_indices'][files[path]]
+                with open(path, 'rb') as original:
+                    assert data == original.read()
+
+
+def test_framing_matches_tfrecord(packed):
+    out_dir, _ = packed
+    for shard in read_index(out_dir, 'train')['shards']:
+        records = [r.numpy() for r in tf.data.TFRecordDataset(os.path.join(out_dir, shard['file']))]
+        assert len(records) == shard['count'] + 1
+        positions = np.cumsum([0] + [record_size(r) for r in records])
+        assert positions[1:-1].tolist() == shard['offsets']
+        assert positions[-1] == os.path.getsize(os.path.join(out_dir, shard['file']))
+
+
+def test_rebuild_index_from_the_shards(packed):
+    out_dir, _ = packed
+    index = read_index(out_dir, 'train')
+    os.remove(os.path.join(out_dir, 'train.index.json'))
+    rebuild_index(out_dir, 'train')
+    assert read_index(out_dir, 'train') == index
+
+
+def test_shard_reader_and_shard_files(packed):
+    out_dir, files = packed
+    filepaths, labels = shard_files(out_dir, 'train')
+    assert sorted(filepaths) == sorted(files)
+    assert labels == [files[p] for p in filepaths]
+    reader = ShardReader(out_dir, 'train')
+    try:
+        assert len(reader) == len(files)
+        for i, path in enumerate(filepaths):
+            assert reader[i][2] == path
+        assert reader[-1][2] == filepaths[-1]
+        with pytest.raises(IndexError):
+            reader[len(files)]
+    finally:
+        reader.close()
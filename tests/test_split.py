@@ -0,0 +1,74 @@
+import os
+from collections import Counter
+
+import pytest
+
+from split import SPLITS, assign_split, path_hash, quotas, split_images, write_manifest
+
+
+def make_tree(root, counts):
+    for label, count in counts.items():
+        os.makedirs(os.path.join(root, label))
+        for i in range(count):
+            open(os.path.join(root, label, f'{label}{i:04d}.jpeg'), 'wb').close()
+
+
+def test_quotas_sum_to_count():
+    for count in range(50):
+        assert sum(quotas(count, (.8, .1, .1))) == count
+
+
+def test_quotas_largest_remainder():
+    assert quotas(997, (.8, .1, .1)) == [797, 100, 100]
+    assert quotas(10, (1, 1, 1)) == [4, 3, 3]
+    assert quotas(5000, (.8, .1, .1)) == [4000, 500, 500]
+
+
+def test_path_hash_is_uniform_and_stable():
+    values = [path_hash(f'lung_n/lungn{i}.jpeg', 1337) for i in range(1000)]
+    assert all(0 <= u < 1 for u in values)
+    assert values == [path_hash(f'lung_n/lungn{i}.jpeg', 1337) for i in range(1000)]
+    assert values != [path_hash(f'lung_n/lungn{i}.jpeg', 1) for i in range(1000)]
+    assert 0.45 < sum(values) / len(values) < 0.55
+
+
+def test_assign_split_meets_every_quota():
+    for u_of in (lambda i: 0.0, lambda i: 0.999999, lambda i: path_hash(str(i), 7)):
+        needed = [8, 1, 1]
+        got = Counter(assign_split(needed, 10 - i, u_of(i)) for i in range(10))
+        assert got == {'train': 8, 'val': 1, 'test': 1}
+        assert needed == [0, 0, 0]
+
+
+def test_assign_split_without_places():
+    with pytest.raises(ValueError):
+        assign_split([0, 0, 0], 1, 0.5)
+
+
+def test_split_images_is_exact_and_deterministic(tmp_path):
+    make_tree(str(tmp_path), {'lung_aca': 997, 'lung_n': 120, 'lung_scc': 3})
+    first = list(split_images(str(tmp_path)))
+    assert first == list(split_images(str(tmp_path)))
+    counts = Counter((label, split) for _, label, split in first)
+    assert [counts['lung_aca', s] for s in SPLITS] == [797, 100, 100]
+    assert [counts['lung_n', s] for s in SPLITS] == [96, 12, 12]
+    assert [counts['lung_scc', s] for s in SPLITS] == quotas(3, (.8, .1, .1))
+
+
+def test_split_does_not_depend_on_the_root(tmp_path):
+    make_tree(str(tmp_path / 'a'), {'lung_n': 50})
+    make_tree(str(tmp_path / 'b'), {'lung_n': 50})
+    a = [(os.path.basename(p), s) for p, _, s in split_images(str(tmp_path / 'a'))]
+    b = [(os.path.basename(p), s) for p, _, s in split_images(str(tmp_path / 'b'))]
+    assert a == b
+
+
+def test_write_manifest(tmp_path):
+    make_tree(str(tmp_path / 'images'), {'lung_aca': 20, 'lung_n': 10})
+    out = str(tmp_path / 'split.csv')
+    counts = write_manifest(str(tmp_path / 'images'), out)
+    with open(out) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'filepaths,labels,split'
+    assert len(lines) == 31
+    assert counts['lung_aca', 'train'] == 16 and counts['lung_n', 'val'] == 1